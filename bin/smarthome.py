@@ -93,6 +93,7 @@ import lib.item
 import lib.log
 import lib.logic
 import lib.module
+import lib.network
 import lib.plugin
 import lib.scene
 import lib.scheduler
@@ -101,6 +102,7 @@ import lib.utils
 import lib.orb
 from lib.shtime import Shtime
 import lib.shyaml
+import lib.timeseries
 
 from lib.constants import (YAML_FILE, CONF_FILE, DEFAULT_FILE)
 
@@ -484,6 +486,12 @@ class SmartHome():
         self._logger.info("Items initialization finished, {} items loaded".format(self.items.item_count()))
         self.item_load_complete = True
 
+        #############################################################
+        # Init Time Series
+        #############################################################
+        self.timeseries = lib.timeseries.TimeSeries(self)
+        self.timeseries.start()
+
         #############################################################
         # Init Logics
         #############################################################
@@ -530,10 +538,16 @@ class SmartHome():
         self._logger.info("stop: Number of Threads: {}".format(threading.activeCount()))
 
         self.items.stop()
+        self.timeseries.stop()
+        scenes = lib.scene.Scenes.get_instance()
+        if scenes is not None:
+            scenes.save_learned_values()
         self.scheduler.stop()
         self.plugins.stop()
         self.modules.stop()
         self.connections.close()
+        lib.network.NetworkLoop.shutdown()
+        lib.network.HttpClient.shutdown()
 
         for thread in threading.enumerate():
             if thread.name != 'Main':
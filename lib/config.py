@@ -30,8 +30,13 @@ This library does the handling and parsing of the configuration of SmartHomeNG.
 
 import logging
 import collections
+import concurrent.futures
 import keyword
+import multiprocessing
 import os
+import pickle
+import sys
+import time
 import lib.shyaml as shyaml
 from lib.constants import (YAML_FILE, CONF_FILE)
 logger = logging.getLogger(__name__)
@@ -44,6 +49,14 @@ reserved = ['set', 'get']
 REMOVE_ATTR = 'attr'
 REMOVE_PATH = 'path'
 
+# precompiled character sets and words for sanitize_and_merge()
+_valid_key_chars = frozenset(valid_item_chars + valid_attr_chars)
+_digits = frozenset(digits)
+_reserved = frozenset(reserved)
+
+SNAPSHOT_VERSION = 1
+PARALLEL_MIN_FILES = 4
+
 def parse_basename(basename, configtype=''):
     '''
     Load and parse a single configuration and merge it to the configuration tree
@@ -69,7 +82,7 @@ def parse_basename(basename, configtype=''):
     return config
         
 
-def parse_itemsdir(itemsdir, item_conf, addfilenames=False):
+def parse_itemsdir(itemsdir, item_conf, addfilenames=False, processes=1):
     '''
     Load and parse item configurations and merge it to the configuration tree
     The configuration is only specified by the name of the directory.
@@ -78,26 +91,277 @@ def parse_itemsdir(itemsdir, item_conf, addfilenames=False):
     
     :param itemsdir: Name of folder containing the configuration files
     :param item_conf: Optional OrderedDict tree, into which the configuration should be merged
+    :param processes: Number of processes to parse the files in parallel (None: number of CPUs)
     :type itemsdir: str
     :type item_conf: OrderedDict
+    :type processes: int
 
     :return: The resulting merged OrderedDict tree
     :rtype: OrderedDict
 
     '''
-    for item_file in sorted(os.listdir(itemsdir)):
-        if item_file.endswith(CONF_FILE) or item_file.endswith(YAML_FILE):
-            if item_file == 'logic'+YAML_FILE and itemsdir.find('lib/env/') > -1:
-                logger.info("config.parse_itemsdir: skipping logic definition file = {}".format( itemsdir+item_file ))
-            else:
-                try:
-                    item_conf = parse(itemsdir + item_file, item_conf, addfilenames)
-                except Exception as e:
-                    logger.exception("Problem reading {0}: {1}".format(item_file, e))
+    return _parse_files(_itemsdir_parse_list(itemsdir, addfilenames), item_conf, processes)
+
+
+def _itemsdir_parse_list(itemsdir, addfilenames):
+    files = []
+    for item_file in _itemsdir_files(itemsdir):
+        if item_file == 'logic'+YAML_FILE and itemsdir.find('lib/env/') > -1:
+            logger.info("config.parse_itemsdir: skipping logic definition file = {}".format( itemsdir+item_file ))
+        else:
+            files.append((itemsdir, item_file, addfilenames))
+    return files
+
+
+def _parse_files(files, item_conf, processes=1):
+    '''
+    Parse configuration files and merge them to the configuration tree in the given order
+
+    With more than one process (and at least PARALLEL_MIN_FILES files) each file is parsed to a
+    tree of its own in a process pool and the trees are merged in the main process. Messages
+    logged while parsing are passed to the main process and logged there.
+
+    :param files: List of tuples (folder, filename, addfilenames)
+    '''
+    if processes is None:
+        processes = os.cpu_count() or 1
+    if processes > 1 and len(files) >= PARALLEL_MIN_FILES:
+        try:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=min(processes, len(files)), mp_context=_pool_context()) as executor:
+                futures = [executor.submit(_parse_file_isolated, itemsdir + item_file, addfilenames) for itemsdir, item_file, addfilenames in files]
+                results = [_future_result(future) for future in futures]
+        except (OSError, concurrent.futures.BrokenExecutor) as e:
+            logger.warning("config._parse_files: Parsing in parallel failed, parsing sequentially: {}".format(e))
+        else:
+            for (itemsdir, item_file, addfilenames), (file_conf, records, e) in zip(files, results):
+                for record in records:
+                    record_logger = logging.getLogger(record.name)
+                    if record_logger.isEnabledFor(record.levelno):
+                        record_logger.handle(record)
+                if e is not None:
+                    logger.error("Problem reading {0}: {1}".format(item_file, e), exc_info=e)
                     continue
+                if item_conf is None:
+                    item_conf = collections.OrderedDict()
+                item_conf = merge(file_conf, item_conf)
+            return item_conf
+
+    for itemsdir, item_file, addfilenames in files:
+        try:
+            item_conf = parse(itemsdir + item_file, item_conf, addfilenames)
+        except Exception as e:
+            logger.exception("Problem reading {0}: {1}".format(item_file, e))
+            continue
     return item_conf
 
 
+def _pool_context():
+    '''
+    Returns the multiprocessing context for the parse pool
+
+    Items are loaded while the scheduler, plugins and connections already run their threads.
+    A forked worker would inherit locks held by these threads, so the workers are started
+    by a forkserver (or spawned, where no forkserver is available) instead.
+    '''
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('forkserver')
+    return multiprocessing.get_context('spawn')
+
+
+def _future_result(future):
+    '''
+    Returns the result of a future of _parse_file_isolated as tuple (configuration tree, log records, exception)
+    '''
+    try:
+        file_conf, records = future.result()
+    except concurrent.futures.BrokenExecutor:
+        raise
+    except Exception as e:
+        return None, [], e
+    return file_conf, records, None
+
+
+def _parse_file_isolated(filename, addfilenames):
+    '''
+    Parse a configuration file to a tree of its own (runs in a worker process of _parse_files)
+
+    :return: configuration tree and the log records of the messages logged while parsing
+    '''
+    collector = _RecordCollector()
+    loggers = [logging.getLogger(name) for name in (__name__, shyaml.__name__)]
+    saved = [(l.handlers, l.propagate, l.level) for l in loggers]
+    for l in loggers:
+        l.handlers = [collector]
+        l.propagate = False
+        l.setLevel(logging.DEBUG)
+    try:
+        file_conf = parse(filename, None, addfilenames)
+    finally:
+        for l, (handlers, propagate, level) in zip(loggers, saved):
+            l.handlers = handlers
+            l.propagate = propagate
+            l.setLevel(level)
+    return file_conf, collector.records
+
+
+def parse_itemsdirs(itemsdirs, snapshot_file=None, processes=None):
+    '''
+    Load and parse the item configurations of several directories and merge them in the given order
+    (see parse_itemsdir)
+
+    If a snapshot file is given, the resulting configuration tree is stored in it, together with
+    the modification times and sizes of all configuration files. As long as no configuration file
+    has been changed, added or removed, the configuration tree is loaded from the snapshot instead
+    of parsing the files again. The snapshot is not stored, if warnings or errors were logged while
+    parsing, so they are logged again at the next start until the configuration is fixed.
+
+    The files are parsed in parallel by 'processes' processes (default: number of CPUs).
+
+    :param itemsdirs: List of tuples (name of folder containing the configuration files, addfilenames)
+    :param snapshot_file: Optional name of the snapshot file
+    :param processes: Number of processes to parse the files in parallel
+    :type itemsdirs: list
+    :type snapshot_file: str
+    :type processes: int
+
+    :return: The resulting merged OrderedDict tree
+    :rtype: OrderedDict
+
+    '''
+    sources = _snapshot_sources(itemsdirs)
+    if snapshot_file is not None:
+        item_conf = load_snapshot(snapshot_file, sources)
+        if item_conf is not None:
+            logger.info("config.parse_itemsdirs: Item configuration loaded from snapshot {}".format(snapshot_file))
+            return item_conf
+
+    problems = _ProblemCounter()
+    loggers = [logger, logging.getLogger(shyaml.__name__)]
+    for l in loggers:
+        l.addHandler(problems)
+    try:
+        files = []
+        for itemsdir, addfilenames in itemsdirs:
+            files.extend(_itemsdir_parse_list(itemsdir, addfilenames))
+        item_conf = _parse_files(files, None, processes)
+    finally:
+        for l in loggers:
+            l.removeHandler(problems)
+
+    if snapshot_file is not None and item_conf is not None:
+        if problems.count == 0:
+            save_snapshot(snapshot_file, sources, item_conf)
+        else:
+            remove_snapshot(snapshot_file)
+    return item_conf
+
+
+def load_snapshot(snapshot_file, sources):
+    '''
+    Load a configuration tree from a snapshot file, if it has been created from the given sources
+
+    :param snapshot_file: Name of the snapshot file
+    :param sources: Description of the configuration files (see parse_itemsdirs)
+
+    :return: The configuration tree or None, if the snapshot does not exist or is outdated
+    :rtype: OrderedDict
+
+    '''
+    try:
+        with open(snapshot_file, 'rb') as f:
+            snapshot = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.warning("config.load_snapshot: Ignoring damaged snapshot {}: {}".format(snapshot_file, e))
+        return None
+    if not isinstance(snapshot, dict) or snapshot.get('version') != _snapshot_version() or snapshot.get('sources') != sources:
+        return None
+    return snapshot.get('config')
+
+
+def save_snapshot(snapshot_file, sources, config):
+    '''
+    Save a configuration tree together with the description of its configuration files
+
+    :param snapshot_file: Name of the snapshot file
+    :param sources: Description of the configuration files (see parse_itemsdirs)
+    :param config: Configuration tree
+
+    '''
+    try:
+        os.makedirs(os.path.dirname(snapshot_file), exist_ok=True)
+        with open(snapshot_file + '.tmp', 'wb') as f:
+            pickle.dump({'version': _snapshot_version(), 'sources': sources, 'config': config}, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(snapshot_file + '.tmp', snapshot_file)
+    except Exception as e:
+        logger.warning("config.save_snapshot: Could not save snapshot {}: {}".format(snapshot_file, e))
+
+
+def remove_snapshot(snapshot_file):
+    '''
+    Remove a snapshot file (if it exists)
+    '''
+    try:
+        os.remove(snapshot_file)
+    except OSError:
+        pass
+
+
+def _snapshot_version():
+    # a changed parser invalidates the snapshot as well
+    return (SNAPSHOT_VERSION, sys.version_info[:2], os.path.getmtime(__file__), os.path.getmtime(shyaml.__file__))
+
+
+def _snapshot_sources(itemsdirs):
+    sources = []
+    for itemsdir, addfilenames in itemsdirs:
+        files = []
+        for item_file in _itemsdir_files(itemsdir):
+            try:
+                st = os.stat(os.path.join(itemsdir, item_file))
+                files.append((item_file, st.st_mtime_ns, st.st_size))
+            except OSError:
+                pass
+        sources.append((itemsdir, addfilenames, files))
+    return sources
+
+
+def _itemsdir_files(itemsdir):
+    return [item_file for item_file in sorted(os.listdir(itemsdir)) if item_file.endswith(CONF_FILE) or item_file.endswith(YAML_FILE)]
+
+
+class _RecordCollector(logging.Handler):
+    """
+    Collects the log records of a worker process of _parse_files (in a picklable form)
+    """
+
+    def __init__(self):
+        super().__init__(logging.DEBUG)
+        self.records = []
+
+    def emit(self, record):
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.msg = record.getMessage()
+        record.args = None
+        record.exc_info = None
+        self.records.append(record)
+
+
+class _ProblemCounter(logging.Handler):
+    """
+    Counts the warnings and errors logged while parsing configuration files
+    """
+
+    def __init__(self):
+        super().__init__(logging.WARNING)
+        self.count = 0
+
+    def emit(self, record):
+        self.count += 1
+
+
 def parse(filename, config=None, addfilenames=False):
     '''
     Load and parse a configuration file and merge it to the configuration tree
@@ -249,6 +513,66 @@ def merge(source, destination):
     return destination
     
     
+def sanitize_and_merge(source, destination, filename=None, key_prefix=''):
+    '''
+    Checks an OrderedDict tree loaded from a yaml file and merges it into another one in a single pass
+
+    The result and the logged warnings are the same as calling remove_comments(), remove_digits(),
+    remove_reserved(), remove_keyword(), remove_invalid(), _add_filenames_to_config() (if a filename
+    is given) and merge() one after another:
+
+    - attributes starting with 'comment' are removed
+    - items and attributes starting with a digit are removed
+    - items named set or get or like a Python keyword are removed
+    - items and attributes with invalid characters are removed
+    - scalar values are converted to strings without newlines, lists are taken as they are
+
+    :param source: source tree to check and merge into another one
+    :param destination: destination tree to merge into
+    :param filename: name of the config file to add to every item (as attribute '_filename')
+    :param key_prefix: path of the subtree (used for recursion)
+    :type source: OrderedDict
+    :type destination: OrderedDict
+    :type filename: str
+
+    :return: Merged configuration tree
+    :rtype: OrderedDict
+
+    '''
+    if not isinstance(source, dict) or not isinstance(destination, dict):
+        logger.error("Problem merging subtrees, probably invalid YAML file")
+        return destination
+
+    for key, value in source.items():
+        key_str = str(key)
+        if isinstance(value, dict):
+            if key_str[:1] in _digits:
+                logger.warning("Problem parsing '{}': item starts with digits".format(key_prefix+key_str))
+            elif key_str in _reserved:
+                logger.warning("Problem parsing '{}': item using reserved word set/get".format(key_prefix+key_str))
+            elif keyword.iskeyword(key_str):
+                logger.warning("Problem parsing '{}': item using reserved Python keyword".format(key_prefix+key_str))
+            elif not _valid_key_chars.issuperset(key_str):
+                logger.warning("Problem parsing '{}' invalid character. Valid characters are: {}".format(key_prefix+key_str, valid_item_chars + valid_attr_chars))
+            else:
+                node = destination.setdefault(key, collections.OrderedDict())
+                sanitize_and_merge(value, node, filename, key_prefix+key_str+'.')
+                if filename and isinstance(node, dict):
+                    node['_filename'] = filename
+        elif key_str.startswith('comment'):
+            continue
+        elif key_str[:1] in _digits:
+            logger.warning("Problem parsing '{}': item starts with digits".format(key_prefix+key_str))
+        elif not _valid_key_chars.issuperset(key_str):
+            logger.warning("Problem parsing '{}' invalid character. Valid characters are: {}".format(key_prefix+key_str, valid_item_chars + valid_attr_chars))
+        elif type(value) is list:
+            destination[key] = value
+        else:
+            # convert to string and remove newlines from multiline attributes
+            destination[key] = str(value).replace('\n','')
+    return destination
+
+
 def parse_yaml(filename, config=None, addfilenames=False):
     """
     Load and parse a yaml configuration file and merge it to the configuration tree
@@ -294,19 +618,16 @@ def parse_yaml(filename, config=None, addfilenames=False):
     if config is None:
         config = collections.OrderedDict()
 
+    start = time.perf_counter()
     items = shyaml.yaml_load(filename, ordered=True)
+    loaded = time.perf_counter()
     if items is not None:
-        remove_comments(items)
-        remove_digits(items)
-        remove_reserved(items)
-        remove_keyword(items)
-        remove_invalid(items)
-
         if addfilenames:
             logger.debug("parse_yaml: Add filename = {} to items".format(os.path.basename(filename)))
-            _add_filenames_to_config(items, os.path.basename(filename))
-
-        config = merge(items, config)
+        config = sanitize_and_merge(items, config, os.path.basename(filename) if addfilenames else None)
+        end = time.perf_counter()
+        logger.debug("parse_yaml: Parsed file {} in {:.1f} ms (loading {:.1f} ms, checking and merging {:.1f} ms)".format(
+                     os.path.basename(filename), (end - start) * 1000, (loaded - start) * 1000, (end - loaded) * 1000))
     return config
     
 
@@ -78,6 +78,7 @@ class Connections(Base):
 
     _connections = {}
     _servers = {}
+    _write_interest = {}
     if hasattr(select, 'epoll'):
         _ro = select.EPOLLIN | select.EPOLLHUP | select.EPOLLERR
         _rw = _ro | select.EPOLLOUT
@@ -85,6 +86,7 @@ class Connections(Base):
     def __init__(self):
         Base.__init__(self)
         Base._poller = self
+        self._write_interest_lock = threading.Lock()
         if hasattr(select, 'epoll'):
             self._epoll = select.epoll()
         elif hasattr(select, 'kqueue'):
@@ -111,6 +113,8 @@ class Connections(Base):
             logger.error("tried to register a connection with filenumber == -1")
             return
         self._connections[fileno] = obj
+        with self._write_interest_lock:
+            self._write_interest[fileno] = False
         if hasattr(select, 'epoll'):
             self._epoll.register(fileno, self._ro)
         elif hasattr(select, 'kqueue'):
@@ -141,6 +145,9 @@ class Connections(Base):
         except:
             pass
 
+        with self._write_interest_lock:
+            self._write_interest.pop(fileno, None)
+
     def monitor(self, obj):
         self._monitor.append(obj)
 
@@ -149,23 +156,74 @@ class Connections(Base):
             if not obj.connected:
                 obj.connect()
 
+    def set_write_interest(self, fileno, interest):
+        """
+        Enable or disable polling a connection for writability
+
+        The registration of the connection is only modified, if the interest changes,
+        i.e. if the outbuffer of the connection changes between empty and non-empty.
+        The check and the modification are done under a lock, as the sending threads
+        and the polling thread call this concurrently.
+
+        :param fileno: filenumber of the connection
+        :param interest: True, if the connection has data to send
+        :type fileno: int
+        :type interest: bool
+        """
+        with self._write_interest_lock:
+            if fileno not in self._write_interest or self._write_interest[fileno] == interest:
+                return
+            self._write_interest[fileno] = interest
+            if hasattr(select, 'epoll'):
+                try:
+                    self._epoll.modify(fileno, self._rw if interest else self._ro)
+                except OSError as e:
+                    # as with python 3.6 an OSError will be raised when a socket is already closed like with a settimeout
+                    # the socket will need to be recreated then
+                    logger.error("OSError {} for epoll.modify({}) with fileno {} for object {}, please report to SmartHomeNG team".format(e, 'RW' if interest else 'RO', fileno, self._connections.get(fileno)))
+            elif hasattr(select, 'kqueue'):
+                if interest:
+                    event = [
+                        select.kevent(fileno,
+                               filter=select.KQ_FILTER_WRITE,
+                               flags=select.KQ_EV_ADD | select.KQ_EV_ONESHOT)
+                    ]
+                    self._kqueue.control(event, 0, 0)
+
     def trigger(self, fileno):
         if fileno == -1:
             logger.error("tried to trigger a connection with filenumber == -1")
             return
         if self._connections[fileno].outbuffer:
-            if hasattr(select, 'epoll'):
-                self._epoll.modify(fileno, self._rw)
-            elif hasattr(select, 'kqueue'):
-                event = [
-                    select.kevent(fileno,
-                           filter=select.KQ_FILTER_WRITE,
-                           flags=select.KQ_EV_ADD | KQ_EV_ONESHOT)
-                ]
-                self._kqueue.control(event, 0, 0)
+            self.set_write_interest(fileno, True)
+
+    def _handle_event(self, fileno, readable, writable, hangup):
+        if fileno in self._servers:
+            server = self._servers[fileno]
+            server.handle_connection()
+            return
+        con = self._connections.get(fileno)
+        if con is None:
+            return
+        if readable:
+            try:
+                con._in()
+            except Exception as e:
+                con.close()
+                return
+        if writable and con.connected:
+            try:
+                con._out()
+            except Exception as e:
+                con.close()
+                return
+        if hangup and con.connected:
+            try:
+                con.close()
+            except:
+                pass
 
     def poll(self):
-        time.sleep(0.0000000001)  # give epoll.modify a chance
         if not self._connections:
             time.sleep(1)
             return
@@ -174,105 +232,19 @@ class Connections(Base):
             logger.error("fileno -1 was found, please report to SmartHomeNG team")
             del( self._connections[-1])
 
-        for fileno in self._connections:
-            if fileno not in self._servers:
-                if hasattr(select, 'epoll'):
-                    if self._connections[fileno].outbuffer:
-                        try:
-                            self._epoll.modify(fileno, self._rw)
-                        except OSError as e:
-                            # as with python 3.6 an OSError will be raised when a socket is already closed like with a settimeout
-                            # the socket will need to be recreated then
-                            logger.error("OSError {} for epoll.modify(RW) with fileno {} for object {}, please report to SmartHomeNG team".format(e, fileno, self._connections[fileno]))
-                            # here we could try to get rid of the connection that causes the headache
-                        except PermissionError as e:
-                            logger.error("PermissionError {} for epoll.modify(RW) with fileno {} for object {}, please report to SmartHomeNG team".format(e, fileno, self._connections[fileno]))
-                            # here we could try to get rid of the connection that causes the headache
-                        except FileNotFoundError as e:
-                            logger.error("FileNotFoundError {} for epoll.modify(RW) with fileno {} for object {}, please report to SmartHomeNG team".format(e, fileno, self._connections[fileno]))
-                            # here we could try to get rid of the connection that causes the headache
-                    else:
-                        try:
-                            self._epoll.modify(fileno, self._ro)
-                        except OSError as e:
-                            # as with python 3.6 an OSError will be raised when a socket is already closed like with a settimeout
-                            # the socket will need to be recreated then
-                            logger.error("OSError {} for epoll.modify(RO) with fileno {} for object {}, please report to SmartHomeNG team".format(e, fileno, self._connections[fileno]))
-                            # here we could try to get rid of the connection that causes the headache
-                        except PermissionError as e:
-                            logger.error("PermissionError {} for epoll.modify(RO) with fileno {} for object {}, please report to SmartHomeNG team".format(e, fileno, self._connections[fileno]))
-                            # here we could try to get rid of the connection that causes the headache
-                        except FileNotFoundError as e:
-                            logger.error("FileNotFoundError {} for epoll.modify(RO) with fileno {} for object {}, please report to SmartHomeNG team".format(e, fileno, self._connections[fileno]))
-                            # here we could try to get rid of the connection that causes the headache
-
-                elif hasattr(select, 'kqueue'):
-                    event = []
-                    if self._connections[fileno].outbuffer:
-                        event.append(select.kevent(fileno,
-                                            filter=select.KQ_FILTER_WRITE,
-                                            flags=select.KQ_EV_ADD | KQ_EV_ONESHOT))
-                    else:
-                        event.append(select.kevent(fileno,
-                                            filter=select.KQ_FILTER_READ,
-                                            flags=select.KQ_EV_ADD))
-                    self._kqueue.control(event, 0, 0)
-
         if hasattr(select, 'epoll'):
             for fileno, event in self._epoll.poll(timeout=1):
-                if fileno in self._servers:
-                    server = self._servers[fileno]
-                    server.handle_connection()
-                else:
-                    if event & select.EPOLLIN:
-                        try:
-                            con = self._connections[fileno]
-                            con._in()
-                        except Exception as e:
-                            con.close()
-                            continue
-                        if event & select.EPOLLOUT:
-                            try:
-                                con = self._connections[fileno]
-                                con._out()
-                            except Exception as e:
-                                con.close()
-                                continue
-                        if event & (select.EPOLLHUP | select.EPOLLERR):
-                            try:
-                                con = self._connections[fileno]
-                                con.close()
-                                continue
-                            except:
-                                pass
+                self._handle_event(fileno, event & select.EPOLLIN, event & select.EPOLLOUT, event & (select.EPOLLHUP | select.EPOLLERR))
         elif hasattr(select, 'kqueue'):
-            for event in self._kqueue.control(None, 1):
+            for event in self._kqueue.control(None, 64, 1):
                 fileno = event.ident
-                if fileno in self._servers:
-                    server = self._servers[fileno]
-                    server.handle_connection()
-                else:
-                    if event.filter == select.KQ_FILTER_READ:
-                        try:
-                            con = self._connections[fileno]
-                            con._in()
-                        except Exception as e:  # noqa
-                            con.close()
-                            continue
-                        if event.filter == select.KQ_FILTER_WRITE:
-                            try:
-                                con = self._connections[fileno]
-                                con._out()
-                            except Exception as e:  # noqa
-                                con.close()
-                                continue
-                        if event.flags & select.KQ_EV_EOF:
-                            try:
-                                con = self._connections[fileno]
-                                con.close()
-                                continue
-                            except:
-                                pass
+                writable = event.filter == select.KQ_FILTER_WRITE
+                if writable:
+                    # write filters are registered as oneshot events
+                    with self._write_interest_lock:
+                        if fileno in self._write_interest:
+                            self._write_interest[fileno] = False
+                self._handle_event(fileno, event.filter == select.KQ_FILTER_READ, writable, event.flags & select.KQ_EV_EOF)
         else:
             logger.exception("WARNING: no epoll/kqueue implementation available")
             sys.exit(0)
@@ -357,10 +329,23 @@ class Stream(Base):
         self.connected = False
         self.address = address
         self.inbuffer = bytearray()
+        self._recv_buffer = bytearray()
+        self._scan_terminator = None    # terminator and position of an incomplete search in inbuffer
+        self._scan_pos = 0
+        self._balance_pos = 0           # position and depth of an incomplete balance scan in inbuffer
+        self._balance_depth = 0
         self.outbuffer = collections.deque()
+        self.outbuffer_size = 0         # bytes currently queued in outbuffer
+        self.queued_bytes = 0           # total bytes queued for sending
+        self.sent_bytes = 0             # total bytes sent
+        self.write_paused = False       # True while outbuffer_size is above the high watermark
+        self._high_watermark = None
+        self._low_watermark = 0
         self.__olock = threading.Lock()
+        self.__qlock = threading.Lock()
         self._frame_size_in = 4096
         self._frame_size_out = 4096
+        self._iov_max = 64              # maximum number of frames sent with one sendmsg() call
         self.terminator = b'\r\n'
         self._balance_open = False
         self._balance_close = False
@@ -376,78 +361,159 @@ class Stream(Base):
 
     def _in(self):
         max_size = self._frame_size_in
+        if len(self._recv_buffer) != max_size:
+            self._recv_buffer = bytearray(max_size)
         try:
-            data = self.socket.recv(max_size)
+            size = self.socket.recv_into(self._recv_buffer, max_size)
         except Exception as e:  # noqa
             self.close()
             return
-        if data == b'':
+        if size == 0:
             self.close()
             return
-        self.inbuffer.extend(data)
+        with memoryview(self._recv_buffer) as view:
+            self.inbuffer += view[:size]
+        # frames are consumed by moving a read offset, the buffer is compacted once per read
+        inbuffer = self.inbuffer
+        offset = 0
         while True:
             terminator = self.terminator
             buffer_len = len(self.inbuffer)
             if not terminator:
                 if not self._balance_open:
                     break
-                index = self._is_balanced()
+                index = self._is_balanced(offset)
+                if index is None:
+                    # unbalanced input, connection has been closed
+                    return
                 if index:
-                    data = self.inbuffer[:index]
-                    self.inbuffer = self.inbuffer[index:]
+                    data = self.inbuffer[offset:index]
+                    offset = index
                     self.found_balance(data)
                 else:
                     break
             elif isinstance(terminator, int):
-                if buffer_len < terminator:
+                if buffer_len - offset < terminator:
                     break
                 else:
-                    data = self.inbuffer[:terminator]
-                    self.inbuffer = self.inbuffer[terminator:]
+                    data = self.inbuffer[offset:offset + terminator]
+                    offset += terminator
                     self.terminator = 0
                     self.found_terminator(data)
             else:
-                if terminator not in self.inbuffer:
+                start = offset
+                if self._scan_terminator == terminator:
+                    start = max(offset, self._scan_pos)
+                index = self.inbuffer.find(terminator, start)
+                if index == -1:
+                    # resume the search here when more data arrives
+                    self._scan_terminator = terminator
+                    self._scan_pos = max(offset, buffer_len - len(terminator) + 1)
                     break
-                index = self.inbuffer.find(terminator)
-                data = self.inbuffer[:index]
-                cut = index + len(terminator)
-                self.inbuffer = self.inbuffer[cut:]
+                data = self.inbuffer[offset:index]
+                offset = index + len(terminator)
                 self.found_terminator(data)
-
-    def _is_balanced(self):
-        stack = []
-        for index, char in enumerate(self.inbuffer):
-            if char == self._balance_open:
-                stack.append(char)
-            elif char == self._balance_close:
-                stack.append(char)
-                if stack.count(self._balance_open) < stack.count(self._balance_close):
+            if not self.connected or self.inbuffer is not inbuffer:
+                # connection closed or buffers discarded by a handler
+                return
+        if offset:
+            del self.inbuffer[:offset]
+            self._scan_pos = max(0, self._scan_pos - offset)
+            self._balance_pos = max(0, self._balance_pos - offset)
+
+    def _is_balanced(self, offset=0):
+        """
+        Scan the inbuffer for a balanced frame starting at offset
+
+        The scan resumes where the previous (incomplete) scan stopped.
+
+        :return: index behind the end of the frame, False if the frame is incomplete or None if the input is unbalanced
+        """
+        if self._balance_pos <= offset:
+            self._balance_pos = offset
+            self._balance_depth = 0
+        buffer = self.inbuffer
+        index = self._balance_pos
+        depth = self._balance_depth
+        while True:
+            next_open = buffer.find(self._balance_open, index)
+            next_close = buffer.find(self._balance_close, index)
+            if next_close == -1 or (next_open != -1 and next_open < next_close):
+                if next_open == -1:
+                    break
+                depth += 1
+                index = next_open + 1
+            else:
+                depth -= 1
+                index = next_close + 1
+                if depth < 0:
                     logger.warning("{}: unbalanced input!".format(self._name))
-                    logger.close()
-                    return False
-                if stack.count(self._balance_open) == stack.count(self._balance_close):
-                    return index + 1
+                    self.close()
+                    return None
+                if depth == 0:
+                    self._balance_pos = index
+                    self._balance_depth = 0
+                    return index
+        self._balance_pos = len(buffer)
+        self._balance_depth = depth
         return False
 
     def _out(self):
         if not self.__olock.acquire(timeout=1):
+            # another thread is still sending, poll for writability so the outbuffer is not stalled
+            if self.connected and self.outbuffer:
+                self._poller.set_write_interest(self.socket.fileno(), True)
             return
         try:
-            while self.connected:
-                frame = self.outbuffer.pop()
-                if not frame:
+            paused = self._send_outbuffer()
+        finally:
+            self.__olock.release()
+        # handle_watermark() may send, so it is called after the lock has been released
+        self._notify_watermark(paused)
+
+    def _send_outbuffer(self):
+        """
+        Send the outbuffer until it is empty or the socket buffer is full (called with the lock held)
+
+        :return: watermark transition (see _account_out)
+        """
+        paused = None
+        try:
+            while self.connected and self.outbuffer:
+                # gather the oldest frames (right end of the deque) up to the next close marker
+                buffers = []
+                for index in range(1, min(len(self.outbuffer), self._iov_max) + 1):
+                    frame = self.outbuffer[-index]
                     if frame is None:
-                        self.close()
-                        return
-                    continue  # ignore empty frames
-                sent = self.socket.send(frame)
-                if sent < len(frame):
-                    self.outbuffer.append(frame[sent:])
-        except IndexError:  # buffer empty
-            return
-        except socket.error:
-            self.outbuffer.append(frame)
+                        break
+                    buffers.append(frame)
+                if not buffers:
+                    self.outbuffer.pop()
+                    self.close()
+                    return paused
+                try:
+                    sent = self._send_buffers(buffers)
+                except (BlockingIOError, InterruptedError):
+                    break
+                except socket.error:
+                    break
+                remaining = sent
+                complete = True
+                for frame in buffers:
+                    size = len(frame)
+                    if remaining >= size:
+                        self.outbuffer.pop()
+                        remaining -= size
+                    else:
+                        # keep the unsent part of the frame without copying it
+                        self.outbuffer[-1] = memoryview(frame)[remaining:]
+                        complete = False
+                        break
+                transition = self._account_out(-sent)
+                if transition is not None:
+                    paused = transition
+                if not complete:
+                    break   # socket buffer is full, wait for EPOLLOUT
         except Exception as e:  # noqa
             logger.exception("{}: {}".format(self._name, e))
             self.close()
@@ -455,7 +521,75 @@ class Stream(Base):
             if self._close_after_send:
                 logger.debug("close after send")
                 self.close()
-            self.__olock.release()
+            elif self.connected:
+                # poll for writability only while there is data left to send
+                self._poller.set_write_interest(self.socket.fileno(), bool(self.outbuffer))
+        return paused
+
+    def _send_buffers(self, buffers):
+        """
+        Send a list of buffers with one system call (scatter-gather) if the socket supports it
+
+        :return: number of bytes sent
+        """
+        if len(buffers) > 1 and hasattr(self.socket, 'sendmsg'):
+            try:
+                return self.socket.sendmsg(buffers)
+            except NotImplementedError:
+                # e.g. ssl sockets
+                pass
+        return self.socket.send(buffers[0])
+
+    def _account_out(self, size):
+        """
+        Update the outbuffer counters and check the watermarks
+
+        The transition is only recorded here, the caller has to pass it to _notify_watermark()
+        when it does not hold the send lock any more.
+
+        :param size: number of bytes queued (positive) or sent (negative)
+        :return: True if the high watermark has been reached, False if the outbuffer has drained to the low watermark, else None
+        """
+        with self.__qlock:
+            self.outbuffer_size += size
+            if size > 0:
+                self.queued_bytes += size
+            else:
+                self.sent_bytes -= size
+            paused = None
+            if self._high_watermark is not None:
+                if not self.write_paused and self.outbuffer_size >= self._high_watermark:
+                    self.write_paused = paused = True
+                elif self.write_paused and self.outbuffer_size <= self._low_watermark:
+                    self.write_paused = paused = False
+        return paused
+
+    def _notify_watermark(self, paused):
+        if paused is None:
+            return
+        try:
+            self.handle_watermark(paused)
+        except Exception as e:
+            logger.exception("{}: handle_watermark: {}".format(self._name, e))
+
+    def set_watermarks(self, high, low=None):
+        """
+        Set the high and low watermark for the outbuffer
+
+        When the number of queued bytes reaches the high watermark, handle_watermark(True)
+        is called and producers should pause sending. When the outbuffer has drained to the
+        low watermark, handle_watermark(False) is called.
+
+        :param high: high watermark in bytes (None disables the watermarks)
+        :param low: low watermark in bytes (defaults to a quarter of the high watermark)
+        :type high: int
+        :type low: int
+        """
+        self._high_watermark = high
+        if high is None:
+            self._low_watermark = 0
+        else:
+            self._low_watermark = high // 4 if low is None else low
 
     def balance(self, bopen, bclose):
         self._balance_open = ord(bopen)
@@ -488,7 +622,15 @@ class Stream(Base):
 
     def discard_buffers(self):
         self.inbuffer = bytearray()
+        self._scan_terminator = None
+        self._scan_pos = 0
+        self._balance_pos = 0
+        self._balance_depth = 0
         self.outbuffer.clear()
+        with self.__qlock:
+            self.outbuffer_size = 0
+        if self.write_paused:
+            self._notify_watermark(self._account_out(0))
 
     def found_terminator(self, data):
         pass
@@ -502,16 +644,30 @@ class Stream(Base):
     def handle_connect(self):
         pass
 
+    def handle_watermark(self, paused):
+        pass
+
     def send(self, data, close=False):
         self._close_after_send = close
         if not self.connected:
             return False
+        if not isinstance(data, bytes):
+            # copy mutable buffers, the caller may change them before they are sent
+            try:
+                data = bytes(memoryview(data))
+            except TypeError as e:
+                # e.g. str, handled like a failing send
+                logger.exception("{}: {}".format(self._name, e))
+                self.close()
+                return True
         frame_size = self._frame_size_out
         if len(data) > frame_size:
+            view = memoryview(data)
             for i in range(0, len(data), frame_size):
-                self.outbuffer.appendleft(data[i:i + frame_size])
+                self.outbuffer.appendleft(view[i:i + frame_size])
         else:
             self.outbuffer.appendleft(data)
+        self._notify_watermark(self._account_out(len(data)))
         self._out()
         return True
 
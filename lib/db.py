@@ -26,6 +26,11 @@ import datetime
 import time
 import threading
 import collections
+import contextlib
+import functools
+import itertools
+import json
+import os
 import re
 
 logger = logging.getLogger('')
@@ -45,10 +50,18 @@ class Database():
     'execute()' - execute statement (no result returned)
     'fetchone()' - execute statement and return first row from result
     'fetchall()' - execute statement and reeturn all rows from result
+    'executemany()' - execute statement for each parameter set of a list
+    'fetchiter()' - execute statement and iterate over the rows of the result
+    'stream()' - execute statement and iterate over chunks of rows of the result
+    'transaction()' - execute statements in one transaction (context manager)
     'cursor()' - create a cursor object to execute multiple statements
     'lock()' - acquire the database lock (prevent simultaneous reads/writes)
     'release()' - release the database lock
     'verify()' - check database connection and reconnect if required
+    'connection()' - check out a connection from the pool (context manager)
+    'start_writer()' - start the queued writer mode (see 'QueuedWriter')
+    'enqueue()' - queue a statement for the writer thread
+    'stop_writer()' - write the queued statements and stop the writer thread
 
     The SQL statements executed may have placeholders and parameters which
     are passed to the execution methods listed above. The following DB-API
@@ -65,6 +78,18 @@ class Database():
 
     In case the driver implementation uses a different formatting it
     will be converted transparently!
+
+    Besides the main connection (used by the methods above together with
+    'lock()' and 'release()') the database object can manage a pool of
+    further connections, which allows concurrent queries from several
+    threads. Connections are checked out with the 'connection()' context
+    manager::
+
+       with db.connection() as conn:
+           cur = conn.cursor()
+           db.execute("SELECT ...", params, cur=cur)
+           rows = cur.fetchall()
+           cur.close()
     """
 
     # Supported formatting styles
@@ -123,7 +148,7 @@ class Database():
       'pyformat' : dict
     }
 
-    def __init__(self, name, dbapi, connect, formatting='named'):
+    def __init__(self, name, dbapi, connect, formatting='named', min_connections=1, max_connections=1, verify_interval=60, statement_cache_size=256):
         """Create a new database instance
 
         The 'name' parameter identifies the name for the database access.
@@ -141,6 +166,18 @@ class Database():
 
         The 'formatting' parameter can be used to specify a different type
         of formatting (see DB-API spec) which defaults to 'pyformat'.
+
+        The 'min_connections' and 'max_connections' parameters specify the
+        number of connections (including the main connection) to open on
+        connect and the maximum number of connections open at the same time.
+        Pooled connections idle for more than 'verify_interval' seconds are
+        checked before they are handed out. With more than one connection
+        sqlite databases are switched to WAL mode, which allows concurrent
+        readers alongside one writer.
+
+        The translations of the last 'statement_cache_size' statements to
+        the formatting style of the driver are cached (see
+        'statement_cache_info()').
         """
         self._name = name
         self._dbapi = dbapi
@@ -174,7 +211,7 @@ class Database():
                self._params[key] = v
 
         elif type(connect) is dict:
-            self._params = connect
+            self._params = dict(connect)
 
         self._format_output = self._dbapi.paramstyle
         if self._format_output not in self._styles:
@@ -183,13 +220,37 @@ class Database():
         self._translation = self._translations[self._format_input][self._format_output]
         self._translation_param_type = self._translation_param_types[self._format_output]
 
+        # translated statements, keyed by statement and input formatting style
+        self._translate_statement = functools.lru_cache(maxsize=statement_cache_size)(self._translate_statement)
+
         self._fdb_lock = threading.Lock()
 
+        self._min_connections = max(1, min_connections)
+        self._max_connections = max(self._min_connections, max_connections)
+        self._verify_interval = verify_interval
+        self._pool = collections.deque()
+        self._pool_size = 0
+        self._pool_cond = threading.Condition()
+
+        if self._is_sqlite() and self._max_connections > 1:
+            if self._params.get('database', ':memory:') == ':memory:':
+                logger.warning("Database [{}]: In-memory sqlite databases can not be shared between connections, using one connection".format(self._name))
+                self._min_connections = self._max_connections = 1
+            else:
+                # pooled connections are used by different threads
+                self._params.setdefault('check_same_thread', False)
+
+        self._writer = None
+
     def connect(self):
         """Connects to the database"""
         self.lock()
         try:
-            self._conn = self._dbapi.connect(**self._params)
+            self._conn = self._open_connection()
+            with self._pool_cond:
+                while self._pool_size < self._min_connections - 1:
+                    self._pool.append((self._open_connection(), time.time()))
+                    self._pool_size += 1
         except Exception as e:
             logger.error("Database [{}]: Could not connect to the database: {}".format(self._name, e))
             raise
@@ -200,6 +261,7 @@ class Database():
 
     def close(self):
         """Closes the database connection"""
+        self.stop_writer()
         self.lock()
         try:
             self._conn.close()
@@ -209,6 +271,120 @@ class Database():
             self.release()
         self._conn = None
         self._connected = False
+        with self._pool_cond:
+            while self._pool:
+                self._close_connection(self._pool.pop()[0])
+                self._pool_size -= 1
+            self._pool_cond.notify_all()
+
+    @contextlib.contextmanager
+    def connection(self, timeout=None):
+        """Check out a connection for exclusive use (context manager)
+
+        With a pool of more than one connection a pooled connection is
+        handed out, otherwise the main connection is locked for the duration
+        of the block. The connection is rolled back if the block raises an
+        exception. Use 'commit()' of the connection to commit changes.
+
+        If no connection is available within 'timeout' seconds an exception
+        is raised (default is to wait forever).
+        """
+        if self._max_connections == 1:
+            if not self.lock(-1 if timeout is None else timeout):
+                raise Exception("Database [{}]: No connection available within {} seconds".format(self._name, timeout))
+            try:
+                yield self._conn
+            except Exception:
+                try:
+                    self._conn.rollback()
+                except Exception:
+                    pass
+                raise
+            finally:
+                self.release()
+            return
+
+        conn = self._checkout(timeout)
+        try:
+            yield conn
+        except Exception:
+            try:
+                conn.rollback()
+            except Exception:
+                pass
+            raise
+        finally:
+            self._checkin(conn)
+
+    def _checkout(self, timeout):
+        """Internal helper method to take a connection from the pool"""
+        deadline = None if timeout is None else time.time() + timeout
+        with self._pool_cond:
+            while True:
+                if self._pool:
+                    conn, last_used = self._pool.pop()
+                    break
+                if self._pool_size < self._max_connections - 1:
+                    self._pool_size += 1
+                    conn, last_used = None, None
+                    break
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    raise Exception("Database [{}]: No connection available within {} seconds".format(self._name, timeout))
+                self._pool_cond.wait(remaining)
+
+        try:
+            if conn is not None and time.time() - last_used > self._verify_interval:
+                try:
+                    self._ping(conn)
+                except Exception as e:
+                    logger.warning("Database [{}]: Pooled connection broken, reconnecting: {}".format(self._name, e))
+                    self._close_connection(conn)
+                    conn = None
+            if conn is None:
+                conn = self._open_connection()
+        except Exception:
+            with self._pool_cond:
+                self._pool_size -= 1
+                self._pool_cond.notify()
+            raise
+        return conn
+
+    def _checkin(self, conn):
+        """Internal helper method to return a connection to the pool"""
+        with self._pool_cond:
+            if self._connected:
+                self._pool.append((conn, time.time()))
+            else:
+                self._close_connection(conn)
+                self._pool_size -= 1
+            self._pool_cond.notify()
+
+    def _open_connection(self):
+        """Internal helper method to open a new connection"""
+        conn = self._dbapi.connect(**self._params)
+        if self._is_sqlite() and self._max_connections > 1:
+            conn.execute('PRAGMA journal_mode=WAL')
+        return conn
+
+    def _close_connection(self, conn):
+        """Internal helper method to close a connection ignoring errors"""
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _ping(self, conn):
+        """Internal helper method to check a connection (raises an exception if broken)"""
+        cur = conn.cursor()
+        try:
+            self.fetchone("SELECT 1", cur=cur)
+        finally:
+            cur.close()
+
+    def _is_sqlite(self):
+        """Internal helper method to check if the database is a sqlite database"""
+        return getattr(self._dbapi, '__name__', None) == 'sqlite3'
 
     def connected(self):
         """Return the connected status"""
@@ -319,6 +495,92 @@ class Database():
             if c is not None:
                 c.close()
 
+    def executemany(self, stmt, seq_params, formatting=None, cur=None):
+        """Execute the given statement for each parameter set
+
+        This will execute the statement once for each list or dict of
+        parameters in 'seq_params' using the 'executemany()' method of the
+        driver. The statement is translated only once.
+
+        It accepts the same further arguments as the 'execute()' method.
+        Use it within 'transaction()' to commit all rows at once.
+        """
+        try:
+            stmt, mapping = self._translate_statement(stmt, formatting)
+            args = [self._prepare_params(mapping, params) for params in seq_params]
+        except Exception as e:
+            logger.error("Can not prepare query: {}: {}".format(stmt, e))
+            raise
+
+        c = None
+        try:
+            if cur == None:
+                c = self.cursor()
+                result = c.executemany(stmt, args)
+                c.close()
+                c = None
+            else:
+                result = cur.executemany(stmt, args)
+            return result
+        except Exception as e:
+            logger.error("Can not execute query: {} ({} parameter sets): {}".format(stmt, len(args), e))
+            raise
+        finally:
+            if c is not None:
+                c.close()
+
+    @contextlib.contextmanager
+    def transaction(self, timeout=None):
+        """Execute statements in one transaction (context manager)
+
+        A connection is checked out (see 'connection()') and a cursor for it
+        is returned. The transaction is committed at the end of the block or
+        rolled back if the block raises an exception::
+
+           with db.transaction() as cur:
+               db.execute("DELETE FROM ...", cur=cur)
+               db.executemany("INSERT INTO ...", rows, cur=cur)
+
+        Without a pool the main connection is locked, so do not call it while
+        holding the database lock.
+        """
+        with self.connection(timeout) as conn:
+            cur = conn.cursor()
+            try:
+                yield cur
+                conn.commit()
+            finally:
+                cur.close()
+
+    def start_writer(self, max_queue=10000, overflow='block', spill_file=None, batch_size=500, max_delay=1):
+        """Start the queued writer mode
+
+        Statements passed to 'enqueue()' are written by a dedicated writer
+        thread in batches, so the calling thread does not wait for the
+        database. See 'QueuedWriter' for the parameters. Returns the writer,
+        which provides the metrics with 'statistics()'.
+        """
+        if self._writer is None:
+            self._writer = QueuedWriter(self, max_queue=max_queue, overflow=overflow, spill_file=spill_file, batch_size=batch_size, max_delay=max_delay)
+            self._writer.start()
+        return self._writer
+
+    def enqueue(self, stmt, params=(), formatting=None, timeout=None):
+        """Queue a statement for the writer thread (see 'start_writer()')
+
+        Returns False if the statement has been discarded because the queue
+        is full.
+        """
+        if self._writer is None:
+            raise Exception("Database [{}]: Queued writer is not started".format(self._name))
+        return self._writer.put(stmt, params, formatting=formatting, timeout=timeout)
+
+    def stop_writer(self, timeout=None):
+        """Write the queued statements and stop the writer thread"""
+        if self._writer is not None:
+            self._writer.stop(timeout)
+            self._writer = None
+
     def verify(self, retry=5, delay=5):
         """Verifies the connection status and reconnets if required
 
@@ -332,6 +594,9 @@ class Database():
 
         To specify the delay between retries use the `delay` parameter,
         which defaults to 5 seconds.
+
+        Idle connections of the pool are checked as well, broken ones are
+        closed (and reopened on demand).
         """
         while retry > 0:
             locked = False
@@ -343,9 +608,10 @@ class Database():
                 locked = self.lock(2)
 
                 if locked:
-                    self.fetchone("SELECT 1")
+                    self._ping(self._conn)
                     retry = -1
                     self.release()
+                    self._verify_pool()
 
             except Exception as e:
                 logger.warning("Database [{}]: Connection error {}".format(self._name, e))
@@ -359,6 +625,75 @@ class Database():
 
         return retry
 
+    def fetchiter(self, stmt, params=(), formatting=None, cur=None, chunk_size=500):
+        """Execute given statement and iterate over the rows of the result
+
+        The rows are fetched in chunks of 'chunk_size' rows, so large results
+        are processed in constant memory::
+
+           for row in db.fetchiter("SELECT ...", params):
+               ...
+
+        It accepts the same arguments as mentioned in the 'execute()' method.
+        See 'stream()' for details about the connection used.
+        """
+        for rows in self.stream(stmt, params, formatting=formatting, cur=cur, chunk_size=chunk_size):
+            for row in rows:
+                yield row
+
+    def stream(self, stmt, params=(), formatting=None, cur=None, chunk_size=500):
+        """Execute given statement and iterate over chunks of rows of the result
+
+        Each chunk is a list of up to 'chunk_size' rows fetched with the
+        'fetchmany()' method of the driver.
+
+        If no cursor is given, a connection is checked out (see
+        'connection()') until the iteration is finished or stopped early
+        (e.g. by 'break' or by closing the generator). Without a pool this
+        locks the main connection for that time, so do not call it while
+        holding the database lock.
+        """
+        if cur is not None:
+            self.execute(stmt, params, formatting=formatting, cur=cur)
+            yield from self._fetchchunks(cur, chunk_size)
+            return
+
+        with self.connection() as conn:
+            c = conn.cursor()
+            try:
+                self.execute(stmt, params, formatting=formatting, cur=c)
+                yield from self._fetchchunks(c, chunk_size)
+            finally:
+                c.close()
+
+    def _fetchchunks(self, cur, chunk_size):
+        """Internal helper method to fetch the result of a cursor in chunks"""
+        while True:
+            rows = cur.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield rows
+
+    def _verify_pool(self):
+        """Internal helper method to check the idle connections of the pool"""
+        with self._pool_cond:
+            idle = list(self._pool)
+            self._pool.clear()
+        for conn, last_used in idle:
+            try:
+                self._ping(conn)
+                checked = (conn, time.time())
+            except Exception as e:
+                logger.warning("Database [{}]: Pooled connection broken, closing it: {}".format(self._name, e))
+                self._close_connection(conn)
+                checked = None
+            with self._pool_cond:
+                if checked is not None:
+                    self._pool.append(checked)
+                else:
+                    self._pool_size -= 1
+                self._pool_cond.notify()
+
     def fetchone(self, stmt, params=(), formatting=None, cur=None):
         """Execute given statement and fetch one row from result
 
@@ -392,27 +727,55 @@ class Database():
             result = cur.fetchall()
         return result
 
+    def statement_cache_info(self):
+        """Return the hits, misses and size of the statement translation cache"""
+        info = self._translate_statement.cache_info()
+        return {'hits': info.hits, 'misses': info.misses, 'size': info.currsize, 'maxsize': info.maxsize}
+
     def _prepare(self, stmt, params, formatting=None):
         """Internal helper method to convert the statement and parameter list"""
 
+        stmt_result, mapping = self._translate_statement(stmt, formatting)
+        return (stmt_result, self._prepare_params(mapping, params))
+
+    def _prepare_params(self, mapping, params):
+        """Internal helper method to convert the parameter list of a translated statement"""
+
+        if mapping is None:
+            # statement has not been translated, only convert the parameters to the expected type
+            if self._translation_param_type is list:
+                return list(params.values()) if isinstance(params, dict) else list(params)
+            if isinstance(params, dict):
+                return params
+            return collections.OrderedDict((str(key+1), value) for key, value in enumerate(params))
+
         if isinstance(params, dict):
-            param_dict = params
+            values = [params[input_name] for output_name, input_name in mapping]
         else:
-            param_dict = collections.OrderedDict()
-            for key, value in enumerate(params):
-                param_dict[str(key+1)] = value
+            values = [params[int(input_name)-1] for output_name, input_name in mapping]
+
+        if self._translation_param_type is list:
+            return values
+        elif self._translation_param_type is dict:
+            return collections.OrderedDict(zip((output_name for output_name, input_name in mapping), values))
+
+    def _translate_statement(self, stmt, formatting):
+        """Internal helper method to translate a statement once (the result is cached)
 
+        Returns the translated statement and a list of (output name, input
+        name) pairs describing how to build the parameters, or None if the
+        statement does not need a translation.
+        """
         if formatting is None:
             translation = self._translation
         else:
             translation = self._translations[formatting][self._format_output]
 
-        stmt_result, param_result = self._translate(stmt, param_dict, **translation)
+        if translation.get('input_token') is None or translation.get('output_token') is None:
+            return (stmt, None)
 
-        if self._translation_param_type is list:
-            return (stmt_result, [param_result[name] for name in param_result])
-        elif self._translation_param_type is dict:
-            return (stmt_result, param_result)
+        stmt_result, param_result = self._translate(stmt, _ParamNames(), **translation)
+        return (stmt_result, tuple(param_result.items()))
 
     def _translate(self, stmt, params, input_token=None, output_token=None, input_name='{0}', output_name='{0}'):
         """Internal helper method to convert the statement from input format to output format"""
@@ -438,3 +801,367 @@ class Database():
 
         return (stmt,  param_result)
 
+
+class _ParamNames(dict):
+    """Parameter lookup returning the name of the parameter instead of its value"""
+
+    def __missing__(self, key):
+        return key
+
+
+class BatchWriter():
+    """Collects rows and writes them in one transaction
+
+    Rows added with 'add()' are written with 'executemany()' in one
+    transaction as soon as 'max_rows' rows are collected or the oldest row
+    is waiting for 'max_delay' seconds. Use 'flush()' to write the collected
+    rows immediately and 'close()' to write them when shutting down. As rows
+    may be written from a timer thread, the connections must be usable from
+    any thread (for sqlite add 'check_same_thread:0' to connect)::
+
+       writer = BatchWriter(db, "INSERT INTO log VALUES (:time, :item, :val)")
+       writer.add({'time': ..., 'item': ..., 'val': ...})
+    """
+
+    def __init__(self, db, stmt, formatting=None, max_rows=500, max_delay=5):
+        self._db = db
+        self._stmt = stmt
+        self._formatting = formatting
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.written_rows = 0
+        self.failed_rows = 0
+        self._rows = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._timer = None
+
+    def add(self, params):
+        """Add a row (list or dict of parameters of the statement)"""
+        with self._lock:
+            self._rows.append(params)
+            full = len(self._rows) >= self.max_rows
+            if not full and self._timer is None:
+                self._timer = threading.Timer(self.max_delay, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+        if full:
+            self.flush()
+
+    def pending(self):
+        """Return the number of rows not written yet"""
+        return len(self._rows)
+
+    def flush(self):
+        """Write the collected rows in one transaction"""
+        with self._flush_lock:
+            with self._lock:
+                rows = self._rows
+                self._rows = []
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+            if not rows:
+                return
+            try:
+                with self._db.transaction() as cur:
+                    self._db.executemany(self._stmt, rows, formatting=self._formatting, cur=cur)
+                self.written_rows += len(rows)
+            except Exception as e:
+                self.failed_rows += len(rows)
+                logger.error("Database [{}]: Could not write {} rows: {}".format(self._db._name, len(rows), e))
+
+    def close(self):
+        """Write the collected rows and stop the timer"""
+        self.flush()
+
+
+class QueuedWriter():
+    """Writes statements from a queue in a dedicated writer thread
+
+    Statements added with 'put()' are queued and written by the writer
+    thread in batches of up to 'batch_size' statements in one transaction
+    (consecutive statements with the same SQL are written with
+    'executemany()'). A batch is written as soon as it is full or the
+    oldest statement is waiting for 'max_delay' seconds. This way the
+    thread adding the statements (e.g. the thread updating an item) is not
+    stalled by a slow disk or a locked database.
+
+    The queue holds up to 'max_queue' statements. When it is full, the
+    'overflow' policy decides what happens to new statements:
+    - 'block': wait until there is space in the queue
+    - 'drop_oldest': discard the oldest queued statement
+    - 'spill': append the statements to 'spill_file' (as json lines) until
+      the queue has been written, then write the spilled statements in
+      the order they were added (parameters have to be json compatible)
+
+    A failed batch is retried 'retries' times after 'retry_delay' seconds,
+    after that its statements are written one by one and failing ones are
+    discarded. As the statements are written from the writer thread, the
+    connections must be usable from any thread (for sqlite add
+    'check_same_thread:0' to connect).
+
+    The writer is usually started with 'Database.start_writer()'::
+
+       writer = db.start_writer(overflow='drop_oldest')
+       db.enqueue("INSERT INTO log VALUES (:time, :item, :val)", {...})
+       writer.statistics()
+    """
+
+    # Supported overflow policies
+    _policies = ('block', 'drop_oldest', 'spill')
+
+    def __init__(self, db, max_queue=10000, overflow='block', spill_file=None, batch_size=500, max_delay=1, retries=3, retry_delay=1):
+        if overflow not in self._policies:
+            raise Exception("Database [{}]: Overflow policy {} not supported (only {})".format(db._name, overflow, self._policies))
+        if overflow == 'spill' and not spill_file:
+            raise Exception("Database [{}]: Overflow policy spill requires a spill file".format(db._name))
+        self._db = db
+        self.max_queue = max(1, max_queue)
+        self.overflow = overflow
+        self.spill_file = spill_file
+        self.batch_size = max(1, batch_size)
+        self.max_delay = max_delay
+        self.retries = retries
+        self.retry_delay = retry_delay
+
+        self._queue = collections.deque()
+        self._cond = threading.Condition()
+        self._spill = None
+        self._spilled_pending = 0
+        self._busy = False
+        self._flush_requested = False
+        self._stopping = False
+        self._thread = None
+
+        self._stats = {'enqueued': 0, 'written': 0, 'failed': 0, 'dropped': 0, 'spilled': 0, 'batches': 0, 'max_queue_depth': 0}
+        self._latency_last = 0.0
+        self._latency_max = 0.0
+        self._latency_sum = 0.0
+
+    def start(self):
+        """Start the writer thread"""
+        with self._cond:
+            if self._thread is not None:
+                return
+            self._stopping = False
+            if self.spill_file:
+                # statements spilled before a shutdown or crash are written first
+                if not os.path.exists(self.spill_file + '.replay') and os.path.exists(self.spill_file):
+                    os.replace(self.spill_file, self.spill_file + '.replay')
+                self._spilled_pending = sum(self._count_lines(self.spill_file + ext) for ext in ('.replay', ''))
+            self._thread = threading.Thread(target=self._run, name='db.writer.{}'.format(self._db._name))
+            self._thread.daemon = True
+            self._thread.start()
+
+    def put(self, stmt, params=(), formatting=None, timeout=None):
+        """Queue a statement, returns False if it has been discarded
+
+        With the 'block' policy 'timeout' limits the time to wait for space
+        in the queue (the statement is discarded when it expires).
+        """
+        with self._cond:
+            if self._thread is None or self._stopping:
+                raise Exception("Database [{}]: Queued writer is not running".format(self._db._name))
+            entry = (stmt, params, formatting)
+            if self._spill is not None:
+                return self._spill_entry(entry)
+            if len(self._queue) >= self.max_queue:
+                if self.overflow == 'block':
+                    if not self._cond.wait_for(lambda: len(self._queue) < self.max_queue or self._stopping, timeout) or self._stopping:
+                        self._stats['dropped'] += 1
+                        return False
+                elif self.overflow == 'drop_oldest':
+                    self._queue.popleft()
+                    self._stats['dropped'] += 1
+                else:
+                    return self._spill_entry(entry)
+            self._queue.append((entry, time.time()))
+            self._stats['enqueued'] += 1
+            self._stats['max_queue_depth'] = max(self._stats['max_queue_depth'], len(self._queue))
+            if len(self._queue) == 1 or len(self._queue) >= self.batch_size:
+                self._cond.notify_all()
+            return True
+
+    def flush(self, timeout=None):
+        """Wait until all queued (and spilled) statements are written
+
+        Returns False if the timeout expired before.
+        """
+        with self._cond:
+            self._flush_requested = True
+            self._cond.notify_all()
+            done = self._cond.wait_for(lambda: self._thread is None or not (self._queue or self._busy or self._spill is not None or self._spilled_pending), timeout)
+            self._flush_requested = False
+            return done
+
+    def stop(self, timeout=None):
+        """Write the queued statements and stop the writer thread
+
+        Statements spilled to the spill file and not written until the
+        timeout expires remain in the file and are written after the next
+        start.
+        """
+        with self._cond:
+            thread = self._thread
+            if thread is None:
+                return
+            self._stopping = True
+            self._cond.notify_all()
+        thread.join(timeout)
+        with self._cond:
+            if thread.is_alive():
+                logger.warning("Database [{}]: Queued writer did not stop within {} seconds, {} statements not written".format(self._db._name, timeout, len(self._queue)))
+            self._thread = None
+            self._cond.notify_all()
+
+    def queue_depth(self):
+        """Return the number of queued statements (not including spilled ones)"""
+        return len(self._queue)
+
+    def statistics(self):
+        """Return the metrics of the writer as dict
+
+        - 'queue_depth', 'max_queue_depth': current and highest number of queued statements
+        - 'spilled_depth': number of statements in the spill file, not written yet
+        - 'enqueued', 'written', 'failed', 'dropped', 'spilled': number of statements
+        - 'batches': number of written batches (transactions)
+        - 'flush_latency_last', 'flush_latency_avg', 'flush_latency_max': seconds
+          to write a batch (including the commit)
+        """
+        with self._cond:
+            stats = dict(self._stats)
+            stats['queue_depth'] = len(self._queue)
+            stats['spilled_depth'] = self._spilled_pending
+            stats['flush_latency_last'] = self._latency_last
+            stats['flush_latency_max'] = self._latency_max
+            stats['flush_latency_avg'] = self._latency_sum / stats['batches'] if stats['batches'] else 0.0
+        return stats
+
+    def _spill_entry(self, entry):
+        """Append an entry to the spill file (called with the lock held)"""
+        try:
+            if self._spill is None:
+                self._spill = open(self.spill_file, 'a', encoding='utf-8')
+            self._spill.write(json.dumps(entry) + '\n')
+            self._spill.flush()
+        except (OSError, TypeError, ValueError) as e:
+            logger.error("Database [{}]: Could not spill statement to {}: {}".format(self._db._name, self.spill_file, e))
+            self._stats['dropped'] += 1
+            return False
+        self._spilled_pending += 1
+        self._stats['enqueued'] += 1
+        self._stats['spilled'] += 1
+        return True
+
+    def _run(self):
+        self._replay()
+        while True:
+            with self._cond:
+                while True:
+                    if self._queue:
+                        if self._stopping or self._flush_requested or len(self._queue) >= self.batch_size:
+                            break
+                        wait = self._queue[0][1] + self.max_delay - time.time()
+                        if wait <= 0:
+                            break
+                        self._cond.wait(wait)
+                    elif self._spill is not None:
+                        # the queue has been written, continue with the spilled statements
+                        self._spill.close()
+                        self._spill = None
+                        break
+                    elif self._stopping:
+                        self._cond.notify_all()
+                        return
+                    else:
+                        self._cond.wait()
+                batch = [self._queue.popleft()[0] for i in range(min(self.batch_size, len(self._queue)))]
+                self._busy = True
+                self._cond.notify_all()
+            try:
+                if batch:
+                    self._write(batch)
+                else:
+                    self._replay()
+            finally:
+                with self._cond:
+                    self._busy = False
+                    self._cond.notify_all()
+
+    def _replay(self):
+        """Write the statements of the spill file"""
+        if not self.spill_file:
+            return
+        replay_file = self.spill_file + '.replay'
+        with self._cond:
+            if self._spill is None and not os.path.exists(replay_file) and os.path.exists(self.spill_file):
+                os.replace(self.spill_file, replay_file)
+        if not os.path.exists(replay_file):
+            return
+        batch = []
+        with open(replay_file, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    batch.append(tuple(json.loads(line)))
+                except ValueError:
+                    logger.error("Database [{}]: Ignoring invalid line in spill file: {}".format(self._db._name, line.strip()))
+                    continue
+                if len(batch) >= self.batch_size:
+                    self._write(batch)
+                    batch = []
+            if batch:
+                self._write(batch)
+        os.remove(replay_file)
+        with self._cond:
+            self._spilled_pending = self._count_lines(self.spill_file)
+            self._cond.notify_all()
+
+    def _count_lines(self, filename):
+        try:
+            with open(filename, encoding='utf-8') as f:
+                return sum(1 for line in f)
+        except OSError:
+            return 0
+
+    def _write(self, batch):
+        """Write a batch of statements in one transaction"""
+        for attempt in range(self.retries + 1):
+            start = time.time()
+            try:
+                self._write_transaction(batch)
+            except Exception as e:
+                logger.warning("Database [{}]: Could not write batch of {} statements (attempt {}): {}".format(self._db._name, len(batch), attempt + 1, e))
+                if attempt < self.retries and not self._stopping:
+                    time.sleep(self.retry_delay)
+                    continue
+                break
+            latency = time.time() - start
+            with self._cond:
+                self._stats['written'] += len(batch)
+                self._stats['batches'] += 1
+                self._latency_last = latency
+                self._latency_max = max(self._latency_max, latency)
+                self._latency_sum += latency
+            return
+
+        # write the statements one by one to discard only the failing ones
+        for entry in batch:
+            try:
+                self._write_transaction([entry])
+                written, failed = 1, 0
+            except Exception as e:
+                logger.error("Database [{}]: Could not write statement {}: {}".format(self._db._name, entry[0], e))
+                written, failed = 0, 1
+            with self._cond:
+                self._stats['written'] += written
+                self._stats['failed'] += failed
+
+    def _write_transaction(self, batch):
+        with self._db.transaction() as cur:
+            for (stmt, formatting), entries in itertools.groupby(batch, key=lambda entry: (entry[0], entry[2])):
+                entries = list(entries)
+                if len(entries) == 1:
+                    self._db.execute(stmt, entries[0][1], formatting=formatting, cur=cur)
+                else:
+                    self._db.executemany(stmt, [entry[1] for entry in entries], formatting=formatting, cur=cur)
@@ -68,6 +68,8 @@ class Items():
 
     _children = []         # List of top level items
 
+    _logic_trigger_index = None     # Index of watch_item subscriptions (set by lib.logic)
+
 
     def __init__(self, smarthome):
         self._sh = smarthome
@@ -84,9 +86,10 @@ class Items():
 
     def load_itemdefinitions(self, env_dir, items_dir):
     
-        item_conf = None
-        item_conf = lib.config.parse_itemsdir(env_dir, item_conf)
-        item_conf = lib.config.parse_itemsdir(items_dir, item_conf, addfilenames=True)
+        snapshot_file = None
+        if hasattr(self._sh, '_var_dir'):
+            snapshot_file = os.path.join(self._sh._var_dir, 'config', 'items.snapshot')
+        item_conf = lib.config.parse_itemsdirs([(env_dir, False), (items_dir, True)], snapshot_file)
         
         for attr, value in item_conf.items():
             if isinstance(value, dict):
@@ -168,6 +171,38 @@ class Items():
         if path not in self.__items:
             self.__items.append(path)
         self.__item_dict[path] = item
+        if self._logic_trigger_index is not None:
+            self._logic_trigger_index.invalidate(path)
+
+
+    def set_logic_trigger_index(self, index):
+        """
+        Function to register the index which resolves the logics to trigger on item updates
+
+        The index is maintained by lib.logic when logics are loaded or unloaded. It has to
+        implement the methods ``lookup(item)`` and ``invalidate(path)``.
+
+        :param index: The index object
+        :type index: object
+        """
+
+        Items._logic_trigger_index = index
+
+
+    def return_logic_triggers(self, item):
+        """
+        Function to return the logics, which are watching the given item (via watch_item)
+
+        :param item: Item to return the logics for
+        :type item: object
+
+        :return: logics watching the item
+        :rtype: tuple
+        """
+
+        if self._logic_trigger_index is None:
+            return ()
+        return self._logic_trigger_index.lookup(item)
 
 
     def return_item(self, string):
@@ -208,17 +243,84 @@ class Items():
         :rtype: list
         """
 
-        regex, __, attr = regex.partition(':')
-        regex = regex.replace('.', '\.').replace('*', '.*') + '$'
+        regex, attr, val = self.compile_match_pattern(regex)
+        return [self.__item_dict[item] for item in self.__items if self.item_matches_pattern(self.__item_dict[item], regex, attr, val)]
+
+
+    @staticmethod
+    def compile_match_pattern(pattern):
+        """
+        Function to compile an item pattern (as used by match_items) for repeated matching
+
+        The pattern is split into the compiled regular expression for the item path and an
+        optional attribute filter (``path:attr`` or ``path:attr[value]``)
+
+        :param pattern: Pattern to compile
+        :type pattern: str
+
+        :return: tuple (compiled regex, attribute, value)
+        :rtype: tuple
+        """
+
+        regex, __, attr = pattern.partition(':')
+        regex = regex.replace('.', '\\.').replace('*', '.*') + '$'
         regex = re.compile(regex)
         attr, __, val = attr.partition('[')
         val = val.rstrip(']')
+        return (regex, attr, val)
+
+
+    @staticmethod
+    def item_matches_pattern(item, regex, attr='', val=''):
+        """
+        Function to test a single item against a pattern compiled by compile_match_pattern
+
+        :param item: Item to test
+        :param regex: compiled regular expression for the item path
+        :param attr: attribute the item has to be configured with (optional)
+        :param val: value the attribute has to contain (optional)
+
+        :return: True, if the item matches the pattern
+        :rtype: bool
+        """
+
+        if not regex.match(item._path):
+            return False
         if attr != '' and val != '':
-            return [self.__item_dict[item] for item in self.__items if regex.match(item) and attr in self.__item_dict[item].conf and ((type(self.__item_dict[item].conf[attr]) in [list,dict] and val in self.__item_dict[item].conf[attr]) or (val == self.__item_dict[item].conf[attr]))]
+            return attr in item.conf and ((type(item.conf[attr]) in [list,dict] and val in item.conf[attr]) or (val == item.conf[attr]))
         elif attr != '':
-            return [self.__item_dict[item] for item in self.__items if regex.match(item) and attr in self.__item_dict[item].conf]
-        else:
-            return [self.__item_dict[item] for item in self.__items if regex.match(item)]
+            return attr in item.conf
+        return True
+
+
+    def update_items(self, updates, caller='Logic', source=None, dest=None):
+        """
+        Function to update a batch of items in one pass
+
+        First the new values of all items are set, afterwards the triggers (on_update/on_change,
+        method triggers, logics, eval triggers) of all changed items are dispatched. Items with
+        an eval expression are updated the regular way (through the scheduler).
+
+        :param updates: list of (item, value) tuples
+        :param caller: caller of the update
+        :param source: source of the update
+        :param dest: destination of the update
+        :type updates: list
+        :type caller: str
+        """
+
+        pending = []
+        for item, value in updates:
+            if value is None or item._type is None:
+                continue
+            if item._eval:
+                item(value, caller, source, dest)
+                continue
+            result = item._update_value(value, caller, source, dest)
+            if result is not None:
+                pending.append((item, result))
+        for item, (value, changed) in pending:
+            item._update_dispatch(value, changed, caller, source, dest)
 
 
     def find_items(self, conf):
@@ -991,11 +1093,21 @@ class Item():
                 self._run_on_xxx(self._path, value, on_change_dest, on_change_eval, 'on_change')
 
 
-    def __trigger_logics(self):
-        for logic in self.__logics_to_trigger:
+    def __trigger_logics(self, logics):
+        for logic in logics:
             logic.trigger('Item', self._path, self._value)
 
     def __update(self, value, caller='Logic', source=None, dest=None):
+        result = self._update_value(value, caller, source, dest)
+        if result is not None:
+            self._update_dispatch(result[0], result[1], caller, source, dest)
+
+    def _update_value(self, value, caller='Logic', source=None, dest=None):
+        """
+        First phase of an item update: cast and store the new value
+
+        :return: tuple (value, changed) or None, if the value could not be cast to the item type
+        """
         try:
             value = self.cast(value)
         except:
@@ -1003,7 +1115,7 @@ class Item():
                 logger.warning("Item {}: value {} does not match type {}. Via {} {}".format(self._path, value, self._type, caller, source))
             except:
                 pass
-            return
+            return None
         self._lock.acquire()
         _changed = False
         self.__updated_by = "{0}:{1}".format(caller, source)
@@ -1027,6 +1139,12 @@ class Item():
                         log_dst += ', dest: ' + dest
                     self._log_change_logger.info("Item Change: {} = {}  -  caller: {}{}{}".format(self._path, value, caller, log_src, log_dst))
         self._lock.release()
+        return (value, _changed)
+
+    def _update_dispatch(self, value, _changed, caller='Logic', source=None, dest=None):
+        """
+        Second phase of an item update: run on_update/on_change, triggers, cache and autotimer
+        """
         # ms: call run_on_update() from here
         self.__run_on_update(value)
         if _changed or self._enforce_updates or self._type == 'scene':
@@ -1039,15 +1157,16 @@ class Item():
                     method(self, caller, source, dest)
                 except Exception as e:
                     logger.exception("Item {}: problem running {}: {}".format(self._path, method, e))
-            if self._threshold and self.__logics_to_trigger:
+            logics = self.get_logic_triggers()
+            if self._threshold and logics:
                 if self.__th_crossed and self._value <= self.__th_low:  # cross lower bound
                     self.__th_crossed = False
-                    self.__trigger_logics()
+                    self.__trigger_logics(logics)
                 elif not self.__th_crossed and self._value >= self.__th_high:  # cross upper bound
                     self.__th_crossed = True
-                    self.__trigger_logics()
-            elif self.__logics_to_trigger:
-                self.__trigger_logics()
+                    self.__trigger_logics(logics)
+            elif logics:
+                self.__trigger_logics(logics)
             for item in self._items_to_trigger:
                 args = {'value': value, 'source': self._path}
                 self._sh.trigger(name=item.id(), obj=item.__run_eval, value=args, by=caller, source=source, dest=dest)
@@ -1083,7 +1202,18 @@ class Item():
         self.__logics_to_trigger.remove(logic)
 
     def get_logic_triggers(self):
-        return self.__logics_to_trigger
+        """
+        Returns the logics to trigger on an update of this item
+
+        These are the logics added directly to the item and the logics watching the item
+        through the watch_item index of lib.logic
+        """
+        if _items_instance is None:
+            return self.__logics_to_trigger
+        indexed = _items_instance.return_logic_triggers(self)
+        if not self.__logics_to_trigger:
+            return indexed
+        return self.__logics_to_trigger + [logic for logic in indexed if logic not in self.__logics_to_trigger]
 
     def add_method_trigger(self, method):
         self.__methods_to_trigger.append(method)
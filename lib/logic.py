@@ -48,6 +48,7 @@ They can be used the following way: To call eg. **enable_logic(name)**, use the
 """
 import logging
 import os
+import threading
 
 from collections import OrderedDict
 
@@ -102,6 +103,8 @@ class Logics():
         self._logics = {}
         self._bytecode = {}
         self.alive = True
+        self._watch_index = WatchItemIndex(self.items)
+        self.items.set_logic_trigger_index(self._watch_index)
 
         global _logics_instance
         if _logics_instance is not None:
@@ -172,9 +175,7 @@ class Logics():
             if isinstance(logic.watch_item, str):
                 logic.watch_item = [logic.watch_item]
             for entry in logic.watch_item:
-#                for item in self._sh.match_items(entry):
-                for item in self.items.match_items(entry):
-                    item.add_logic_trigger(logic)
+                self._watch_index.subscribe(logic, entry)
         return True
         
     
@@ -512,17 +513,7 @@ class Logics():
         self.scheduler.remove(self._logicname_prefix+name)
     
         # watch_items entfernen
-        if hasattr(mylogic, 'watch_item'):
-            if isinstance(mylogic.watch_item, str):
-                mylogic.watch_item = [mylogic.watch_item]
-            for entry in mylogic.watch_item:
-                # item hook
-#                for item in self._sh.match_items(entry):
-                for item in self.items.match_items(entry):
-                    try:
-                        item.remove_logic_trigger(mylogic)
-                    except:
-                        logger.error("unload_logic: logic = '{}' - cannot remove logic_triggers".format(name))
+        self._watch_index.unsubscribe(mylogic)
         mylogic.watch_item = []
         self._delete_logic(name)
         return True
@@ -894,6 +885,139 @@ class Logics():
         return True
         
 
+# ------------------------------------------------------------------------------------
+
+class WatchItemIndex():
+    """
+    Index of the ``watch_item`` subscriptions of all loaded logics
+
+    Subscriptions for plain item pathes are stored in a dict. Subscriptions with wildcards
+    (like ``*.motion``) or attribute filters are compiled once and evaluated the first time
+    an item with a given path is looked up. The result is cached per item path, so items
+    which are added after a logic has been loaded are matched too, and an item update
+    only needs a single dict lookup to find the logics to trigger.
+
+    :param items: Instance of the Items class
+    :type items: object
+    """
+
+    _regex_chars = set('^$*+?{}[]\\|():')
+
+    def __init__(self, items):
+        self._items = items
+        self._lock = threading.Lock()
+        self._exact = {}           # item path -> list of logics
+        self._patterns = {}        # pattern -> [compiled pattern, list of logics]
+        self._subscriptions = {}   # logic -> list of patterns
+        self._order = {}           # logic -> sequence number (keeps trigger order = load order)
+        self._sequence = 0
+        self._cache = {}           # item path -> tuple of logics
+
+
+    def _is_exact(self, pattern):
+        return not (self._regex_chars & set(pattern))
+
+
+    def subscribe(self, logic, pattern):
+        """
+        Add a subscription of a logic for an item path or pattern
+
+        :param logic: logic to trigger
+        :param pattern: item path or pattern (as used by match_items)
+        :type pattern: str
+        """
+        pattern = str(pattern).strip()
+        with self._lock:
+            if logic not in self._order:
+                self._sequence += 1
+                self._order[logic] = self._sequence
+            subscriptions = self._subscriptions.setdefault(logic, [])
+            if pattern in subscriptions:
+                return
+            subscriptions.append(pattern)
+            if self._is_exact(pattern):
+                self._exact.setdefault(pattern, []).append(logic)
+                self._cache.pop(pattern, None)
+            else:
+                if pattern not in self._patterns:
+                    self._patterns[pattern] = [self._items.compile_match_pattern(pattern), []]
+                self._patterns[pattern][1].append(logic)
+                self._cache = {}
+
+
+    def unsubscribe(self, logic):
+        """
+        Remove all subscriptions of a logic
+
+        :param logic: logic to remove the subscriptions for
+        """
+        with self._lock:
+            wildcards = False
+            for pattern in self._subscriptions.pop(logic, []):
+                if pattern in self._exact:
+                    self._exact[pattern].remove(logic)
+                    if not self._exact[pattern]:
+                        del self._exact[pattern]
+                    self._cache.pop(pattern, None)
+                elif pattern in self._patterns:
+                    self._patterns[pattern][1].remove(logic)
+                    if not self._patterns[pattern][1]:
+                        del self._patterns[pattern]
+                    wildcards = True
+            self._order.pop(logic, None)
+            if wildcards:
+                self._cache = {}
+
+
+    def invalidate(self, path):
+        """
+        Drop the cached subscriptions of an item path (e.g. if an item has been (re)added)
+
+        :param path: path of the item
+        :type path: str
+        """
+        self._cache.pop(path, None)
+
+
+    def lookup(self, item):
+        """
+        Return the logics watching an item
+
+        :param item: item to return the logics for
+        :type item: object
+
+        :return: logics in the order they have been loaded
+        :rtype: tuple
+        """
+        logics = self._cache.get(item._path)
+        if logics is None:
+            logics = self._resolve(item)
+        return logics
+
+
+    def _resolve(self, item):
+        with self._lock:
+            matches = set(self._exact.get(item._path, []))
+            for (regex, attr, val), pattern_logics in self._patterns.values():
+                if self._items.item_matches_pattern(item, regex, attr, val):
+                    matches.update(pattern_logics)
+            logics = tuple(sorted(matches, key=self._order.get))
+            self._cache[item._path] = logics
+        return logics
+
+
+    def get_subscriptions(self, logic):
+        """
+        Return the item pathes and patterns a logic is subscribed to
+
+        :param logic: logic to return the subscriptions for
+
+        :return: list of item pathes and patterns
+        :rtype: list
+        """
+        return list(self._subscriptions.get(logic, []))
+
+
 # ------------------------------------------------------------------------------------
 
 class Logic():
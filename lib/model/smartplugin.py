@@ -632,7 +632,6 @@ class SmartPlugin(SmartObject, Utils):
 
 
 
-from jinja2 import Environment, FileSystemLoader
 from lib.module import Modules
 
 
@@ -649,8 +648,7 @@ class SmartPluginWebIf():
         :rtype: object
         """
         mytemplates = self.plugin.path_join( self.webif_dir, 'templates' )
-        globaltemplates = self.plugin.mod_http.gtemplates_dir
-        tplenv = Environment(loader=FileSystemLoader([mytemplates,globaltemplates]))
+        tplenv = self.plugin.mod_http.create_template_environment([mytemplates])
 
         tplenv.globals['isfile'] = self.is_staticfile
         tplenv.globals['_'] = self.translate
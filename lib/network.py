@@ -35,13 +35,21 @@ This classes, functions and methods are mainly meant to be used by plugin develo
 """
 
 import asyncio
+import collections
+import concurrent.futures
+import copy
+import http.cookiejar
 import ipaddress
 import logging
+import math
+import os
 import queue
 import re
 import requests
+import requests.adapters
 import select
 import socket
+import struct
 import threading
 import time
 
@@ -216,19 +224,384 @@ class Network(object):
         return 'IPv6' if ipver == socket.AF_INET6 else 'IPv4'
 
 
+class NetworkLoop(object):
+    """
+    Shared asyncio event loop for the network classes of this library
+
+    All connections of all Tcp_client, Tcp_server, Udp_server and Udp_client instances
+    are handled by this one loop, which runs in a single thread. Callbacks of the clients
+    and servers are called from that thread, so they should not block. The loop is stopped
+    by SmartHomeNG on shutdown, servers registered with the loop are closed before.
+
+    Use it the following way:
+
+    .. code-block:: python
+
+        from lib.network import NetworkLoop
+        loop = NetworkLoop.get_instance()
+    """
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self):
+        self.logger = logging.getLogger(__name__)
+        self.loop = asyncio.new_event_loop()
+        self._servers = []
+        self._thread = threading.Thread(target=self._run, name='Network_Loop')
+        self._thread.daemon = True
+        self._thread.start()
+
+    @classmethod
+    def get_instance(cls):
+        """
+        Returns the instance of the shared network loop, the loop is started on first use
+
+        :return: network loop instance
+        :rtype: NetworkLoop
+        """
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+            return cls._instance
+
+    @classmethod
+    def shutdown(cls, timeout=10):
+        """
+        Stops the shared network loop (if it has been started)
+
+        All registered servers are closed before the loop is stopped.
+        """
+        with cls._instance_lock:
+            instance = cls._instance
+            cls._instance = None
+        if instance is not None:
+            instance.stop(timeout)
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_forever()
+        except Exception as e:
+            self.logger.exception("Network loop stopped with error: {}".format(e))
+        finally:
+            self.loop.close()
+
+    def register_server(self, server):
+        """
+        Registers a server, which is closed when the network loop is stopped
+
+        The server has to implement a coroutine ``wait_closed()``.
+        """
+        if server not in self._servers:
+            self._servers.append(server)
+
+    def unregister_server(self, server):
+        """
+        Removes a server from the list of registered servers
+        """
+        if server in self._servers:
+            self._servers.remove(server)
+
+    async def _stop(self):
+        for server in list(self._servers):
+            try:
+                await server.wait_closed()
+            except Exception as e:
+                self.logger.warning("Error closing server {}: {}".format(server.name, e))
+        self.loop.stop()
+
+    def stop(self, timeout=10):
+        """
+        Closes all registered servers and stops the network loop
+        """
+        if self.in_loop_thread():
+            self.loop.create_task(self._stop())
+            return
+        asyncio.run_coroutine_threadsafe(self._stop(), self.loop)
+        self._thread.join(timeout)
+
+    def in_loop_thread(self):
+        """
+        Returns True, if called from the thread of the network loop
+        """
+        return threading.current_thread() is self._thread
+
+    def call_soon(self, callback, *args):
+        """
+        Schedules a callback to be run in the network loop (may be called from any thread)
+        """
+        if self.in_loop_thread():
+            self.loop.call_soon(callback, *args)
+        else:
+            self.loop.call_soon_threadsafe(callback, *args)
+
+    def run_coroutine(self, coro):
+        """
+        Schedules a coroutine to be run in the network loop (may be called from any thread)
+
+        :return: future of the coroutine's result
+        :rtype: concurrent.futures.Future or asyncio.Task
+        """
+        if self.in_loop_thread():
+            return self.loop.create_task(coro)
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+
+class HttpClient(object):
+    """
+    Shared HTTP client with connection pooling, response caching and batch fetching
+
+    Connections are kept alive and reused per host (one pool per host, at most
+    ``pool_connections`` hosts and ``pool_maxsize`` connections per host are kept).
+    Responses of GET requests can be cached for ``cache_ttl`` seconds. After the ttl is
+    expired, a cached response with ETag or Last-Modified header is revalidated with a
+    conditional request and reused if the server answers with 304 Not Modified. Responses are
+    cached per URL, parameters, authentication and request headers, each caller gets its own
+    copy of a cached response.
+
+    The client is shared by all plugins and logics, so its session does not keep cookies:
+    cookies received by one caller are never sent with the requests of another caller.
+    The cookies of a response are still available in ``response.cookies``.
+
+    Use it the following way:
+
+    .. code-block:: python
+
+        from lib.network import HttpClient
+        client = HttpClient.get_instance()
+        response = client.request('GET', 'http://www.myserver.tld', cache_ttl=60)
+        responses = client.fetch_many(['http://host1.tld', 'http://host2.tld'])
+
+    :param pool_connections: Number of hosts to keep connection pools for
+    :param pool_maxsize: Maximum number of connections kept per host (also number of worker threads of fetch_many)
+    :param max_cache_entries: Maximum number of cached responses
+
+    :type pool_connections: int
+    :type pool_maxsize: int
+    :type max_cache_entries: int
+    """
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self, pool_connections=10, pool_maxsize=4, max_cache_entries=256):
+        self.logger = logging.getLogger(__name__)
+        self.pool_maxsize = pool_maxsize
+        self.max_cache_entries = max_cache_entries
+        self.session = requests.Session()
+        self.session.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._cache = collections.OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._executor = None
+
+        # statistics
+        self.requests_sent = 0
+        self.cache_hits = 0
+        self.cache_revalidated = 0
+
+    @classmethod
+    def get_instance(cls):
+        """
+        Returns the instance of the shared http client, the client is created on first use
+
+        :return: http client instance
+        :rtype: HttpClient
+        """
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+            return cls._instance
+
+    @classmethod
+    def shutdown(cls):
+        """
+        Closes all pooled connections of the shared http client (if it has been created)
+        """
+        with cls._instance_lock:
+            instance = cls._instance
+            cls._instance = None
+        if instance is not None:
+            instance.close()
+
+    def close(self):
+        """
+        Closes all pooled connections and stops the worker threads of fetch_many
+        """
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+        self.session.close()
+
+    def clear_cache(self):
+        """
+        Removes all cached responses
+        """
+        with self._cache_lock:
+            self._cache.clear()
+
+    def request(self, method, url, params=None, data=None, headers=None, auth=None, timeout=10, cache_ttl=None):
+        """
+        Sends a request using a pooled connection
+
+        :param method: HTTP method ('GET', 'POST', ...)
+        :param url: URL to send the request to
+        :param params: Optional dict of parameters to add to URL query string.
+        :param data: Optional body of the request
+        :param headers: Optional dict of headers to send
+        :param auth: Optional (username, password) tuple for basic authentication
+        :param timeout: Timeout in seconds
+        :param cache_ttl: Seconds to answer GET requests from the cache. Default is None (no caching).
+
+        :type method: str
+        :type url: str
+        :type params: dict
+        :type headers: dict
+        :type auth: tuple
+        :type timeout: int | float
+        :type cache_ttl: int | float
+
+        :return: Response object of the requests library
+        :rtype: requests.Response
+
+        :raises requests.exceptions.RequestException: if the request failed
+        """
+        method = method.upper()
+        if cache_ttl is None or method != 'GET':
+            return self._send(method, url, params, data, headers, auth, timeout)
+
+        key = self._cache_key(url, params, headers, auth)
+        if key is None:
+            return self._send(method, url, params, data, headers, auth, timeout)
+        with self._cache_lock:
+            entry = self._cache.get(key)
+        if entry is not None:
+            response, fetched = entry
+            if time.time() < fetched + cache_ttl:
+                self.cache_hits += 1
+                return self._copy(response)
+            validators = {}
+            if response.headers.get('ETag'):
+                validators['If-None-Match'] = response.headers['ETag']
+            if response.headers.get('Last-Modified'):
+                validators['If-Modified-Since'] = response.headers['Last-Modified']
+            if validators:
+                validators.update(headers or {})
+                revalidated = self._send(method, url, params, data, validators, auth, timeout)
+                if revalidated.status_code == 304:
+                    self.cache_revalidated += 1
+                    self._store(key, response)
+                    return self._copy(response)
+                self._store(key, revalidated)
+                return revalidated
+
+        response = self._send(method, url, params, data, headers, auth, timeout)
+        self._store(key, response)
+        return response
+
+    def _cache_key(self, url, params, headers, auth):
+        """
+        Returns the cache key of a request or None, if the request cannot be cached (e.g. auth objects of requests)
+        """
+        if auth is not None:
+            if not isinstance(auth, (tuple, list)) or len(auth) != 2:
+                return None
+            auth = (auth[0], auth[1])
+        try:
+            if params:
+                items = params.items() if isinstance(params, dict) else params
+                if isinstance(items, (str, bytes)):
+                    params = items
+                else:
+                    # list values (e.g. {'id': [1, 2]}) are sent as repeated parameters
+                    params = tuple(sorted((name, tuple(value) if isinstance(value, list) else value) for name, value in items))
+            else:
+                params = None
+            if headers:
+                headers = tuple(sorted((name.lower(), value) for name, value in headers.items()))
+            else:
+                headers = None
+            key = (url, params, auth, headers)
+            hash(key)
+        except (TypeError, ValueError):
+            # not comparable or not hashable, the request is sent without caching
+            return None
+        return key
+
+    def _send(self, method, url, params, data, headers, auth, timeout):
+        self.requests_sent += 1
+        return self.session.request(method, url, params=params, data=data, headers=headers, auth=auth, timeout=timeout)
+
+    def _store(self, key, response):
+        if response.status_code != 200:
+            return
+        response = self._copy(response)
+        with self._cache_lock:
+            self._cache.pop(key, None)
+            self._cache[key] = (response, time.time())
+            while len(self._cache) > self.max_cache_entries:
+                self._cache.popitem(last=False)
+
+    def _copy(self, response):
+        """
+        Returns a copy of a response, so callers can change it (e.g. its encoding) without affecting the cache
+        """
+        response = copy.copy(response)
+        response.headers = requests.structures.CaseInsensitiveDict(response.headers)
+        response.cookies = response.cookies.copy()
+        return response
+
+    def fetch_many(self, urls, method='GET', timeout=10, cache_ttl=None):
+        """
+        Sends requests to several URLs concurrently
+
+        The requests are sent by up to ``pool_maxsize`` worker threads. Errors are returned
+        in place of the responses, so one failing URL does not affect the others.
+
+        :param urls: List of URLs
+        :param method: HTTP method used for all requests
+        :param timeout: Timeout in seconds for each request
+        :param cache_ttl: Seconds to answer GET requests from the cache. Default is None (no caching).
+
+        :return: List of response objects (or exceptions) in the order of the urls
+        :rtype: list
+        """
+        with self._cache_lock:
+            if self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.pool_maxsize)
+            executor = self._executor
+        futures = [executor.submit(self.request, method, url, timeout=timeout, cache_ttl=cache_ttl) for url in urls]
+        results = []
+        for url, future in zip(urls, futures):
+            try:
+                results.append(future.result())
+            except Exception as e:
+                self.logger.warning("Error sending {} request to {}: {}".format(method, url, e))
+                results.append(e)
+        return results
+
+
 class Http(object):
     """
     Creates an instance of the Http class.
 
+    The requests are sent by the shared HttpClient, which keeps the connections alive.
+
     :param baseurl: base URL used everywhere in this instance (example: http://www.myserver.tld)
+    :param cache_ttl: Seconds to answer GET requests from the cache. Default is None (no caching).
     :type baseurl: str
+    :type cache_ttl: int | float
     """
-    def __init__(self, baseurl=None):
+    def __init__(self, baseurl=None, cache_ttl=None):
         self.logger = logging.getLogger(__name__)
 
         self.baseurl = baseurl
         self._response = None
         self.timeout = 10
+        self.cache_ttl = cache_ttl
 
     def get_json(self, url=None, params=None):
         """
@@ -341,7 +714,7 @@ class Http(object):
         timeout = timeout if timeout else self.timeout
         self.logger.info("Sending GET request to {}".format(url))
         try:
-            self._response = requests.get(url, params=params, timeout=timeout)
+            self._response = HttpClient.get_instance().request('GET', url, params=params, timeout=timeout, cache_ttl=self.cache_ttl)
             self.logger.debug("{} Fetched URL {}".format(self.response_status(), self._response.url))
         except Exception as e:
             self.logger.warning("Error sending GET request to {}: {}".format(url, e))
@@ -403,10 +776,10 @@ class Tcp_client(object):
         self._data_received_callback = None
 
         # "Secret" properties
-        self.__connect_thread = None
-        self.__connect_threadlock = threading.Lock()
-        self.__receive_thread = None
-        self.__receive_threadlock = threading.Lock()
+        self.__loop = NetworkLoop.get_instance()
+        self.__transport = None
+        self.__connect_future = None
+        self.__buffer = None
         self.__running = True
 
         self.logger.setLevel(logging.DEBUG)
@@ -462,7 +835,10 @@ class Tcp_client(object):
     def connect(self):
         """ Connects the socket
 
-        :return: False if an error prevented us from launching a connection thread. True if a connection thread has been started.
+        The connection is established by the shared network loop (see class NetworkLoop),
+        which also handles the connect retries and the reconnect cycles.
+
+        :return: False if an error prevented us from starting a connection cycle. True if a connection cycle has been started.
         :rtype: bool
         """
         if self._hostip is None:  # return False if no valid ip to connect to
@@ -472,10 +848,12 @@ class Tcp_client(object):
         if self._is_connected:  # return false if already connected
             self.logger.error("Already connected to {}, ignoring new request".format(self._host))
             return False
+        if self.__connect_future is not None and not self.__connect_future.done():
+            self.logger.warning("Connection attempt already in progress for {}, ignoring new request".format(self._host))
+            return False
 
-        self.__connect_thread = threading.Thread(target=self._connect_thread_worker, name='TCP_Connect')
-        self.__connect_thread.daemon = True
-        self.__connect_thread.start()
+        self.__running = True
+        self.__connect_future = self.__loop.run_coroutine(self._connect_worker())
         return True
 
     def connected(self):
@@ -489,7 +867,7 @@ class Tcp_client(object):
     def send(self, message):
         """ Sends a message to the server. Can be a string, bytes or a bytes array.
 
-        :return: True if message has been successfully sent, else False.
+        :return: True if message has been successfully queued for sending, else False.
         :rtype: bool
         """
         if not isinstance(message, (bytes, bytearray)):
@@ -500,138 +878,125 @@ class Tcp_client(object):
                 return False
         try:
             if self._is_connected:
-                self._socket.send(message)
+                self.__loop.call_soon(self.__transport.write, bytes(message))
             else:
                 return False
         except:
-            self.logger.warning("No connection to {}, cannot send data {}".format(self._host, msg))
+            self.logger.warning("No connection to {}, cannot send data {}".format(self._host, message))
             return False
         return True
 
-    def _connect_thread_worker(self):
-        if not self.__connect_threadlock.acquire(blocking=False):
-            self.logger.warning("Connection attempt already in progress for {}, ignoring new request".format(self._host))
-            return
-        if self._is_connected:
-            self.logger.error("Already connected to {}, ignoring new request".format(self._host))
-            return
+    async def _connect_worker(self):
+        """ Tries to connect until successful, runs in the network loop """
         self.logger.debug("Starting connection cycle for {}".format(self._host))
         self._connect_counter = 0
         while self.__running and not self._is_connected:
             # Try a full connect cycle
             while not self._is_connected and self._connect_counter < self._connect_retries and self.__running:
-                self._connect()
+                await self._connect()
                 if self._is_connected:
-                    try:
-                        self.__connect_threadlock.release()
-                        self._connected_callback and self._connected_callback(self)
-                        _name='TCP_Client'
-                        if self.name is not None:
-                            _name += '_' + self.name
-                        self.__receive_thread = threading.Thread(target=self.__receive_thread_worker, name=_name)
-                        self.__receive_thread.daemon = True
-                        self.__receive_thread.start()
-                    except:
-                        raise
                     return True
-                self._sleep(self._connect_cycle)
+                await asyncio.sleep(self._connect_cycle)
 
             if self._autoreconnect:
-                self._sleep(self._retry_cycle)
+                await asyncio.sleep(self._retry_cycle)
                 self._connect_counter = 0
             else:
                 break
-        try:
-            self.__connect_threadlock.release()
-        except:
-            pass
+        return False
 
-    def _connect(self):
+    async def _connect(self):
         self.logger.debug("Connecting to {} using {} {} on TCP port {} {} autoreconnect".format(self._host, 'IPv6' if self._ipver == socket.AF_INET6 else 'IPv4', self._hostip, self._port, ('with' if self._autoreconnect else 'without')))
         # Try to connect to remote host using ip (v4 or v6)
         try:
-            self._socket = socket.socket(self._ipver, socket.SOCK_STREAM)
-            self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
-            self._socket.settimeout(5)
-            self._socket.connect(('{}'.format(self._hostip), int(self._port)))
-            self._socket.settimeout(self._timeout)
-            self._is_connected = True
-            self.logger.info("Connected to {} on TCP port {}".format(self._host, self._port))
+            transport, protocol = await asyncio.wait_for(self.__loop.loop.create_connection(lambda: _Tcp_client_protocol(self), self._hostip, int(self._port), family=self._ipver), 5)
+            self._socket = transport.get_extra_info('socket')
+            if self._socket is not None:
+                self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
         # Connection error
         except Exception as err:
             self._is_connected = False
             self._connect_counter += 1
             self.logger.warning("TCP connection to {}:{} failed with error {}. Counter: {}/{}".format(self._host, self._port, err, self._connect_counter, self._connect_retries))
-
-    def __receive_thread_worker(self):
-        poller = select.poll()
-        poller.register(self._socket, select.POLLIN | select.POLLPRI | select.POLLHUP | select.POLLERR)
-        __buffer = b''
-
+            return
+        if not self.__running:
+            transport.close()
+            return
+        self.__transport = transport
+        self.__buffer = b'' if self._binary else ''
+        self._is_connected = True
+        self.logger.info("Connected to {} on TCP port {}".format(self._host, self._port))
+        self._connected_callback and self._connected_callback(self)
         self._is_receiving = True
         self._receiving_callback and self._receiving_callback(self)
-        while self._is_connected and self.__running:
-            events = poller.poll(1000)
-            for fd, event in events:
-                if event & select.POLLHUP:
-                    self.logger.warning("Client socket closed")
-                # Check if POLLIN event triggered
-                if event & (select.POLLIN | select.POLLPRI):
-                    msg = self._socket.recv(4096)
-                    # Check if incoming message is not empty
-                    if msg:
-                        # If we transfer in text mode decode message to string
-                        if not self._binary:
-                            msg = str.rstrip(str(msg, 'utf-8'))
-                        # If we work in line mode (with a terminator) slice buffer into single chunks based on terminator
-                        if self.terminator:
-                            __buffer += msg
-                            while True:
-                                # terminator = int means fixed size chunks
-                                if isinstance(self.terminator, int):
-                                    i = self.terminator
-                                    if i > len(__buffer):
-                                        break
-                                # terminator is str or bytes means search for it
-                                else:
-                                    i = __buffer.find(self.terminator)
-                                    if i == -1:
-                                        break
-                                    i += len(self.terminator)
-                                line = __buffer[:i]
-                                __buffer = __buffer[i:]
-                                if self._data_received_callback is not None:
-                                    self._data_received_callback(self, line)
-                        # If not in terminator mode just forward what we received
-                        else:
-                            if self._data_received_callback is not None:
-                                self._data_received_callback(self, msg)
-                    # If empty peer has closed the connection
-                    else:
-                        # Peer connection closed
-                        self.logger.warning("Connection closed by peer {}".format(self._host))
-                        self._is_connected = False
-                        poller.unregister(self._socket)
-                        self._disconnected_callback and self._disconnected_callback(self)
-                        if self._autoreconnect:
-                            self.logger.debug("Autoreconnect enabled for {}".format(self._host))
-                            self.connect()
-        self._is_receiving = False
 
-    def _sleep(self, time_lapse):
-        time_start = time.time()
-        time_end = (time_start + time_lapse)
-        while self.__running and time_end > time.time():
-            pass
+    def _data_received(self, msg):
+        """ Called by the protocol (in the network loop) with the received data """
+        # If we transfer in text mode decode message to string
+        if not self._binary:
+            msg = str.rstrip(str(msg, 'utf-8'))
+        # If we work in line mode (with a terminator) slice buffer into single chunks based on terminator
+        if self.terminator:
+            self.__buffer += msg
+            while True:
+                # terminator = int means fixed size chunks
+                if isinstance(self.terminator, int):
+                    i = self.terminator
+                    if i > len(self.__buffer):
+                        break
+                # terminator is str or bytes means search for it
+                else:
+                    i = self.__buffer.find(self.terminator)
+                    if i == -1:
+                        break
+                    i += len(self.terminator)
+                line = self.__buffer[:i]
+                self.__buffer = self.__buffer[i:]
+                if self._data_received_callback is not None:
+                    self._data_received_callback(self, line)
+        # If not in terminator mode just forward what we received
+        else:
+            if self._data_received_callback is not None:
+                self._data_received_callback(self, msg)
+
+    def _connection_lost(self):
+        """ Called by the protocol (in the network loop) when the connection has been closed """
+        self._is_connected = False
+        self._is_receiving = False
+        self.__transport = None
+        if not self.__running:
+            return
+        # Peer connection closed
+        self.logger.warning("Connection closed by peer {}".format(self._host))
+        self._disconnected_callback and self._disconnected_callback(self)
+        if self._autoreconnect:
+            self.logger.debug("Autoreconnect enabled for {}".format(self._host))
+            self.connect()
 
     def close(self):
         """ Closes the current client socket """
         self.logger.info("Closing connection to {} on TCP port {}".format(self._host, self._port))
         self.__running = False
-        if self.__connect_thread is not None and self.__connect_thread.isAlive():
-            self.__connect_thread.join()
-        if self.__receive_thread is not None and self.__receive_thread.isAlive():
-            self.__receive_thread.join()
+        if self.__connect_future is not None:
+            self.__connect_future.cancel()
+        if self.__transport is not None:
+            self.__loop.call_soon(self.__transport.close)
+
+
+class _Tcp_client_protocol(asyncio.Protocol):
+    """ asyncio protocol, which forwards the events of a connection to its Tcp_client """
+
+    def __init__(self, client):
+        self._client = client
+
+    def data_received(self, data):
+        try:
+            self._client._data_received(data)
+        except Exception as e:
+            self._client.logger.exception("Error processing data received from {}: {}".format(self._client._host, e))
+
+    def connection_lost(self, exc):
+        self._client._connection_lost()
 
 
 class _Client(object):
@@ -688,9 +1053,7 @@ class _Client(object):
                 self.logger.warning("Error encoding data for client {}".format(self.name))
                 return False
         try:
-            
-            self.writer.write(message)
-            self.writer.drain()
+            NetworkLoop.get_instance().call_soon(self.writer.write, bytes(message))
         except:
             self.logger.warning("Error sending data to client {}".format(self.name))
             return False
@@ -722,7 +1085,7 @@ class _Client(object):
         """ Client socket closes itself """
         self._will_close_callback and self._will_close_callback(self)
         self.set_callbacks(data_received=None, will_close=None)
-        self.writer.close()
+        NetworkLoop.get_instance().call_soon(self.writer.close)
         return True
 
     def _iac_to_string(self, msg):
@@ -740,27 +1103,47 @@ class _Client(object):
 class Tcp_server(object):
     """ Creates a new instance of the Tcp_server class
 
+    The server is handled by the shared network loop (see class NetworkLoop).
+
     :param interface: Remote interface name or ip address (v4 or v6). Default is '::' which listens on all IPv4 and all IPv6 addresses available.
     :param port: Remote interface port to connect to
     :param name: Name of this connection (mainly for logging purposes)
+    :param mode: Framing of the received data (MODE_BINARY, MODE_TEXT, MODE_TEXT_LINE, MODE_RAW or MODE_FIXED_LENGTH)
+    :param terminator: Line terminator for MODE_TEXT_LINE (default b'\\n') or frame length for MODE_FIXED_LENGTH
+    :param max_connections: Maximum number of simultaneous client connections (None means unlimited)
 
     :type interface: str
     :type port: int
     :type name: str
+    :type mode: int
+    :type terminator: bytes | str | int
+    :type max_connections: int
+
+    The received data is passed to the data_received callbacks as follows:
+
+    - MODE_BINARY (default) and MODE_TEXT: decoded string of each received chunk, trailing whitespace removed
+    - MODE_TEXT_LINE: decoded string of each line, without the terminator
+    - MODE_RAW: bytes of each received chunk as received
+    - MODE_FIXED_LENGTH: bytes of each frame of terminator bytes
+
+    MODE_BINARY keeps its meaning from the former implementation (decoded strings), use MODE_RAW
+    to receive bytes.
     """
 
     MODE_TEXT = 1
     MODE_TEXT_LINE = 2
     MODE_BINARY = 3
     MODE_FIXED_LENGTH = 4
+    MODE_RAW = 5
 
-    def __init__(self, port, interface='', name=None, mode=MODE_BINARY, terminator=None):
+    def __init__(self, port, interface='', name=None, mode=MODE_BINARY, terminator=None, max_connections=None):
         self.logger = logging.getLogger(__name__)
 
         # Public properties
         self.name = name
         self.mode = mode
         self.terminator = terminator
+        self.max_connections = max_connections
 
         # "Private" properties
         self._interface = interface
@@ -775,13 +1158,12 @@ class Tcp_server(object):
         self._listening_callback = None
         self._incoming_connection_callback = None
         self._data_received_callback = None
+        self._disconnected_callback = None
 
         # "Secret" properties
-        self.__loop = None
-        self.__coroutine = None
+        self.__loop = NetworkLoop.get_instance()
         self.__server = None
-        self.__listening_thread = None
-        self.__listening_threadlock = threading.Lock()
+        self.__clients = {}
         self.__running = True
 
         # Test if host is an ip address or a host name
@@ -809,7 +1191,7 @@ class Tcp_server(object):
                     self.logger.error("Unknown ip address family {}".format(self._ipver))
                     self._interfaceip = None
                 if self._interfaceip is not None:
-                    self.logger.info("Resolved {} to {} address {}".format(self._interface, ipver_to_string(self._ipver), self._hostip))
+                    self.logger.info("Resolved {} to {} address {}".format(self._interface, Network.ipver_to_string(self._ipver), self._interfaceip))
             except:
                 # Unable to resolve hostname
                 self.logger.error("Cannot resolve {} to a valid ip address (v4 or v6)".format(self._interface))
@@ -838,89 +1220,117 @@ class Tcp_server(object):
     def start(self):
         """ Start the server socket
 
-        :return: False if an error prevented us from launching a connection thread. True if a connection thread has been started.
+        :return: False if an error prevented us from starting the server. True if the server is listening.
         :rtype: bool
         """
         if self._is_listening:
             return False
+        self.logger.info("Starting up TCP server socket {}".format(self.__our_socket))
+        self.__running = True
+        future = self.__loop.run_coroutine(self.__start())
+        if self.__loop.in_loop_thread():
+            return True
         try:
-            self.logger.info("Starting up TCP server socket {}".format(self.__our_socket))
-            self.__loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(self.__loop)
-            self.__coroutine = asyncio.start_server(self.__handle_connection, self._interfaceip, self._port)   
-            self.__server = self.__loop.run_until_complete(self.__coroutine)
-
-            self.__listening_thread = threading.Thread(target=self.__listening_thread_worker, name='TCP_Server_{}'.format(self.name))
-            self.__listening_thread.daemon = True
-            self.__listening_thread.start()
-        except:
+            return future.result(timeout=10)
+        except Exception as e:
+            self.logger.error("Unable to start TCP server socket {}: {}".format(self.__our_socket, e))
             return False
-        return True
 
-    def __listening_thread_worker(self):
-        """ Runs the asyncio loop in a separate thread to not block the Tcp_server.start() method """
-        asyncio.set_event_loop(self.__loop)
-        self._is_listening = True
+    async def __start(self):
         try:
-            self.__loop.run_forever()
-        except:
-            self.logger.debug('*** Error in loop.run_forever()')
-        finally:
-            
-            for task in asyncio.Task.all_tasks():
-                task.cancel()
-            self.__server.close()
-            self.__loop.run_until_complete(self.__server.wait_closed())
-            self.__loop.close()
-        self._is_listening = False
+            self.__server = await asyncio.start_server(self.__handle_connection, self._interfaceip, self._port)
+        except Exception as e:
+            self.logger.error("Unable to start TCP server socket {}: {}".format(self.__our_socket, e))
+            return False
+        self._is_listening = True
+        self.__loop.register_server(self)
+        self._listening_callback and self._listening_callback(self)
         return True
 
+    async def __read(self, reader):
+        """ Reads the next frame according to the framing mode, returns None on EOF """
+        try:
+            if self.mode == self.MODE_TEXT_LINE:
+                terminator = self.terminator or b'\n'
+                if isinstance(terminator, str):
+                    terminator = terminator.encode()
+                try:
+                    data = await reader.readuntil(terminator)
+                except asyncio.IncompleteReadError as e:
+                    data = e.partial
+                    terminator = b''
+                if not data:
+                    return None
+                if terminator == b'\n' and data.endswith(b'\r\n'):
+                    terminator = b'\r\n'
+                return data[:len(data) - len(terminator)]
+            elif self.mode == self.MODE_FIXED_LENGTH:
+                return await reader.readexactly(int(self.terminator))
+            else:
+                data = await reader.read(4096)
+                return data if data else None
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            return None
+
     async def __handle_connection(self, reader, writer):
         """ Handles incoming connection. One handler per client """
         peer = writer.get_extra_info('peername')
         socket_object = writer.get_extra_info('socket')
         peer_socket = Network.ip_port_to_socket(peer[0], peer[1])
-        
+
+        if self.max_connections is not None and len(self.__clients) >= self.max_connections:
+            self.logger.warning("Rejected connection from {} on socket {}: maximum of {} connection(s) reached".format(peer_socket, self.__our_socket, self.max_connections))
+            writer.close()
+            return
+
         client = _Client(server=self, socket=socket_object, ip=peer[0], port=peer[1])
         client.ipver = socket.AF_INET6 if Network.is_ipv6(client.ip) else socket.AF_INET
         client.name = Network.ip_port_to_socket(client.ip, client.port)
         client.writer = writer
-        
-        self.logger.info("Incoming connection from {} on socket {}".format(peer_socket, self.__our_socket))
-        self._incoming_connection_callback and self._incoming_connection_callback(self, client)
+        self.__clients[client] = writer
 
-        while True:
+        self.logger.info("Incoming connection from {} on socket {}".format(peer_socket, self.__our_socket))
+        text = self.mode in (self.MODE_BINARY, self.MODE_TEXT, self.MODE_TEXT_LINE)
+        try:
             try:
-                if self.mode == self.MODE_TEXT_LINE:
-                    # self.logger.debug("***")
-                    data = await reader.readline()
-                else:
-                    data = await reader.read(4096)
-            except:
-                data = None
-
-            if data and data[0] == 0xFF and client.process_iac:
-                data = client._process_IAC(data)                
-            if data:
-                try:
-                    string = str.rstrip(str(data, 'utf-8'))
-                    self.logger.debug("Received '{}' from {}".format(string, client.name))
-                    self._data_received_callback and self._data_received_callback(self, client, string)
-                    client._data_received_callback and client._data_received_callback(self, client, string)
-                except:
-                    self.logger.debug("Received undecodable bytes from {}".format(client.name))
-            else:
-                try:
-                    self.__close_client(client)
-                    pass
-                finally:
-                    del client
+                self._incoming_connection_callback and self._incoming_connection_callback(self, client)
+            except Exception as e:
+                self.logger.exception("Error processing incoming connection from {}: {}".format(client.name, e))
                 return
- 
+            while self.__running:
+                data = await self.__read(reader)
+                if data is None:
+                    break
+                if text:
+                    if data and data[0] == 0xFF and client.process_iac:
+                        data = client._process_IAC(data)
+                    try:
+                        data = data.decode('utf-8')
+                    except UnicodeDecodeError:
+                        self.logger.debug("Received undecodable bytes from {}".format(client.name))
+                        continue
+                    if self.mode != self.MODE_TEXT_LINE:
+                        data = data.rstrip()
+                if data:
+                    self.logger.debug("Received '{}' from {}".format(data, client.name))
+                    try:
+                        self._data_received_callback and self._data_received_callback(self, client, data)
+                        client._data_received_callback and client._data_received_callback(self, client, data)
+                    except Exception as e:
+                        self.logger.exception("Error processing data received from {}: {}".format(client.name, e))
+        finally:
+            self.__close_client(client)
+
     def __close_client(self, client):
+        if self.__clients.pop(client, None) is None:
+            return
         self.logger.info("Lost connection to client {}".format(client.name))
-        self._disconnected_callback and self._disconnected_callback(self, client)
-        client.writer.close()        
+        try:
+            self._disconnected_callback and self._disconnected_callback(self, client)
+        except Exception as e:
+            self.logger.exception("Error processing lost connection to {}: {}".format(client.name, e))
+        finally:
+            client.writer.close()
 
     def listening(self):
         """ Returns the current listening state
@@ -930,6 +1340,14 @@ class Tcp_server(object):
         """
         return self._is_listening
 
+    def connection_count(self):
+        """ Returns the number of connected clients
+
+        :return: Number of connected clients
+        :rtype: int
+        """
+        return len(self.__clients)
+
     def send(self, client, msg):
         """ Send a string to connected client
 
@@ -954,18 +1372,560 @@ class Tcp_server(object):
         client.close()
         return True
 
+    async def wait_closed(self):
+        """ Closes the listening socket and all client connections (coroutine, runs in the network loop) """
+        self.__running = False
+        if self.__server is not None:
+            self.__server.close()
+        for client, writer in list(self.__clients.items()):
+            writer.close()
+        if self.__server is not None:
+            try:
+                await asyncio.wait_for(self.__server.wait_closed(), 5)
+            except asyncio.TimeoutError:
+                self.logger.warning("Timeout while waiting for TCP server socket {} to close".format(self.__our_socket))
+        self.__server = None
+        self._is_listening = False
+        self.__loop.unregister_server(self)
+
     def close(self):
         """ Closes running listening socket """
         self.logger.info("Shutting down listening socket on interface {} port {}".format(self._interface, self._port))
-        asyncio.set_event_loop(self.__loop)
-        active_connections = len([task for task in asyncio.Task.all_tasks() if not task.done()])
-        if active_connections > 0:
-            self.logger.info('Tcp_server still has {} active connection(s), cleaning up'.format(active_connections))
-        self.__running = False
-        self.__loop.call_soon_threadsafe(self.__loop.stop)
-        while self.__loop.is_running():
-            pass
-        if self.__listening_thread and self.__listening_thread.isAlive():
-            self.__listening_thread.join()
-        self.__loop.close()
-        
+        if self.__clients:
+            self.logger.info('Tcp_server still has {} active connection(s), cleaning up'.format(len(self.__clients)))
+        future = self.__loop.run_coroutine(self.wait_closed())
+        if not self.__loop.in_loop_thread():
+            try:
+                future.result(timeout=10)
+            except Exception as e:
+                self.logger.warning("Error shutting down TCP server socket {}: {}".format(self.__our_socket, e))
+
+
+class _Udp_socket(object):
+    """ Base class of Udp_server and Udp_client
+
+    Received datagrams are read by the shared network loop (see class NetworkLoop) with
+    recvfrom_into() into a pool of preallocated buffers. All datagrams that are available
+    when the socket becomes readable (up to batch_size) are passed to the data_received
+    callback with one call as a list of (data, (ip, port)) tuples.
+
+    The data of a datagram is a memoryview into the buffer pool, which is only valid during
+    the callback. Use bytes(data) to keep it (or set copy_data to True).
+
+    :param name: Name of this socket (mainly for logging purposes)
+    :param max_size: Maximum size of a datagram, larger datagrams are dropped
+    :param batch_size: Maximum number of datagrams passed to one callback
+    :param copy_data: Pass the data of the datagrams as bytes instead of memoryviews
+
+    :type name: str
+    :type max_size: int
+    :type batch_size: int
+    :type copy_data: bool
+    """
+
+    def __init__(self, name=None, max_size=8192, batch_size=64, copy_data=False):
+        self.logger = logging.getLogger(__name__)
+
+        # Public properties
+        self.name = name
+
+        # "Private" properties
+        self._socket = None
+        self._ipver = socket.AF_INET
+        self._max_size = max_size
+        self._batch_size = batch_size
+        self._copy_data = copy_data
+        self._data_received_callback = None
+        self._loop = NetworkLoop.get_instance()
+
+        # one byte more than max_size to detect truncated datagrams
+        self._buffers = [bytearray(max_size + 1) for i in range(batch_size)]
+        self._views = [memoryview(buffer) for buffer in self._buffers]
+
+        # statistics
+        self._started = None
+        self.datagrams_received = 0
+        self.bytes_received = 0
+        self.datagrams_dropped = 0
+        self.datagrams_sent = 0
+        self.bytes_sent = 0
+        self.send_errors = 0
+        self.batches = 0
+
+    def set_callbacks(self, data_received=None):
+        """ Set callbacks to caller for different socket events
+
+        :param data_received: Called with a list of received datagrams (list of (data, (ip, port)) tuples)
+        :type data_received: function
+        """
+        self._data_received_callback = data_received
+
+    def _create_socket(self, ip, port):
+        self._ipver = socket.AF_INET6 if Network.is_ipv6(ip) else socket.AF_INET
+        sock = socket.socket(self._ipver, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((ip, port))
+        sock.setblocking(False)
+        self._socket = sock
+        self._started = time.time()
+        self._loop.register_server(self)
+        self._loop.call_soon(self._loop.loop.add_reader, sock.fileno(), self._read_ready)
+
+    def _read_ready(self):
+        """ Called by the network loop, when the socket is readable """
+        datagrams = []
+        max_size = self._max_size
+        for view in self._views:
+            try:
+                size, address = self._socket.recvfrom_into(view)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError as e:
+                self.logger.warning("{}: error receiving datagram: {}".format(self.name, e))
+                break
+            if size > max_size:
+                self.datagrams_dropped += 1
+                self.logger.debug("{}: dropped datagram from {} exceeding {} bytes".format(self.name, address, max_size))
+                continue
+            self.datagrams_received += 1
+            self.bytes_received += size
+            datagrams.append((bytes(view[:size]) if self._copy_data else view[:size], address[:2]))
+        if not datagrams:
+            return
+        self.batches += 1
+        if self._data_received_callback is not None:
+            try:
+                self._data_received_callback(self, datagrams)
+            except Exception as e:
+                self.logger.exception("{}: error processing received datagrams: {}".format(self.name, e))
+        if not self._copy_data:
+            # release the views into the buffer pool
+            for data, address in datagrams:
+                data.release()
+
+    def sendto(self, message, host, port):
+        """ Sends a datagram
+
+        :param message: Message to send
+        :param host: IP address of the receiver
+        :param port: Port of the receiver
+
+        :type message: str | bytes | bytearray
+        :type host: str
+        :type port: int
+
+        :return: True if the datagram has been sent, else False.
+        :rtype: bool
+        """
+        if not isinstance(message, (bytes, bytearray, memoryview)):
+            try:
+                message = message.encode('utf-8')
+            except:
+                self.logger.warning("{}: error encoding message".format(self.name))
+                return False
+        if self._socket is None:
+            return False
+        try:
+            self.bytes_sent += self._socket.sendto(message, (host, int(port)))
+            self.datagrams_sent += 1
+        except OSError as e:
+            self.send_errors += 1
+            self.logger.warning("{}: error sending datagram to {}: {}".format(self.name, Network.ip_port_to_socket(host, port), e))
+            return False
+        return True
+
+    def join_multicast(self, group, interface='0.0.0.0'):
+        """ Joins a multicast group
+
+        :param group: IP address of the multicast group (v4 or v6)
+        :param interface: IP address of the interface to join on (IPv4) or interface index (IPv6)
+
+        :return: True if the group has been joined, else False.
+        :rtype: bool
+        """
+        try:
+            if Network.is_ipv6(group):
+                mreq = socket.inet_pton(socket.AF_INET6, group) + int(interface if interface != '0.0.0.0' else 0).to_bytes(4, 'little')
+                self._socket.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_JOIN_GROUP, mreq)
+            else:
+                mreq = socket.inet_aton(group) + socket.inet_aton(interface)
+                self._socket.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+        except Exception as e:
+            self.logger.error("{}: unable to join multicast group {}: {}".format(self.name, group, e))
+            return False
+        self.logger.info("{}: joined multicast group {}".format(self.name, group))
+        return True
+
+    def get_statistics(self):
+        """ Returns the counters of this socket
+
+        :return: counters and throughput (datagrams and bytes per second since start)
+        :rtype: dict
+        """
+        duration = time.time() - self._started if self._started else 0
+        stats = {'datagrams_received': self.datagrams_received, 'bytes_received': self.bytes_received,
+                 'datagrams_dropped': self.datagrams_dropped, 'batches': self.batches,
+                 'datagrams_sent': self.datagrams_sent, 'bytes_sent': self.bytes_sent, 'send_errors': self.send_errors,
+                 'datagrams_per_second': 0, 'bytes_per_second': 0}
+        if duration > 0:
+            stats['datagrams_per_second'] = self.datagrams_received / duration
+            stats['bytes_per_second'] = self.bytes_received / duration
+        return stats
+
+    async def wait_closed(self):
+        """ Closes the socket (coroutine, runs in the network loop) """
+        if self._socket is not None:
+            self._loop.loop.remove_reader(self._socket.fileno())
+            self._socket.close()
+            self._socket = None
+        self._loop.unregister_server(self)
+
+    def close(self):
+        """ Closes the socket """
+        future = self._loop.run_coroutine(self.wait_closed())
+        if not self._loop.in_loop_thread():
+            try:
+                future.result(timeout=10)
+            except Exception as e:
+                self.logger.warning("{}: error closing socket: {}".format(self.name, e))
+
+
+class Udp_server(_Udp_socket):
+    """ Creates a new instance of the Udp_server class
+
+    The server receives datagrams on the given interface and port (see class _Udp_socket
+    for the delivery of the datagrams and the further parameters).
+
+    :param port: Local port to listen on
+    :param interface: Local interface ip address (v4 or v6). Default is '' which listens on all IPv4 addresses.
+    :param name: Name of this server (mainly for logging purposes)
+
+    :type port: int
+    :type interface: str
+    :type name: str
+    """
+
+    def __init__(self, port, interface='', name=None, max_size=8192, batch_size=64, copy_data=False):
+        _Udp_socket.__init__(self, name=name, max_size=max_size, batch_size=batch_size, copy_data=copy_data)
+        self._interface = interface
+        self._port = port
+        if not self.name:
+            self.name = Network.ip_port_to_socket(interface, port)
+
+    def start(self):
+        """ Start the server socket
+
+        :return: False if an error prevented us from binding the socket, else True.
+        :rtype: bool
+        """
+        if self._socket is not None:
+            return False
+        try:
+            self._create_socket(self._interface, self._port)
+        except Exception as e:
+            self.logger.error("Unable to start UDP server socket {}: {}".format(self.name, e))
+            return False
+        self.logger.info("Started UDP server socket {}".format(self.name))
+        return True
+
+    def listening(self):
+        """ Returns the current listening state
+
+        :return: True if the server socket is listening, else False.
+        :rtype: bool
+        """
+        return self._socket is not None
+
+    def get_port(self):
+        """ Returns the port the server is bound to (usefull if it has been started with port 0) """
+        return self._socket.getsockname()[1] if self._socket is not None else self._port
+
+
+class Udp_client(_Udp_socket):
+    """ Creates a new instance of the Udp_client class
+
+    The client sends datagrams to the given host and port. Responses are received through
+    the data_received callback (see class _Udp_socket for the further parameters).
+
+    :param host: Remote host ip address (v4 or v6)
+    :param port: Remote port
+    :param name: Name of this client (mainly for logging purposes)
+
+    :type host: str
+    :type port: int
+    :type name: str
+    """
+
+    def __init__(self, host, port, name=None, max_size=8192, batch_size=64, copy_data=False):
+        _Udp_socket.__init__(self, name=name, max_size=max_size, batch_size=batch_size, copy_data=copy_data)
+        self._host = host
+        self._port = port
+        if not self.name:
+            self.name = Network.ip_port_to_socket(host, port)
+        try:
+            self._create_socket('::' if Network.is_ipv6(host) else '0.0.0.0', 0)
+        except Exception as e:
+            self.logger.error("Unable to create UDP client socket {}: {}".format(self.name, e))
+
+    def send(self, message):
+        """ Sends a datagram to the remote host
+
+        :return: True if the datagram has been sent, else False.
+        :rtype: bool
+        """
+        return self.sendto(message, self._host, self._port)
+
+    def set_multicast_ttl(self, ttl):
+        """ Sets the time-to-live for multicast datagrams sent by this client """
+        if self._ipver == socket.AF_INET6:
+            self._socket.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_MULTICAST_HOPS, ttl)
+        else:
+            self._socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, ttl)
+
+
+class Reachability(object):
+    """
+    Checks the reachability of many hosts concurrently in the shared network loop
+
+    A host is reachable, if it answers an ICMP echo request or a TCP connect probe to one
+    of the probe ports (a refused connection counts as well, as the host answered). ICMP
+    echo requests are sent over a single socket, if the system permits it (unprivileged
+    ICMP sockets or raw sockets with root permissions). Otherwise (and for IPv6 hosts) the
+    echo request is sent by the system ping command, which runs concurrently for all hosts.
+    The results can be cached per host for ``cache_interval`` seconds.
+
+    Use it the following way:
+
+    .. code-block:: python
+
+        from lib.network import Reachability
+        results = Reachability.get_instance().check_many(['192.168.1.10', 'myphone.local'])
+
+    :param cache_interval: Seconds a result is cached for
+    :param ports: TCP ports to probe
+
+    :type cache_interval: int | float
+    :type ports: tuple
+    """
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self, cache_interval=10, ports=(80, 443, 22)):
+        self.logger = logging.getLogger(__name__)
+
+        # Public properties
+        self.name = 'Reachability'
+        self.cache_interval = cache_interval
+        self.ports = ports
+        self.probes = 0
+
+        # "Private" properties
+        self._cache = {}
+        self._icmp_socket = None
+        self._icmp_raw = False
+        self._icmp_available = None
+        self._icmp_id = os.getpid() & 0xffff
+        self._icmp_seq = 0
+        self._icmp_waiting = {}
+        self._ping_available = True
+
+    @classmethod
+    def get_instance(cls):
+        """
+        Returns the shared instance of the reachability checker
+
+        :return: reachability checker instance
+        :rtype: Reachability
+        """
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+            return cls._instance
+
+    def check(self, host, timeout=1, use_cache=True):
+        """
+        Checks if a host is reachable (blocks until the result is available)
+
+        :param host: Host name or ip address (v4 or v6)
+        :param timeout: Seconds to wait for an answer
+        :param use_cache: Use a cached result, if it is not older than cache_interval
+
+        :return: True if the host is reachable, else False.
+        :rtype: bool
+        """
+        return self.check_many([host], timeout=timeout, use_cache=use_cache)[host]
+
+    def check_many(self, hosts, timeout=1, use_cache=True):
+        """
+        Checks concurrently if hosts are reachable (blocks until all results are available)
+
+        Must not be called from the network loop, use the coroutine check_many_async() there.
+
+        :param hosts: List of host names or ip addresses (v4 or v6)
+        :param timeout: Seconds to wait for an answer of each host
+        :param use_cache: Use cached results, if they are not older than cache_interval
+
+        :return: Dict with the hosts as keys and True (reachable) or False as values
+        :rtype: dict
+        """
+        loop = NetworkLoop.get_instance()
+        if loop.in_loop_thread():
+            raise RuntimeError("check_many() must not be called from the network loop, use check_many_async()")
+        return loop.run_coroutine(self.check_many_async(hosts, timeout, use_cache)).result()
+
+    async def check_many_async(self, hosts, timeout=1, use_cache=True):
+        """
+        Coroutine version of check_many(), must run in the network loop
+        """
+        results = {}
+        pending = []
+        now = time.time()
+        for host in hosts:
+            cached = self._cache.get(host)
+            if use_cache and cached is not None and now - cached[1] < self.cache_interval:
+                results[host] = cached[0]
+            elif host not in pending:
+                pending.append(host)
+        if pending:
+            checked = await asyncio.gather(*[self._check_host(host, timeout) for host in pending])
+            now = time.time()
+            for host, result in zip(pending, checked):
+                self._cache[host] = (result, now)
+                results[host] = result
+        return results
+
+    async def _check_host(self, host, timeout):
+        self.probes += 1
+        try:
+            return await asyncio.wait_for(self._probe(host, timeout), timeout)
+        except asyncio.TimeoutError:
+            return False
+        except Exception as e:
+            self.logger.warning("Error checking reachability of {}: {}".format(host, e))
+            return False
+
+    async def _probe(self, host, timeout):
+        loop = asyncio.get_event_loop()
+        try:
+            family, socktype, proto, canonname, sockaddr = (await loop.getaddrinfo(host, None, type=socket.SOCK_STREAM))[0]
+        except OSError:
+            return False
+        ip = sockaddr[0]
+        probes = [asyncio.ensure_future(self._probe_tcp(ip, port)) for port in self.ports]
+        if family == socket.AF_INET and self._icmp_open():
+            probes.append(asyncio.ensure_future(self._probe_icmp(ip)))
+        elif self._ping_available:
+            probes.append(asyncio.ensure_future(self._probe_ping(ip, timeout)))
+        try:
+            for probe in asyncio.as_completed(probes):
+                if await probe:
+                    return True
+            return False
+        finally:
+            for probe in probes:
+                probe.cancel()
+
+    async def _probe_tcp(self, ip, port):
+        try:
+            transport, protocol = await asyncio.get_event_loop().create_connection(asyncio.Protocol, ip, port)
+        except ConnectionRefusedError:
+            # the host answered with a reset, so it is up
+            return True
+        except OSError:
+            return False
+        transport.close()
+        return True
+
+    def _icmp_open(self):
+        if self._icmp_available is None:
+            self._icmp_available = False
+            for sock_type in (socket.SOCK_DGRAM, socket.SOCK_RAW):
+                try:
+                    sock = socket.socket(socket.AF_INET, sock_type, socket.IPPROTO_ICMP)
+                except OSError:
+                    continue
+                sock.setblocking(False)
+                self._icmp_socket = sock
+                self._icmp_raw = sock_type == socket.SOCK_RAW
+                self._icmp_available = True
+                asyncio.get_event_loop().add_reader(sock.fileno(), self._icmp_read_ready)
+                NetworkLoop.get_instance().register_server(self)
+                break
+            if not self._icmp_available:
+                self.logger.info("ICMP sockets not permitted, checking reachability with the system ping command")
+        return self._icmp_available
+
+    async def _probe_icmp(self, ip):
+        self._icmp_seq = (self._icmp_seq + 1) & 0xffff
+        seq = self._icmp_seq
+        future = asyncio.get_event_loop().create_future()
+        self._icmp_waiting[seq] = (ip, future)
+        try:
+            self._icmp_socket.sendto(self._icmp_packet(seq), (ip, 0))
+            return await future
+        except OSError:
+            return False
+        finally:
+            self._icmp_waiting.pop(seq, None)
+
+    async def _probe_ping(self, ip, timeout):
+        try:
+            process = await asyncio.create_subprocess_exec('ping', '-c', '1', '-W', str(max(1, int(math.ceil(timeout)))), ip,
+                                                           stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL)
+        except OSError as e:
+            if self._ping_available:
+                self._ping_available = False
+                self.logger.warning("System ping command not available, checking reachability with TCP probes only: {}".format(e))
+            return False
+        try:
+            return await process.wait() == 0
+        finally:
+            if process.returncode is None:
+                # cancelled by the timeout
+                process.kill()
+                await process.wait()
+
+    def _icmp_packet(self, seq):
+        payload = b'SmartHomeNG'
+        checksum = self._icmp_checksum(struct.pack('!BBHHH', 8, 0, 0, self._icmp_id, seq) + payload)
+        return struct.pack('!BBHHH', 8, 0, checksum, self._icmp_id, seq) + payload
+
+    @staticmethod
+    def _icmp_checksum(data):
+        if len(data) % 2:
+            data += b'\0'
+        total = sum(struct.unpack('!{}H'.format(len(data) // 2), data))
+        total = (total >> 16) + (total & 0xffff)
+        total += total >> 16
+        return ~total & 0xffff
+
+    def _icmp_read_ready(self):
+        while True:
+            try:
+                data, address = self._icmp_socket.recvfrom(1024)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                self.logger.debug("Error receiving ICMP reply: {}".format(e))
+                return
+            if self._icmp_raw:
+                # raw sockets receive the ip header as well
+                data = data[(data[0] & 0x0f) * 4:]
+            if len(data) < 8 or data[0] != 0:
+                continue
+            icmp_type, code, checksum, icmp_id, seq = struct.unpack('!BBHHH', data[:8])
+            if self._icmp_raw and icmp_id != self._icmp_id:
+                continue
+            waiting = self._icmp_waiting.get(seq)
+            if waiting is not None and waiting[0] == address[0] and not waiting[1].done():
+                waiting[1].set_result(True)
+
+    async def wait_closed(self):
+        """ Closes the ICMP socket (coroutine, runs in the network loop) """
+        if self._icmp_socket is not None:
+            asyncio.get_event_loop().remove_reader(self._icmp_socket.fileno())
+            self._icmp_socket.close()
+            self._icmp_socket = None
+        self._icmp_available = None
+        NetworkLoop.get_instance().unregister_server(self)
@@ -24,11 +24,15 @@
 This file implements scenes in SmartHomeNG
 """
 
+import ast
+import datetime
+import json
 import logging
 import os.path
 import csv
+import threading
 
-from lib.item import Items
+from lib.item import Items, Item
 from lib.logic import Logics
 
 from lib.utils import Utils
@@ -66,8 +70,8 @@ class Scenes():
         self.items = Items.get_instance()
 
         self._scenes = {}
-        self._learned_values = {}
         self._scenes_dir = smarthome.base_dir + '/scenes/'
+        self._learned_values = LearnedValues(self._scenes_dir)
         if not os.path.isdir(self._scenes_dir):
             logger.warning("Directory scenes not found. Ignoring scenes.".format(self._scenes_dir))
             return
@@ -130,54 +134,93 @@ class Scenes():
             logger.warning(" - Problem evaluating: {} - {}".format(value, e))
             return value
         return rvalue
-        
-    
-    def _get_learned_value(self, scene, state, ditem):
+
+
+    def _compile(self, value):
+        """
+        Precompile a scene value expression at load time
+
+        Literal values (numbers, strings, lists, ...) are evaluated once, all other expressions
+        are compiled to bytecode, which is evaluated on every recall of the scene.
+
+        :param value: value expression to compile
+        :type value: str
+
+        :return: tuple (is_constant, constant value or code object)
+        :rtype: tuple
+        """
         try:
-            lvalue = self._learned_values[scene +'#'+ str(state) +'#'+ ditem.id()]
-        except:
-            return None
-        logger.debug(" - Return learned value {} for scene/state/ditem {}".format(lvalue, scene +'#'+ str(state) +'#'+ ditem.id()))
+            return (True, ast.literal_eval(value))
+        except Exception:
+            pass
+        try:
+            return (False, compile(value, '<scene value>', 'eval'))
+        except Exception as e:
+            logger.warning(" - Problem compiling: {} - {}".format(value, e))
+            return (True, value)
+
+
+    def _eval_compiled(self, value, compiled):
+        """
+        Evaluate a scene value that has been precompiled by _compile
+
+        :param value: value expression (returned if the evaluation fails)
+        :param compiled: tuple returned by _compile
+
+        :return: evaluated value
+        """
+        is_constant, code = compiled
+        if is_constant:
+            return code
+        sh = self._sh  # noqa
+        try:
+            return eval(code)
+        except Exception as e:
+            logger.warning(" - Problem evaluating: {} - {}".format(value, e))
+            return value
+
+
+    def _get_learned_value(self, scene, state, ditem):
+        lvalue = self._learned_values.get(scene, state, ditem.id())
+        if lvalue is not None:
+            logger.debug(" - Return learned value {} for scene/state/ditem {}".format(lvalue, scene +'#'+ str(state) +'#'+ ditem.id()))
         return lvalue
         
     
     def _set_learned_value(self, scene, state, ditem, lvalue):
-        self._learned_values[scene +'#'+ str(state) +'#'+ ditem.id()] = lvalue
+        if not self._learned_values.set(scene, state, ditem.id(), lvalue):
+            return
         logger.debug(" - Learned value {} for scene/state/ditem {}".format(lvalue, scene +'#'+ str(state) +'#'+ ditem.id()))
 
 
     def _save_learned_values(self, scene):
         """
-        Save learned values for the scene to a file to make them persistant
-        """
-        logger.info("Saving learned values for scene {}:".format(scene))
-        learned_dict = {}
-        for key in self._learned_values:
-            lvalue = self._learned_values[key]
-            kl = key.split('#')
-            fkey = kl[1]+'#'+kl[2]
-            learned_dict[fkey] = lvalue
-            logger.debug(" - Saving value {} for state/ditem {}".format(lvalue, fkey))
-        scene_learnfile = os.path.join(self._scenes_dir, scene+'_learned')
-        yaml.yaml_save(scene_learnfile+'.yaml', learned_dict)
+        Schedule saving of the learned values to make them persistant
+
+        The values are not written immediately. All scenes learned within the save delay
+        are written together (see class LearnedValues).
+        """
+        try:
+            next = self._sh.shtime.now() + datetime.timedelta(seconds=self._learned_values.save_delay)
+            self._sh.scheduler.add('scenes.save_learned_values', self.save_learned_values, next=next)
+        except Exception as e:
+            logger.warning("Unable to schedule saving of learned values for scene {}: {}".format(scene, e))
+            self.save_learned_values()
         return
-        
+
+
+    def save_learned_values(self):
+        """
+        Write the learned values of all scenes with changes to disk
+        """
+        self._learned_values.save()
+
 
     def _load_learned_values(self, scene):
         """
-        Load learned values for the scene from a file
+        Load learned values for the scene from its YAML file, if it has been edited
         """
-        self._learned_values = {}
-        scene_learnfile = os.path.join(self._scenes_dir, scene+'_learned')
-        learned_dict = yaml.yaml_load(scene_learnfile+'.yaml', ordered=False, ignore_notfound=True)
-        if learned_dict is not None:
-            if learned_dict != {}:
-                logger.info("Loading learned values for scene {}".format(scene))
-            for fkey in learned_dict:
-                key = scene + '#' + fkey
-                lvalue = learned_dict[fkey]
-                self._learned_values[key] = lvalue 
-                logger.debug(" - Loading value {} for state/ditem {}".format(lvalue, key))
+        self._learned_values.import_yaml(scene)
         return
         
 
@@ -186,7 +229,9 @@ class Scenes():
         Trigger: set values for a scene state
         """
         logger.info("Triggered scene {} ({}) with state {} ({}):".format(item.id(), str(item), state, self.get_scene_action_name(item.id(), state)))
-        for ditem, value, name, learn in self._scenes[item.id()][str(state)]:
+        updates = []
+        logics = []
+        for ditem, value, name, learn, compiled in self._scenes[item.id()][str(state)]:
             if learn:
                 lvalue = self._get_learned_value(item.id(), state, ditem)
                 if lvalue is not None:
@@ -194,16 +239,26 @@ class Scenes():
                 else:
                     rvalue = value
             else:
-                rvalue = self._eval(value)
+                rvalue = self._eval_compiled(value, compiled)
             if rvalue is not None:
                 if str(rvalue) == str(value):
                     logger.info(" - Item {} set to {}".format(ditem, rvalue))
                 else:
                     logger.info(" - Item {} set to {} ( from {} )".format(ditem, rvalue, value))
-                try:
-                    ditem(value=rvalue, caller='Scene', source=item.id())
-                except Exception as e:
-                    logger.warning(" - ditem '{}', value '{}', exception {}".format(ditem, rvalue, e))
+                if isinstance(ditem, Item):
+                    updates.append((ditem, rvalue))
+                else:
+                    logics.append((ditem, rvalue))
+        # set all items of the scene state first, then dispatch their triggers
+        try:
+            self.items.update_items(updates, caller='Scene', source=item.id())
+        except Exception as e:
+            logger.warning(" - scene '{}', state '{}', exception {}".format(item.id(), state, e))
+        for ditem, rvalue in logics:
+            try:
+                ditem(value=rvalue, caller='Scene', source=item.id())
+            except Exception as e:
+                logger.warning(" - ditem '{}', value '{}', exception {}".format(ditem, rvalue, e))
         return
         
 
@@ -212,7 +267,7 @@ class Scenes():
         Trigger: learn values for a scene state
         """
         logger.info("Triggered 'learn' for scene {} ({}), state {} ({}):".format(item.id(), str(item), state, self.get_scene_action_name(item.id(), state)))
-        for ditem, value, name, learn in self._scenes[item.id()][str(state)]:
+        for ditem, value, name, learn, compiled in self._scenes[item.id()][str(state)]:
             if learn:
                 self._set_learned_value(item.id(), state, ditem, ditem())
         self._save_learned_values(str(item.id()))
@@ -271,13 +326,14 @@ class Scenes():
                 logger.warning("Could not find item or logic '{}' specified in {}".format(ditemname, scene_file))
                 return
 
+        entry = [ditem, value, name, learn, self._compile(value)]
         if item.id() in self._scenes:
             if state in self._scenes[item.id()]:
-                self._scenes[item.id()][state].append([ditem, value, name, learn])
+                self._scenes[item.id()][state].append(entry)
             else:
-                self._scenes[item.id()][state] = [[ditem, value, name, learn]]
+                self._scenes[item.id()][state] = [entry]
         else:
-            self._scenes[item.id()] = {state: [[ditem, value, name, learn]]}
+            self._scenes[item.id()] = {state: [entry]}
         return
         
         
@@ -370,3 +426,151 @@ class Scenes():
             action_list.append(return_action)
         return action_list
 
+
+
+class LearnedValues():
+    """
+    Store for the learned values of all scenes
+
+    The learned values are held in memory and persisted in a single file
+    (``scenes/learned_values.json``), which is loaded once at startup. Learning
+    only marks a scene as dirty, ``save()`` writes the store and exports the values
+    of the dirty scenes to ``<scene>_learned.yaml`` for editing. If such a YAML file
+    has been changed after the store was written, it is imported at startup.
+
+    Only values that can be stored in JSON and YAML are learned (None, bool, numbers,
+    strings and lists or dicts of them, tuples are stored as lists). Other values are
+    not learned and a warning is logged.
+
+    :param scenes_dir: directory of the scene definitions
+    :type scenes_dir: str
+    """
+
+    save_delay = 5      # seconds to wait for further learn events before saving
+
+    _store_filename = 'learned_values.json'
+
+
+    def __init__(self, scenes_dir):
+        self._scenes_dir = scenes_dir
+        self._filename = os.path.join(scenes_dir, self._store_filename)
+        self._lock = threading.Lock()
+        self._values = {}       # scene -> {'state#ditem': value}
+        self._dirty = set()
+        self._mtime = 0
+        try:
+            with open(self._filename, 'r', encoding='UTF-8') as f:
+                self._values = json.load(f)
+            self._mtime = os.path.getmtime(self._filename)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.warning("Problem reading learned values from {}: {}".format(self._filename, e))
+
+
+    def _yaml_filename(self, scene):
+        return os.path.join(self._scenes_dir, scene+'_learned')
+
+
+    def get(self, scene, state, ditem):
+        try:
+            return self._values[scene][str(state) +'#'+ ditem]
+        except KeyError:
+            return None
+
+
+    def set(self, scene, state, ditem, value):
+        """
+        Learn a value
+
+        :return: True, if the value has been learned
+        :rtype: bool
+        """
+        try:
+            value = self._storable(value)
+        except ValueError as e:
+            logger.warning("Learned value for scene/state/ditem {} cannot be stored: {}".format(scene +'#'+ str(state) +'#'+ ditem, e))
+            return False
+        with self._lock:
+            self._values.setdefault(scene, {})[str(state) +'#'+ ditem] = value
+            self._dirty.add(scene)
+        return True
+
+
+    def _storable(self, value):
+        """
+        Return the value in a form that can be stored in JSON and YAML, raise ValueError if it cannot be stored
+        """
+        if value is None or isinstance(value, (bool, int, float, str)):
+            return value
+        if isinstance(value, (list, tuple)):
+            return [self._storable(v) for v in value]
+        if isinstance(value, dict):
+            for key in value:
+                if not isinstance(key, str):
+                    raise ValueError("key {!r} of type {} is not a string".format(key, type(key).__name__))
+            return {key: self._storable(v) for key, v in value.items()}
+        raise ValueError("{!r} of type {}".format(value, type(value).__name__))
+
+
+    def import_yaml(self, scene):
+        """
+        Import the learned values of a scene from its YAML file
+
+        The file is only read, if the scene is not in the store yet (migration) or if
+        the file has been edited after the store was written.
+        """
+        scene_learnfile = self._yaml_filename(scene)
+        try:
+            mtime = os.path.getmtime(scene_learnfile+'.yaml')
+        except OSError:
+            return
+        if scene in self._values and mtime <= self._mtime:
+            return
+        learned_dict = yaml.yaml_load(scene_learnfile+'.yaml', ordered=False, ignore_notfound=True)
+        if learned_dict is not None:
+            logger.info("Loading learned values for scene {} from {}".format(scene, scene_learnfile+'.yaml'))
+            values = {}
+            for key, value in learned_dict.items():
+                try:
+                    values[str(key)] = self._storable(value)
+                except ValueError as e:
+                    logger.warning("Ignoring learned value {} for scene {} from {}: {}".format(key, scene, scene_learnfile+'.yaml', e))
+            with self._lock:
+                self._values[scene] = values
+                self._dirty.add(scene)
+
+
+    def export_yaml(self, scene):
+        """
+        Export the learned values of a scene to its YAML file
+        """
+        try:
+            yaml.yaml_save(self._yaml_filename(scene)+'.yaml', dict(self._values.get(scene, {})))
+        except Exception as e:
+            logger.warning("Problem exporting learned values of scene {}: {}".format(scene, e))
+
+
+    def save(self):
+        """
+        Write the store and export the values of all scenes changed since the last save
+        """
+        with self._lock:
+            if not self._dirty:
+                return
+            dirty = sorted(self._dirty)
+            self._dirty = set()
+            data = json.dumps(self._values, separators=(',', ':'))
+        logger.info("Saving learned values for scene(s) {}".format(', '.join(dirty)))
+        try:
+            # export first, so the store is newer than the exported files
+            for scene in dirty:
+                self.export_yaml(scene)
+            with open(self._filename+'.tmp', 'w', encoding='UTF-8') as f:
+                f.write(data)
+            os.replace(self._filename+'.tmp', self._filename)
+            self._mtime = os.path.getmtime(self._filename)
+        except Exception as e:
+            logger.warning("Problem saving learned values to {}: {}".format(self._filename, e))
+            with self._lock:
+                self._dirty.update(dirty)
@@ -55,6 +55,9 @@ except:
     logger.critical("shyaml: ruamel.yaml is not installed")
     exit(1)
     
+# C based loader of libyaml (only available if ruamel.yaml has been built with libyaml)
+_CSafeLoader = getattr(yaml, 'CSafeLoader', None)
+
 yaml_version = '1.1'
 indent_spaces = 4
 block_seq_indent = 0
@@ -109,10 +112,7 @@ def yaml_load(filename, ordered=False, ignore_notfound=False):
         with open(filename, 'r') as stream:
             sdata = stream.read()
         sdata = sdata.replace('\n', '\n\n')
-        if ordered:
-            y = _ordered_load(sdata, yaml.SafeLoader)
-        else:
-            y = yaml.load(sdata, yaml.SafeLoader)
+        y = _load(sdata, ordered)
     except Exception as e:
         estr = str(e)
         if "found character '\\t'" in estr:
@@ -159,10 +159,7 @@ def yaml_load_fromstring(string, ordered=False):
     try:
         sdata = string
 #        sdata = sdata.replace('\n', '\n\n')
-        if ordered:
-            y = _ordered_load(sdata, yaml.SafeLoader)
-        else:
-            y = yaml.load(sdata, yaml.SafeLoader)
+        y = _load(sdata, ordered)
     except Exception as e:
         estr = str(e)
         if "found character '\\t'" in estr:
@@ -219,6 +216,35 @@ def _format_yaml_load(data):
     return data
     
 
+def _load(sdata, ordered=False):
+    """
+    Safe yaml loader, which uses the C based loader of libyaml if it is available
+
+    If the C based loader fails, the data is parsed again with the pure Python loader. It
+    raises the exception with the error message (and line numbers) the rest of this
+    module expects. Data the C based loader does not accept is handled the same way.
+
+    :param sdata: yaml data to parse
+    :param ordered: load to an OrderedDict?
+
+    :return: dict/OrderedDict structure
+    """
+    if _CSafeLoader is not None:
+        try:
+            return _safe_load(sdata, _CSafeLoader, ordered)
+        except Exception:
+            pass
+    return _safe_load(sdata, yaml.SafeLoader, ordered)
+
+
+def _safe_load(sdata, Loader, ordered):
+    if ordered:
+        return _ordered_load(sdata, Loader)
+    return yaml.load(sdata, Loader)
+
+
+_ordered_loaders = {}    # loader classes created by _ordered_load, keyed by (Loader, object_pairs_hook)
+
 def _ordered_load(stream, Loader=yaml.Loader, object_pairs_hook=OrderedDict):
     """
     Ordered yaml loader
@@ -232,14 +258,17 @@ def _ordered_load(stream, Loader=yaml.Loader, object_pairs_hook=OrderedDict):
     """
 
     # usage example: ordered_load(stream, yaml.SafeLoader)
-    class OrderedLoader(Loader):
-        pass
-    def construct_mapping(loader, node):
-        loader.flatten_mapping(node)
-        return object_pairs_hook(loader.construct_pairs(node))
-    OrderedLoader.add_constructor(
-        yaml.resolver.BaseResolver.DEFAULT_MAPPING_TAG,
-        construct_mapping)
+    OrderedLoader = _ordered_loaders.get((Loader, object_pairs_hook))
+    if OrderedLoader is None:
+        class OrderedLoader(Loader):
+            pass
+        def construct_mapping(loader, node):
+            loader.flatten_mapping(node)
+            return object_pairs_hook(loader.construct_pairs(node))
+        OrderedLoader.add_constructor(
+            yaml.resolver.BaseResolver.DEFAULT_MAPPING_TAG,
+            construct_mapping)
+        _ordered_loaders[(Loader, object_pairs_hook)] = OrderedLoader
     return yaml.load(stream, OrderedLoader)
 
 
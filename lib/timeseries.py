@@ -0,0 +1,661 @@
+#!/usr/bin/env python3
+# vim: set encoding=utf-8 tabstop=4 softtabstop=4 shiftwidth=4 expandtab
+#########################################################################
+#  Copyright 2018-      Martin Sinn                         m.sinn@gmx.de
+#########################################################################
+#  This file is part of SmartHomeNG.    https://github.com/smarthomeNG//
+#
+#  SmartHomeNG is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  SmartHomeNG is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with SmartHomeNG. If not, see <http://www.gnu.org/licenses/>.
+#########################################################################
+
+"""
+This file implements the embedded time-series store of SmartHomeNG
+
+Items take part by setting the attribute ``timeseries: yes``. Every value of such an item
+is stored with its timestamp and is aggregated to rollups with a resolution of one minute,
+one hour and one day (min, max, avg and number of values). Old data is removed per tier
+after a configurable number of days, so the raw values can be kept for a short time only
+while the rollups are kept for a long time.
+
+The data of an item is stored in the directory var/timeseries/<item path>. Each tier is
+partitioned in files by time (raw and 1m: one file per day, 1h: per month, 1d: per year).
+A file consists of columnar blocks, each of them holding a number of rows::
+
+    header:     magic 'TSB1', number of columns (uint16), number of rows (uint32),
+                timestamp of the first row (int64, ms since epoch)
+    timestamps: delta to the previous row for each row (int64)
+    columns:    the values of each column (float64)
+
+All numbers are little endian. Buckets of the rollups are aligned to UTC.
+
+The query API is used the following way:
+
+.. code-block:: python
+
+    from lib.timeseries import TimeSeries
+    ts = TimeSeries.get_instance()
+
+    # the last 24 hours in an appropriate resolution
+    ts.query('wohnung.temperatur', '24h')
+"""
+
+import datetime
+import json
+import logging
+import os
+import re
+import struct
+import sys
+import threading
+import time
+from array import array
+from itertools import accumulate
+
+from lib.item import Items
+from lib.utils import Utils
+
+
+logger = logging.getLogger(__name__)
+
+_timeseries_instance = None    # Pointer to the initialized instance of the TimeSeries class (for use by static methods)
+
+
+KEY_TIMESERIES = 'timeseries'
+
+TIERS = ['raw', '1m', '1h', '1d']
+ROLLUPS = ['1m', '1h', '1d']
+BUCKET_SIZE = {'1m': 60000, '1h': 3600000, '1d': 86400000}
+PARTITION_FORMAT = {'raw': '%Y%m%d', '1m': '%Y%m%d', '1h': '%Y%m', '1d': '%Y'}
+DEFAULT_RETENTION = {'raw': 7, '1m': 90, '1h': 730, '1d': 0}
+
+FILE_EXTENSION = '.tsb'
+STATE_FILE = 'state.json'
+
+_MAGIC = b'TSB1'
+_HEADER = struct.Struct('<4sHIq')
+_DURATION = re.compile(r'^(\d+(?:\.\d+)?)\s*([smhdw])$')
+_DURATION_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+
+
+class TimeSeries():
+    """
+    Stores the values of items in chunked, columnar files and aggregates them to rollups
+
+    :param smarthome: Main SmartHomeNG object
+    :param data_dir: directory for the data files (default: var/timeseries)
+    :param retention: dict with the number of days to keep data for each tier (0 keeps the data forever)
+    :param chunk_size: number of buffered raw values of an item, that triggers writing a block (by a scheduler worker)
+    :param flush_interval: seconds between writing all buffered values
+    :type smarthome: object
+    :type data_dir: str
+    :type retention: dict
+    :type chunk_size: int
+    :type flush_interval: int
+    """
+
+    def __init__(self, smarthome, data_dir=None, retention=None, chunk_size=1024, flush_interval=300):
+        self._sh = smarthome
+
+        global _timeseries_instance
+        if _timeseries_instance is not None:
+            import inspect
+            curframe = inspect.currentframe()
+            calframe = inspect.getouterframes(curframe, 2)
+            logger.critical("A second 'timeseries' object has been created. There should only be ONE instance of class 'TimeSeries'!!! Called from: {} ({})".format(calframe[1][1], calframe[1][3]))
+
+        _timeseries_instance = self
+
+        if data_dir is None:
+            data_dir = os.path.join(smarthome._var_dir, 'timeseries')
+        self._data_dir = data_dir
+        self._retention = dict(DEFAULT_RETENTION)
+        if retention is not None:
+            self._retention.update(retention)
+        self.chunk_size = chunk_size
+        self.flush_interval = flush_interval
+        self._series = {}
+        self._lock = threading.Lock()
+
+
+    @staticmethod
+    def get_instance():
+        """
+        Returns the instance of the TimeSeries class, to be used to access the time-series api
+
+        :return: timeseries instance
+        :rtype: object or None
+        """
+        return _timeseries_instance
+
+
+    def start(self):
+        """
+        Registers all items with the attribute 'timeseries' and schedules the maintenance
+        (writing buffered values and removing old data)
+        """
+        items = Items.get_instance()
+        if items is not None:
+            for item in items.return_items():
+                if Utils.to_bool(item.conf.get(KEY_TIMESERIES, False), default=False):
+                    self.register(item)
+        logger.info("Time series: {} items registered".format(len(self._series)))
+        scheduler = getattr(self._sh, 'scheduler', None)
+        if scheduler is not None and self._series:
+            scheduler.add('sh.timeseries', self.maintenance, prio=8, cycle=self.flush_interval, offset=self.flush_interval)
+
+
+    def stop(self):
+        """
+        Writes all buffered values and the state of the open rollup buckets
+        """
+        self.flush()
+
+
+    def register(self, item):
+        """
+        Stores the values of an item from now on
+
+        :param item: item object
+        :return: True, if the item has been registered
+        :rtype: bool
+        """
+        if item.type() not in ['num', 'bool']:
+            logger.warning("Time series: item '{}' has type '{}', only items of type 'num' or 'bool' can be stored".format(item.id(), item.type()))
+            return False
+        with self._lock:
+            if item.id() in self._series:
+                return True
+            self._series[item.id()] = _Series(os.path.join(self._data_dir, item.id()))
+        item.add_method_trigger(self._item_changed)
+        return True
+
+
+    def registered_items(self):
+        """
+        Returns the pathes of the registered items
+
+        :rtype: list
+        """
+        return sorted(self._series)
+
+
+    def add(self, path, value, timestamp=None):
+        """
+        Adds a value to the time series of an item
+
+        :param path: path of the item
+        :param value: value to store
+        :param timestamp: time of the value (datetime or seconds since epoch, default: now)
+        """
+        ts = _to_ms(timestamp) if timestamp is not None else int(time.time() * 1000)
+        directory = self._directory(path)
+        if directory is None:
+            raise ValueError("Invalid item path '{}'".format(path))
+        with self._lock:
+            series = self._series.get(path)
+            if series is None:
+                series = self._series[path] = _Series(directory)
+        with series.lock:
+            series.add(ts, float(value))
+            write = not series.write_queued and len(series.buffers['raw'][0]) >= self.chunk_size
+            if write:
+                series.write_queued = True
+        scheduler = getattr(self._sh, 'scheduler', None)
+        if write and scheduler is not None:
+            # the block is written by a worker of the scheduler, not by the thread updating the item
+            scheduler.trigger('sh.timeseries.write', self._write_series, value={'path': path}, prio=8)
+
+
+    def _write_series(self, path):
+        series = self._series.get(path)
+        if series is None:
+            return
+        try:
+            series.write_buffers()
+        except OSError as e:
+            logger.error("Time series: unable to write data of item '{}': {}".format(path, e))
+
+
+    def _item_changed(self, item, caller, source, dest):
+        try:
+            self.add(item.id(), item())
+        except Exception as e:
+            logger.error("Time series: unable to store value of item '{}': {}".format(item.id(), e))
+
+
+    def flush(self):
+        """
+        Writes the buffered values of all items
+        """
+        with self._lock:
+            series_list = list(self._series.items())
+        for path, series in series_list:
+            try:
+                series.write_buffers()
+                series.save_state()
+            except OSError as e:
+                logger.error("Time series: unable to write data of item '{}': {}".format(path, e))
+
+
+    def expire(self, now=None):
+        """
+        Removes the data files, which are older than the retention period of their tier
+
+        :param now: reference time (datetime or seconds since epoch, default: now)
+        :return: number of removed files
+        :rtype: int
+        """
+        now = _to_ms(now) if now is not None else int(time.time() * 1000)
+        cutoff = {tier: _partition(tier, now - days * 86400000) for tier, days in self._retention.items() if days}
+        removed = 0
+        if not os.path.isdir(self._data_dir):
+            return removed
+        for path in os.listdir(self._data_dir):
+            directory = os.path.join(self._data_dir, path)
+            for filename in _list_files(directory):
+                tier, key = filename[:-len(FILE_EXTENSION)].split('-', 1)
+                if tier in cutoff and key < cutoff[tier]:
+                    try:
+                        os.remove(os.path.join(directory, filename))
+                        series = self._series.get(path)
+                        if series is not None:
+                            series.forget_file(filename)
+                        removed += 1
+                    except OSError as e:
+                        logger.error("Time series: unable to remove '{}': {}".format(filename, e))
+        return removed
+
+
+    def maintenance(self):
+        """
+        Writes all buffered values and removes old data, called by the scheduler
+        """
+        self.flush()
+        removed = self.expire()
+        if removed:
+            logger.info("Time series: {} expired data files removed".format(removed))
+
+
+    def query(self, item, start, end=None, resolution=None, max_points=1000):
+        """
+        Returns the values of an item in a time range
+
+        start and end are given as datetime, as seconds since epoch or as duration back from
+        now (e.g. '30m', '24h', '7d', '2w').
+
+        Without a resolution, the finest tier is selected, which returns not more than max_points
+        rows and which still holds data for the start of the range. Raw values are only selected
+        for ranges of up to max_points seconds.
+
+        :param item: item object or item path
+        :param start: start of the range
+        :param end: end of the range (default: now)
+        :param resolution: 'raw', '1m', '1h', '1d' or None to select it by the length of the range
+        :param max_points: maximum number of rows for selecting the resolution
+        :type item: object or str
+        :type resolution: str
+        :type max_points: int
+
+        Only registered items and items with stored data (e.g. removed items) can be queried,
+        a KeyError is raised for other pathes. The files are read without holding a lock, only
+        up to the size they had when the buffered rows were taken (see _Series.snapshot).
+
+        :return: rows of (timestamp in ms, value) for raw values or (timestamp in ms, min, max, avg) for rollups
+        :rtype: list
+        """
+        path = item if isinstance(item, str) else item.id()
+        now = int(time.time() * 1000)
+        start = _to_ms(start, now)
+        end = _to_ms(end, now) if end is not None else now
+        if resolution is None:
+            resolution = self.select_resolution(start, end, max_points)
+        elif resolution not in TIERS:
+            raise ValueError("Unknown resolution '{}', valid resolutions are {}".format(resolution, TIERS))
+
+        with self._lock:
+            series = self._series.get(path)
+            if series is None:
+                # not registered (e.g. removed item), but the open buckets may have been saved
+                directory = self._directory(path)
+                if directory is None or not os.path.isdir(directory):
+                    raise KeyError("No time series for item '{}'".format(path))
+                series = _Series(directory)
+        pending, sizes = series.snapshot(resolution, start, end)
+        rows = _read_rows(series.directory, resolution, start, end, sizes)
+        rows.extend(row for row in pending if start <= row[0] <= end)
+        rows.sort(key=lambda row: row[0])
+        if resolution == 'raw':
+            return [(row[0], row[1]) for row in rows]
+        return [(row[0], row[1], row[2], row[3]) for row in rows]
+
+
+    def select_resolution(self, start, end=None, max_points=1000):
+        """
+        Returns the resolution query() selects for a time range without a given resolution
+
+        :return: 'raw', '1m', '1h' or '1d'
+        :rtype: str
+        """
+        now = int(time.time() * 1000)
+        start = _to_ms(start, now)
+        end = _to_ms(end, now) if end is not None else now
+        span = (end - start) / 1000
+        if span <= max_points and self._covers('raw', start, now):
+            return 'raw'
+        for tier in ROLLUPS:
+            if span * 1000 / BUCKET_SIZE[tier] <= max_points and self._covers(tier, start, now):
+                return tier
+        return '1d'
+
+
+    def _directory(self, path):
+        """
+        Returns the data directory of an item path or None, if the path does not resolve to a
+        directory directly within the data directory
+        """
+        if not path or path in ('.', '..') or '/' in path or os.sep in path:
+            return None
+        directory = os.path.join(self._data_dir, path)
+        if os.path.dirname(os.path.realpath(directory)) != os.path.realpath(self._data_dir):
+            return None
+        return directory
+
+
+    def _covers(self, tier, start, now):
+        days = self._retention.get(tier, 0)
+        return not days or start >= now - days * 86400000
+
+
+class _Series():
+    """
+    Buffers and aggregates the values of one item
+
+    buffers holds for each tier a list of timestamps and a list of rows with the column values,
+    buckets holds for each rollup the open bucket as [start, min, max, sum, count].
+
+    lock guards the buffers, the buckets and the sizes of the files. While write_buffers()
+    writes rows to the files without holding the lock, the rows are kept in _writing, so they
+    are still returned by pending(). _sizes holds the size of the files, up to which they only
+    contain rows that are not pending any more.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.write_queued = False
+        self.buffers = self._empty_buffers()
+        self.buckets = {tier: None for tier in ROLLUPS}
+        self._writing = self._empty_buffers()
+        self._write_lock = threading.Lock()
+        self._sizes = {}
+        self.load_state()
+
+
+    @staticmethod
+    def _empty_buffers():
+        return {tier: ([], []) for tier in TIERS}
+
+
+    def add(self, ts, value):
+        self._append('raw', ts, (value, ))
+        self._aggregate(0, ts - ts % BUCKET_SIZE[ROLLUPS[0]], value, value, value, 1)
+
+
+    def _append(self, tier, ts, columns):
+        timestamps, rows = self.buffers[tier]
+        timestamps.append(ts)
+        rows.append(columns)
+
+
+    def _aggregate(self, level, start, vmin, vmax, vsum, count):
+        tier = ROLLUPS[level]
+        bucket = self.buckets[tier]
+        if bucket is not None and bucket[0] == start:
+            bucket[1] = min(bucket[1], vmin)
+            bucket[2] = max(bucket[2], vmax)
+            bucket[3] += vsum
+            bucket[4] += count
+            return
+        if bucket is not None:
+            self._close_bucket(level, bucket)
+        self.buckets[tier] = [start, vmin, vmax, vsum, count]
+
+
+    def _close_bucket(self, level, bucket):
+        start, vmin, vmax, vsum, count = bucket
+        self._append(ROLLUPS[level], start, (vmin, vmax, vsum / count, count))
+        if level + 1 < len(ROLLUPS):
+            size = BUCKET_SIZE[ROLLUPS[level + 1]]
+            self._aggregate(level + 1, start - start % size, vmin, vmax, vsum, count)
+
+
+    def pending(self, tier):
+        """
+        Returns the buffered rows of a tier (including the open bucket of a rollup), called with the lock held
+        """
+        pending = []
+        for buffers in (self._writing, self.buffers):
+            timestamps, rows = buffers[tier]
+            pending.extend((ts, ) + tuple(row) for ts, row in zip(timestamps, rows))
+        if tier in ROLLUPS:
+            # the open buckets of the finer rollups have not been aggregated into this rollup yet
+            size = BUCKET_SIZE[tier]
+            merged = {}
+            for bucket in [self.buckets[rollup] for rollup in ROLLUPS[:ROLLUPS.index(tier) + 1]]:
+                if bucket is None:
+                    continue
+                start = bucket[0] - bucket[0] % size
+                if start in merged:
+                    m = merged[start]
+                    merged[start] = [start, min(m[1], bucket[1]), max(m[2], bucket[2]), m[3] + bucket[3], m[4] + bucket[4]]
+                else:
+                    merged[start] = [start] + bucket[1:]
+            pending.extend((start, vmin, vmax, vsum / count, count) for start, vmin, vmax, vsum, count in merged.values())
+        return pending
+
+
+    def snapshot(self, tier, start, end):
+        """
+        Returns the pending rows of a tier and the sizes up to which the partition files of
+        the time range can be read without returning pending rows twice
+
+        :return: tuple of (pending rows, dict of filename and size)
+        """
+        first, last = _partition(tier, start), _partition(tier, end)
+        with self.lock:
+            sizes = {}
+            for filename in _list_files(self.directory):
+                file_tier, key = filename[:-len(FILE_EXTENSION)].split('-', 1)
+                if file_tier == tier and first <= key <= last:
+                    size = self._sizes.get(filename)
+                    if size is None:
+                        # no write in progress, the file holds no pending rows
+                        size = _file_size(os.path.join(self.directory, filename))
+                    sizes[filename] = size
+            return self.pending(tier), sizes
+
+
+    def forget_file(self, filename):
+        """
+        Forgets the size of a removed file
+        """
+        with self.lock:
+            self._sizes.pop(filename, None)
+
+
+    def write_buffers(self):
+        """
+        Appends the buffered rows of all tiers as blocks to the partition files
+
+        The files are written without holding the lock, so adding values and queries are not blocked.
+        """
+        with self._write_lock:
+            with self.lock:
+                self._writing = self.buffers
+                self.buffers = self._empty_buffers()
+                self.write_queued = False
+            blocks = []
+            for tier in TIERS:
+                timestamps, rows = self._writing[tier]
+                partitions = {}
+                for ts, row in zip(timestamps, rows):
+                    partition = partitions.setdefault(_partition(tier, ts), ([], []))
+                    partition[0].append(ts)
+                    partition[1].append(row)
+                for key, (part_timestamps, part_rows) in partitions.items():
+                    blocks.append(('{}-{}{}'.format(tier, key, FILE_EXTENSION), _encode_block(part_timestamps, part_rows)))
+            if not blocks:
+                return
+            try:
+                os.makedirs(self.directory, exist_ok=True)
+                with self.lock:
+                    # queries read the files only up to the size they have before they are written
+                    for filename, data in blocks:
+                        if filename not in self._sizes:
+                            self._sizes[filename] = _file_size(os.path.join(self.directory, filename))
+                for filename, data in blocks:
+                    with open(os.path.join(self.directory, filename), 'ab') as f:
+                        f.write(data)
+                        size = f.tell()
+                    with self.lock:
+                        self._sizes[filename] = size
+            except OSError:
+                with self.lock:
+                    # keep the rows, they are written with the next flush
+                    for tier in TIERS:
+                        self.buffers[tier] = (self._writing[tier][0] + self.buffers[tier][0], self._writing[tier][1] + self.buffers[tier][1])
+                    self._writing = self._empty_buffers()
+                raise
+            with self.lock:
+                self._writing = self._empty_buffers()
+
+
+    def save_state(self):
+        """
+        Saves the open rollup buckets, so aggregation continues after a restart
+        """
+        with self.lock:
+            if all(bucket is None for bucket in self.buckets.values()):
+                return
+            state = json.dumps(self.buckets)
+        os.makedirs(self.directory, exist_ok=True)
+        filename = os.path.join(self.directory, STATE_FILE)
+        with open(filename + '.tmp', 'w') as f:
+            f.write(state)
+        os.replace(filename + '.tmp', filename)
+
+
+    def load_state(self):
+        try:
+            with open(os.path.join(self.directory, STATE_FILE)) as f:
+                buckets = json.load(f)
+        except (OSError, ValueError):
+            return
+        for tier in ROLLUPS:
+            if isinstance(buckets.get(tier), list) and len(buckets[tier]) == 5:
+                self.buckets[tier] = buckets[tier]
+
+
+def _encode_block(timestamps, rows):
+    """
+    Encodes rows as one columnar block
+    """
+    deltas = array('q', [0])
+    deltas.extend(b - a for a, b in zip(timestamps, timestamps[1:]))
+    columns = [array('d', column) for column in zip(*rows)]
+    if sys.byteorder == 'big':
+        deltas.byteswap()
+        for column in columns:
+            column.byteswap()
+    return _HEADER.pack(_MAGIC, len(columns), len(timestamps), timestamps[0]) + deltas.tobytes() + b''.join(column.tobytes() for column in columns)
+
+
+def _decode_blocks(data):
+    """
+    Decodes all blocks of a file, yields the rows of each block as (timestamp, column values...)
+    """
+    offset = 0
+    while offset + _HEADER.size <= len(data):
+        magic, ncolumns, nrows, first = _HEADER.unpack_from(data, offset)
+        offset += _HEADER.size
+        size = nrows * 8
+        if magic != _MAGIC or offset + size * (ncolumns + 1) > len(data):
+            logger.warning("Time series: ignoring damaged data after offset {}".format(offset - _HEADER.size))
+            return
+        deltas = array('q', data[offset:offset + size])
+        offset += size
+        columns = []
+        for i in range(ncolumns):
+            columns.append(array('d', data[offset:offset + size]))
+            offset += size
+        if sys.byteorder == 'big':
+            deltas.byteswap()
+            for column in columns:
+                column.byteswap()
+        deltas[0] = first
+        yield zip(accumulate(deltas), *columns)
+
+
+def _read_rows(directory, tier, start, end, sizes):
+    """
+    Reads the rows of a tier in a time range from the partition files (each up to the given size)
+    """
+    rows = []
+    for filename, size in sizes.items():
+        try:
+            with open(os.path.join(directory, filename), 'rb') as f:
+                data = f.read(size)
+        except OSError:
+            # removed by expire()
+            continue
+        for block in _decode_blocks(data):
+            rows.extend(row for row in block if start <= row[0] <= end)
+    return rows
+
+
+def _file_size(filename):
+    try:
+        return os.path.getsize(filename)
+    except OSError:
+        return 0
+
+
+def _list_files(directory):
+    try:
+        return [filename for filename in os.listdir(directory) if filename.endswith(FILE_EXTENSION) and '-' in filename]
+    except OSError:
+        return []
+
+
+def _partition(tier, ts):
+    return time.strftime(PARTITION_FORMAT[tier], time.gmtime(ts / 1000))
+
+
+def _to_ms(value, now=None):
+    """
+    Converts a datetime, seconds since epoch or a duration back from now to ms since epoch
+    """
+    if isinstance(value, datetime.datetime):
+        return int(value.timestamp() * 1000)
+    if isinstance(value, str):
+        match = _DURATION.match(value.strip())
+        if match:
+            if now is None:
+                now = int(time.time() * 1000)
+            return now - int(float(match.group(1)) * _DURATION_UNITS[match.group(2)] * 1000)
+        try:
+            value = float(value)
+        except ValueError:
+            raise ValueError("Invalid time '{}', use a datetime, seconds since epoch or a duration like '24h'".format(value))
+    return int(value * 1000)
@@ -28,14 +28,14 @@ This library contains the Tools-class from the original smarthome.py
 
 """
 
-import base64
 import datetime
-import http.client
 import logging
 import math
-import subprocess
+import requests
 import time
 
+import lib.network
+
 logger = logging.getLogger(__name__)
 
 
@@ -44,15 +44,11 @@ class Tools():
     def __init__(self):
         self._start = datetime.datetime.now()
 
-    def ping(self, host):
-        try:
-            retcode = subprocess.call("ping -W 1 -c 1 " + host + " > /dev/null", shell=True)
-            if retcode == 0:
-                return True
-            else:
-                return False
-        except OSError:
-            return False
+    def ping(self, host, use_cache=False):
+        return lib.network.Reachability.get_instance().check(host, use_cache=use_cache)
+
+    def ping_many(self, hosts, use_cache=False):
+        return lib.network.Reachability.get_instance().check_many(hosts, use_cache=use_cache)
 
     def dewpoint(self, t, rf):
         log = math.log((rf + 0.01) / 100)  # + 0.01 to 'cast' float
@@ -64,39 +60,24 @@ class Tools():
     def dt2ts(self, dt):
         return time.mktime(dt.timetuple())
 
-    def fetch_url(self, url, username=None, password=None, timeout=2, warn_no_connect=1, method = 'GET', body=None, errorItem = None):
-        connErrors = ['Host is down', 'timed out', '[Errno 113] No route to host']
+    def fetch_url(self, url, username=None, password=None, timeout=2, warn_no_connect=1, method = 'GET', body=None, errorItem = None, cache_ttl=None):
         headers = {'Accept': 'text/plain'}
-        plain = True
-        if url.startswith('https'):
-            plain = False
-        lurl = url.split('/')
-        host = lurl[2]
-        purl = '/' + '/'.join(lurl[3:])
-        if plain:
-            conn = http.client.HTTPConnection(host, timeout=timeout)
-        else:
-            conn = http.client.HTTPSConnection(host, timeout=timeout)
-        if username and password:
-            headers['Authorization'] = ('Basic '.encode() + base64.b64encode((username + ':' + password).encode()))
+        auth = (username, password) if username and password else None
         try:
-            conn.request(method, purl, body, headers)
+            resp = lib.network.HttpClient.get_instance().request(method, url, data=body, headers=headers, auth=auth, timeout=timeout, cache_ttl=cache_ttl)
         except Exception as e:
-            if format(e) in connErrors:
+            if isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
                 # diese fehler bekommen einen status, der in der visu oder sonst genutzt werden kann
                 if errorItem != None:
                     errorItem(True,'_fetch_url')
             if warn_no_connect == 1:
                 logger.warning("Problem fetching {0}: {1}".format(url, e))
-            conn.close()
             return False
-        resp = conn.getresponse()
-        if resp.status == 200:
-            content = resp.read()
+        if resp.status_code == 200:
+            content = resp.content
         else:
-            logger.warning("Problem fetching {0}: {1} {2}".format(url, resp.status, resp.reason))
+            logger.warning("Problem fetching {0}: {1} {2}".format(url, resp.status_code, resp.reason))
             content = False
-        conn.close()
         return content
 
     def rel2abs(self, t, rf):
@@ -31,6 +31,7 @@ import logging
 
 import re
 import hashlib
+import hmac
 import ipaddress
 import socket
 
@@ -353,9 +354,7 @@ class Utils(object):
         :rtype: str
         """
 
-        hashfunc = hashlib.sha512()
-        hashfunc.update(plaintext.encode())
-        return "".join(format(b, "02x") for b in hashfunc.digest())
+        return hashlib.sha512(plaintext.encode()).hexdigest()
 
     @staticmethod
     def is_hash(value):
@@ -401,7 +400,8 @@ class Utils(object):
 
         # todo: check pwd_to_check for minimum length? <- msinn: not here, password policy at a central point
 
-        return Utils.create_hash(pwd_to_check) == hashed_pwd.lower()
+        # constant-time comparison, to not reveal how many characters of the hash matched
+        return hmac.compare_digest(Utils.create_hash(pwd_to_check).encode(), hashed_pwd.lower().encode())
 
     @staticmethod
     def strip_quotes(string):
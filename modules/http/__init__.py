@@ -20,16 +20,37 @@
 #########################################################################
 
 
+import gzip
+import hashlib
+import hmac
+import json
 import logging
+import mimetypes
 import os
+import queue
+import re
+import stat
+import threading
 import time
+import urllib.parse
+import uuid
+import weakref
 from collections import OrderedDict
 
 import cherrypy
-from jinja2 import Environment, FileSystemLoader
+import cherrypy.lib.httputil
+import cherrypy.lib.static
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
 
+from lib.item import Items
+from lib.timeseries import TimeSeries
 from lib.utils import Utils
 
+try:
+    import brotli
+except ImportError as e:
+    brotli = None  # noqa
+
 
 class Http():
 
@@ -92,6 +113,8 @@ class Http():
             self._showtraceback = self._parameters['showtraceback']
 
             self._starturl = self._parameters['starturl']
+            self._gstatic_max_age = self._parameters['gstatic_max_age']
+            self._template_autoreload = self._parameters['template_autoreload']
         except:
             self.logger.critical("Module '{}': Inconsistent module (invalid metadata definition)".format(self._shortname))
             self._init_complete = False
@@ -129,6 +152,8 @@ class Http():
         if self._servicesport == 0:
             self._servicesport = self._port
 
+        self._credentials = _CredentialCache()
+
 #        self._basic_auth = False
         if self._ip == '0.0.0.0':
             self._ip = self._get_local_ip_address()
@@ -175,9 +200,17 @@ class Http():
 
         self._build_hostmaps()
         
-        self.tplenv = Environment(loader=FileSystemLoader(os.path.join( self.webif_dir, 'templates' ) ))
+        # Template environments of the module and of all plugin webifs share one bytecode cache
+        self._bytecode_cache = _TemplateBytecodeCache(os.path.join(self._sh._var_dir, 'http', 'templates'))
+        self._template_env = Environment(loader=FileSystemLoader(self.gtemplates_dir), bytecode_cache=self._bytecode_cache, auto_reload=self._template_autoreload)
+        self.tplenv = self.create_template_environment([os.path.join( self.webif_dir, 'templates' )])
 
         self._gstatic_dir = self.webif_dir + '/gstatic'
+
+        # Serve the global static files precompressed, the compressed variants are built in the background
+        self.assets = StaticAssets(self._gstatic_dir, os.path.join(self._sh._var_dir, 'http', 'gstatic'), self._gstatic_max_age)
+        cherrypy.tools.gstatic = cherrypy._cptools.HandlerTool(self.assets.serve)
+        threading.Thread(target=self.assets.build, name='http.assets', daemon=True).start()
         
         self.module_conf = {
             '/': {
@@ -188,8 +221,7 @@ class Http():
                 'request.dispatch': cherrypy.dispatch.VirtualHost(**self._hostmap),
             },
             '/gstatic': {
-                'tools.staticdir.on': True,
-                'tools.staticdir.dir': 'gstatic',
+                'tools.gstatic.on': True,
             },
             '/static': {
                 'tools.staticdir.on': True,
@@ -202,8 +234,7 @@ class Http():
                 'tools.staticdir.root': self.webif_dir,
             },
             '/gstatic': {
-                'tools.staticdir.on': True,
-                'tools.staticdir.dir': 'gstatic',
+                'tools.gstatic.on': True,
             },
             '/static': {
                 'tools.staticdir.on': True,
@@ -235,8 +266,7 @@ class Http():
                 'tools.staticdir.dir': 'static'
             },
             '/gstatic': {
-                'tools.staticdir.on': True,
-                'tools.staticdir.dir': 'gstatic',
+                'tools.gstatic.on': True,
             }
         }
         config_services = {
@@ -266,6 +296,11 @@ class Http():
             self.register_service(self.root.services, 'services', config) 
 #                                  pluginclass='', instance='', description='', servicename='')
 
+        # Register the item change stream as a cherrypy app
+        self.item_stream = ItemChangeStream(self._sh)
+        self.root.items = _ItemStreamApp(self)
+        self.register_webif(self.root.items, 'items', {'/': dict(config['/'])})
+
         return
 
 
@@ -275,10 +310,14 @@ class Http():
         if username != self._user or password is None or password == '':
             return False
 
+        return self._credentials.verify(realm, username, password, self._check_password)
+
+
+    def _check_password(self, password):
         if self._hashed_password is not None:
             return Utils.check_hashed_password(password, self._hashed_password)
         elif self._password is not None:
-            return password == self._password
+            return hmac.compare_digest(password.encode(), self._password.encode())
 
         return False
 
@@ -289,14 +328,40 @@ class Http():
         if username != self._service_user or password is None or password == '':
             return False
 
+        return self._credentials.verify(realm, username, password, self._check_service_password)
+
+
+    def _check_service_password(self, password):
         if self._service_hashed_password is not None:
             return Utils.check_hashed_password(password, self._service_hashed_password)
         elif self._service_password is not None:
-            return password == self._service_password
+            return hmac.compare_digest(password.encode(), self._service_password.encode())
 
         return False
 
 
+    def create_template_environment(self, template_dirs):
+        """
+        Creates a Jinja2 template environment (used for the webinterfaces of the plugins)
+
+        The environment searches the given directories and the global templates directory
+        (gtemplates). All environments share one bytecode cache under var/http/templates.
+        Templates are only checked for changes, if the parameter template_autoreload is set.
+
+        :param template_dirs: directories to search for templates before gtemplates
+        :type template_dirs: list
+
+        :return: Jinja2 template engine environment
+        :rtype: jinja2.Environment
+        """
+        tplenv = self._template_env.overlay(loader=FileSystemLoader(list(template_dirs) + [self.gtemplates_dir]))
+        # the overlay shares the globals, filters and tests dicts with the base environment, give it its own
+        tplenv.globals = dict(self._template_env.globals)
+        tplenv.filters = dict(self._template_env.filters)
+        tplenv.tests = dict(self._template_env.tests)
+        return tplenv
+
+
     def _error_page(self, status, message, traceback, version):
         """
         Generate html page for errors
@@ -549,8 +614,7 @@ class Http():
             conf['/']['tools.auth_basic.checkpassword'] = self.validate_password
             
         conf['/gstatic'] = {}
-        conf['/gstatic']['tools.staticdir.on'] = True
-        conf['/gstatic']['tools.staticdir.dir'] = self._gstatic_dir
+        conf['/gstatic']['tools.gstatic.on'] = True
 
         self.logger.info("Module http: Registering webinterface '{}' of plugin '{}' from pluginclass '{}' instance '{}'".format( webifname, pluginname, pluginclass, instance ) )
         self.logger.info(" - conf dict: '{}'".format( conf ) )
@@ -658,6 +722,7 @@ class Http():
         Otherwise don't enter code here
         """
         self.logger.info("{}: Shutting down".format(self._shortname))   # should be debug
+        self.item_stream.stop()
         cherrypy.engine.exit()
         for thread in threading.enumerate():
             if thread.name == '_TimeoutMonitor':
@@ -747,3 +812,525 @@ class _ServicesApp:
         result = tmpl.render( services=self.mod._services )
         return result
 
+
+class ItemChangeStream:
+    """
+    Distributes item changes to the clients of the item stream (see class _ItemStreamApp)
+
+    All item changes are put into one fan-out queue. A dispatcher thread takes them from
+    the queue and hands them to the clients, whose filter matches the item. Each client has
+    a bounded buffer, in which unsent intermediate values of an item are coalesced: only the
+    latest value of an item is kept until the client fetches the buffer.
+
+    The items are only hooked (by a method trigger) when the first client subscribes, so
+    there is no overhead without clients. Items added later are hooked on the next subscribe.
+    """
+
+    def __init__(self, sh, buffer_size=500):
+        self.logger = logging.getLogger(__name__)
+        self._sh = sh
+        self.buffer_size = buffer_size
+        self._queue = queue.Queue()
+        self._clients = {}
+        self._lock = threading.Lock()
+        self._hooked_items = weakref.WeakSet()
+        self._thread = None
+
+
+    def subscribe(self, prefix='', pattern=''):
+        """
+        Subscribes a new client to the item changes
+
+        :param prefix: comma separated list of item path prefixes (empty for all items)
+        :param pattern: item pattern as used by match_items (e.g. '*.licht' or '*:visu_acl')
+        :type prefix: str
+        :type pattern: str
+
+        :return: new client
+        :rtype: _StreamClient
+        """
+        client = _StreamClient(self._client_filter(prefix, pattern), self.buffer_size)
+        with self._lock:
+            self._clients[client.id] = client
+            for item in self._sh.return_items():
+                if item not in self._hooked_items:
+                    item.add_method_trigger(self._item_changed)
+                    self._hooked_items.add(item)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._dispatch, name='http.itemstream')
+                self._thread.daemon = True
+                self._thread.start()
+        return client
+
+
+    def unsubscribe(self, client):
+        """
+        Removes a client
+        """
+        with self._lock:
+            self._clients.pop(client.id, None)
+
+
+    def get_client(self, client_id):
+        """
+        Returns the client with the given id (or None)
+        """
+        return self._clients.get(client_id)
+
+
+    def snapshot(self, client):
+        """
+        Returns the current values of all items the client is interested in
+
+        :return: dict of item path and value
+        :rtype: dict
+        """
+        return {item.id(): item() for item in self._sh.return_items() if client.matches(item.id())}
+
+
+    def expire_clients(self, max_idle):
+        """
+        Removes clients, that have not fetched their buffer for max_idle seconds (long poll clients)
+        """
+        limit = time.time() - max_idle
+        with self._lock:
+            for client_id in [client_id for client_id, client in self._clients.items() if client.last_fetch < limit]:
+                del self._clients[client_id]
+
+
+    def stop(self):
+        """
+        Stops the dispatcher thread
+        """
+        self._queue.put(None)
+
+
+    def _client_filter(self, prefix, pattern):
+        prefixes = tuple(p.strip() for p in prefix.split(',') if p.strip())
+        if pattern:
+            regex, attr, val = Items.compile_match_pattern(pattern)
+            item_dict = {}
+
+            def matches(path):
+                if not path.startswith(prefixes or ''):
+                    return False
+                if path not in item_dict:
+                    # item added after the client subscribed
+                    item_dict.update((item.id(), item) for item in self._sh.return_items())
+                return path in item_dict and Items.item_matches_pattern(item_dict[path], regex, attr, val)
+            return matches
+        return lambda path: path.startswith(prefixes or '')
+
+
+    def _item_changed(self, item, caller=None, source=None, dest=None):
+        if self._clients:
+            self._queue.put((item.id(), item()))
+
+
+    def _dispatch(self):
+        while True:
+            change = self._queue.get()
+            if change is None:
+                break
+            path, value = change
+            for client in list(self._clients.values()):
+                if client.matches(path):
+                    client.put(path, value)
+        self._thread = None
+
+
+class _StreamClient:
+    """
+    A client of the item stream with its bounded buffer of pending item changes
+    """
+
+    def __init__(self, filter, buffer_size):
+        self.id = uuid.uuid4().hex
+        self.dropped = 0
+        self.last_fetch = time.time()
+        self._filter = filter
+        self._matches = {}
+        self._buffer_size = buffer_size
+        self._pending = OrderedDict()
+        self._condition = threading.Condition()
+
+
+    def matches(self, path):
+        """
+        Returns True, if the client is interested in changes of the item (result is cached per item)
+        """
+        result = self._matches.get(path)
+        if result is None:
+            result = self._matches[path] = bool(self._filter(path))
+        return result
+
+
+    def put(self, path, value):
+        """
+        Adds an item change to the buffer, replacing an unsent older value of the item
+        """
+        with self._condition:
+            if path in self._pending:
+                self._pending[path] = value
+            else:
+                if len(self._pending) >= self._buffer_size:
+                    self._pending.popitem(last=False)
+                    self.dropped += 1
+                self._pending[path] = value
+            self._condition.notify()
+
+
+    def fetch(self, timeout=None):
+        """
+        Waits for item changes and returns all pending changes
+
+        :param timeout: maximum time to wait in seconds
+        :return: dict of item path and (latest) value, empty if the timeout expired
+        :rtype: dict
+        """
+        with self._condition:
+            if not self._pending:
+                self._condition.wait(timeout)
+            changes = self._pending
+            self._pending = OrderedDict()
+        self.last_fetch = time.time()
+        return changes
+
+
+class _ItemStreamApp:
+    """
+    The module 'http' implements a stream of item changes for dashboards and similar clients.
+
+    - items/stream: Server-Sent Events, each event contains the changed items as json object
+    - items/poll: Long polling, returns the changed items as json object
+    - items/series: Returns the stored values of an item in a time range (see lib.timeseries)
+
+    Both take the parameters prefix (comma separated item path prefixes) and pattern
+    (item pattern as used by match_items, e.g. '*.licht') to select the items. The first event (or the
+    first poll) contains the current values of all selected items.
+
+    This webinterface is mounted to CherryPy as '/items'
+    """
+
+    keepalive_interval = 15
+    poll_timeout = 25
+
+    def __init__(self, mod):
+        self.mod = mod
+
+
+    @cherrypy.expose
+    def stream(self, prefix='', pattern=''):
+        """
+        This method is exposed to CherryPy. It implements the Server-Sent Events stream 'items/stream'
+        """
+        client = self.mod.item_stream.subscribe(prefix, pattern)
+        cherrypy.response.headers['Content-Type'] = 'text/event-stream'
+        cherrypy.response.headers['Cache-Control'] = 'no-cache'
+
+        def events():
+            try:
+                yield self._event(self.mod.item_stream.snapshot(client))
+                while True:
+                    changes = client.fetch(self.keepalive_interval)
+                    if changes:
+                        yield self._event(changes)
+                    else:
+                        yield ': keepalive\n\n'
+            finally:
+                self.mod.item_stream.unsubscribe(client)
+
+        return events()
+    stream._cp_config = {'response.stream': True}
+
+
+    @cherrypy.expose
+    @cherrypy.tools.json_out()
+    def poll(self, client='', prefix='', pattern='', timeout=None):
+        """
+        This method is exposed to CherryPy. It implements the long polling request 'items/poll'
+
+        Pass the client id returned by the previous poll to get the changes since then.
+        """
+        self.mod.item_stream.expire_clients(3 * self.poll_timeout)
+        stream_client = self.mod.item_stream.get_client(client)
+        if stream_client is None:
+            stream_client = self.mod.item_stream.subscribe(prefix, pattern)
+            changes = self.mod.item_stream.snapshot(stream_client)
+        else:
+            try:
+                timeout = float(timeout or self.poll_timeout)
+            except ValueError:
+                raise cherrypy.HTTPError(400, "Invalid timeout '{}'".format(timeout))
+            if not timeout >= 0:
+                raise cherrypy.HTTPError(400, "Invalid timeout '{}'".format(timeout))
+            changes = stream_client.fetch(min(timeout, self.poll_timeout))
+        return {'client': stream_client.id, 'changes': self._jsonable(changes)}
+
+
+    @cherrypy.expose
+    @cherrypy.tools.json_out()
+    def series(self, item, start='24h', end=None, resolution=None, max_points=1000):
+        """
+        This method is exposed to CherryPy. It implements the request 'items/series'
+
+        Returns the values of an item with the attribute 'timeseries' as list of rows, start and
+        end are seconds since epoch or durations back from now (e.g. '24h').
+        """
+        timeseries = TimeSeries.get_instance()
+        if timeseries is None:
+            raise cherrypy.HTTPError(404, "Time series are not enabled")
+        try:
+            if not resolution:
+                resolution = timeseries.select_resolution(start, end, int(max_points))
+            rows = timeseries.query(item, start, end, resolution)
+        except KeyError as e:
+            raise cherrypy.HTTPError(404, e.args[0])
+        except ValueError as e:
+            raise cherrypy.HTTPError(400, str(e))
+        return {'item': item, 'resolution': resolution, 'rows': rows}
+
+
+    def _event(self, changes):
+        return 'data: {}\n\n'.format(json.dumps(changes, default=str))
+
+
+    def _jsonable(self, changes):
+        return json.loads(json.dumps(changes, default=str))
+
+
+class StaticAssets:
+    """
+    Serves the global static files (gstatic) precompressed and cache-friendly
+
+    build() creates gzip (and brotli, if the python module brotli is installed) variants of
+    the compressible files in a cache directory. A variant is valid as long as its
+    modification time matches the one of the source file, so it is only rebuilt after the
+    source file has changed.
+
+    serve() is used as CherryPy tool 'gstatic'. It selects the variant by the Accept-Encoding
+    header of the request and sends it with a strong ETag and a Last-Modified header
+    (answering conditional requests with 304). Browsers have to revalidate the files on every
+    use (Cache-Control: no-cache), only fingerprinted files (with a content hash in the
+    filename, e.g. app.3f9a2c1e.js) are sent with a long max-age. Files are streamed in chunks
+    by cherrypy.lib.static.serve_file, which supports range requests for large files.
+    """
+
+    compressible = ('.js', '.css', '.html', '.htm', '.svg', '.json', '.map', '.txt', '.xml', '.ttf', '.eot', '.otf')
+    min_size = 1024
+    fingerprinted = re.compile(r'[.-][0-9a-fA-F]{8,}[.-]')
+
+    def __init__(self, source_dir, cache_dir, max_age=31536000):
+        self.logger = logging.getLogger(__name__)
+        self.source_dir = os.path.normpath(source_dir)
+        self.cache_dir = os.path.normpath(cache_dir)
+        self.max_age = max_age
+        self.encodings = ['br', 'gzip'] if brotli is not None else ['gzip']
+
+
+    def build(self):
+        """
+        Creates the missing or outdated compressed variants of all compressible files
+
+        :return: number of variants created
+        :rtype: int
+        """
+        start = time.time()
+        created = 0
+        for dirpath, dirnames, filenames in os.walk(self.source_dir):
+            for filename in filenames:
+                source = os.path.join(dirpath, filename)
+                if not filename.endswith(self.compressible):
+                    continue
+                try:
+                    st = os.stat(source)
+                    if st.st_size < self.min_size:
+                        continue
+                    data = None
+                    for encoding in self.encodings:
+                        variant = self._variant_path(source, encoding)
+                        if self._variant_valid(variant, st):
+                            continue
+                        if data is None:
+                            with open(source, 'rb') as f:
+                                data = f.read()
+                        self._write_variant(variant, self._compress(data, encoding), st)
+                        created += 1
+                except OSError as e:
+                    self.logger.warning("Unable to create compressed variant of {}: {}".format(source, e))
+        self.logger.info("Created {} compressed variants of static files in {:.1f} seconds".format(created, time.time() - start))
+        return created
+
+
+    def serve(self):
+        """
+        Serves a file below the gstatic directory (used as CherryPy tool)
+
+        :return: True, if the request has been handled
+        :rtype: bool
+        """
+        request = cherrypy.serving.request
+        response = cherrypy.serving.response
+        if request.method not in ('GET', 'HEAD'):
+            return False
+        index = request.path_info.find('/gstatic/')
+        if index < 0:
+            return False
+        branch = urllib.parse.unquote(request.path_info[index + len('/gstatic/'):])
+        filename = os.path.normpath(os.path.join(self.source_dir, branch))
+        if not filename.startswith(self.source_dir + os.sep):
+            raise cherrypy.HTTPError(403)
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return False
+        if not stat.S_ISREG(st.st_mode):
+            return False
+
+        path = filename
+        encoding = None
+        if filename.endswith(self.compressible):
+            response.headers['Vary'] = 'Accept-Encoding'
+            accepted = self._accepted_encodings(request.headers.get('Accept-Encoding', ''))
+            for candidate in self.encodings:
+                variant = self._variant_path(filename, candidate)
+                if candidate in accepted and self._variant_valid(variant, st):
+                    path = variant
+                    encoding = candidate
+                    break
+
+        etag = '"{:x}-{:x}{}"'.format(st.st_size, st.st_mtime_ns, '-' + encoding if encoding else '')
+        response.headers['ETag'] = etag
+        response.headers['Last-Modified'] = cherrypy.lib.httputil.HTTPDate(st.st_mtime)
+        if self.fingerprinted.search(os.path.basename(filename)):
+            response.headers['Cache-Control'] = 'public, max-age={}, immutable'.format(self.max_age)
+        else:
+            response.headers['Cache-Control'] = 'no-cache'
+        if_none_match = request.headers.get('If-None-Match', '')
+        if etag in [tag.strip() for tag in if_none_match.split(',')] or if_none_match.strip() == '*':
+            response.status = 304
+            response.body = b''
+            return True
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+        content_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        cherrypy.lib.static.serve_file(path, content_type)
+        return True
+
+
+    def _variant_path(self, source, encoding):
+        extension = '.br' if encoding == 'br' else '.gz'
+        return os.path.join(self.cache_dir, os.path.relpath(source, self.source_dir)) + extension
+
+
+    def _variant_valid(self, variant, st):
+        try:
+            return os.stat(variant).st_mtime_ns == st.st_mtime_ns
+        except OSError:
+            return False
+
+
+    def _compress(self, data, encoding):
+        if encoding == 'br':
+            return brotli.compress(data)
+        return gzip.compress(data, compresslevel=9)
+
+
+    def _write_variant(self, variant, data, st):
+        os.makedirs(os.path.dirname(variant), exist_ok=True)
+        tmp = variant + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        # the variant gets the modification time of the source file, to detect outdated variants
+        os.utime(tmp, ns=(st.st_atime_ns, st.st_mtime_ns))
+        os.replace(tmp, variant)
+
+
+    def _accepted_encodings(self, header):
+        accepted = set()
+        for entry in header.split(','):
+            coding, __, params = entry.strip().partition(';')
+            params = params.replace(' ', '')
+            if params.startswith('q=') and params[2:] in ('0', '0.0', '0.00', '0.000'):
+                continue
+            accepted.add(coding.strip().lower())
+        return accepted
+
+
+class _CredentialCache:
+    """
+    Cache of successfully verified Basic Auth credentials
+
+    Browsers send the credentials with every request (pages, static files, ajax polls). To not
+    verify the password hash on every request, verified credentials are remembered for ttl
+    seconds. The cache only holds a keyed digest of the password (with a random key, created
+    at startup), never the password itself. Failed verifications are not cached.
+    """
+
+    def __init__(self, ttl=300, max_entries=64):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._key = os.urandom(32)
+        self._verified = OrderedDict()
+        self._lock = threading.Lock()
+
+
+    def verify(self, realm, username, password, check):
+        """
+        Verifies credentials, using the cache if possible
+
+        :param check: function to verify the password, if it is not in the cache
+        :type check: function
+
+        :return: True, if the credentials are valid
+        :rtype: bool
+        """
+        entry = (realm, username, hashlib.blake2b(password.encode(), key=self._key, digest_size=32).digest())
+        now = time.time()
+        with self._lock:
+            expires = self._verified.get(entry)
+            if expires is not None and expires > now:
+                return True
+        if not check(password):
+            return False
+        with self._lock:
+            self._verified.pop(entry, None)
+            self._verified[entry] = now + self.ttl
+            while len(self._verified) > self.max_entries:
+                self._verified.popitem(last=False)
+        return True
+
+
+class _TemplateBytecodeCache(FileSystemBytecodeCache):
+    """
+    Bytecode cache for the template environments of the http module and the plugin webifs
+
+    The compiled templates are stored in the cache directory (to survive restarts) and are
+    kept in memory, so a global template (gtemplates) is compiled and read only once, even if
+    it is used by the environments of many webifs. Jinja2 stores a checksum of the template
+    source with the bytecode, so a changed template is compiled again.
+    """
+
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        FileSystemBytecodeCache.__init__(self, directory)
+        self._memory = {}
+        self._lock = threading.Lock()
+
+
+    def load_bytecode(self, bucket):
+        with self._lock:
+            entry = self._memory.get(bucket.key)
+        if entry is not None and entry[0] == bucket.checksum:
+            bucket.bytecode_from_string(entry[1])
+            return
+        FileSystemBytecodeCache.load_bytecode(self, bucket)
+        if bucket.code is not None:
+            with self._lock:
+                self._memory[bucket.key] = (bucket.checksum, bucket.bytecode_to_string())
+
+
+    def dump_bytecode(self, bucket):
+        FileSystemBytecodeCache.dump_bytecode(self, bucket)
+        with self._lock:
+            self._memory[bucket.key] = (bucket.checksum, bucket.bytecode_to_string())
@@ -1,7 +1,16 @@
 
 import unittest
 import common
+import collections
+import copy
+import json
+import os
+import shutil
+import tempfile
+from unittest import mock
+
 import lib.config
+import lib.shyaml as shyaml
 
 verbose = True
 
@@ -131,6 +140,19 @@ class TestConfigConf( unittest.TestCase,ConfigBaseTests):
         self.assertEqual(conf['section']['key_multiline'], 'line1line2')
         self.assertEqual(conf['section']['key_multiline_space'], 'line1 line2')
         self.assertEqual(conf['section']['key_multiline_quotes'], 'line1line2')
+
+    @unittest.skipIf(shyaml._CSafeLoader is None, "libyaml is not available")
+    def test_yamlread_libyaml(self):
+        for name in ['digits', 'empty', 'invalidchars', 'keyvalues', 'keyword', 'lists', 'reserved', 'sections', 'structure']:
+            with open(common.BASE + '/tests/resources/config_{}.yaml'.format(name)) as f:
+                sdata = f.read().replace('\n', '\n\n')
+            expected = shyaml._safe_load(sdata, shyaml.yaml.SafeLoader, True)
+            self.assertEqual(expected, shyaml._load(sdata, True))
+            self.assertEqual(expected, shyaml._load(sdata, False))
+        # errors are reported by the pure Python loader
+        y, estr = shyaml.yaml_load_fromstring('item:\n\ttype: num\n', True)
+        self.assertIsNone(y)
+        self.assertTrue(estr.startswith('TABs are not allowed in YAML files'))
     
 
 class TestConfigYaml(unittest.TestCase,ConfigBaseTests):
@@ -146,5 +168,144 @@ class TestConfigYaml(unittest.TestCase,ConfigBaseTests):
         self.assertEqual(conf['section']['key_multiline_quotes'], 'line1line2')
 
 
+class TestConfigSanitize(unittest.TestCase):
+
+    def tree(self):
+        od = collections.OrderedDict
+        return od([
+            ('wohnung', od([
+                ('name', 'Wohnung'), ('comment', 'removed'), ('comment_2', 'removed'),
+                ('licht', od([('type', 'bool'), ('knx_listen', ['1/1/1', '1/1/2']), ('eval', 'value\nand more'), ('1attr', '1')])),
+                ('set', od([('type', 'num')])), ('get', 'attribute is allowed'), ('global', od([('type', 'num')])),
+                ('in', 'attribute is allowed'), ('bad.item', od([('type', 'num')])), ('bad-attr', '1'), ('2item', od()),
+                ('comment_item', od([('type', 'str'), ('sub', od([('value', 5), ('enforce_updates', True)]))])),
+                ('*attr@x', 'special chars'), (12, 'number as key'),
+            ])),
+            ('3top', od([('type', 'num')])),
+            ('garten', od([('type', 'foo')])),
+        ])
+
+    def run_old(self, tree, destination, filename):
+        lib.config.remove_comments(tree)
+        lib.config.remove_digits(tree)
+        lib.config.remove_reserved(tree)
+        lib.config.remove_keyword(tree)
+        lib.config.remove_invalid(tree)
+        if filename:
+            lib.config._add_filenames_to_config(tree, filename)
+        return lib.config.merge(tree, destination)
+
+    def test_same_result_and_warnings(self):
+        for filename in (None, 'test.yaml'):
+            existing = collections.OrderedDict([('garten', collections.OrderedDict([('name', 'Garten'), ('_filename', 'old.yaml')]))])
+            with self.assertLogs('lib.config', 'WARNING') as old_logs:
+                old = self.run_old(self.tree(), copy.deepcopy(existing), filename)
+            with self.assertLogs('lib.config', 'WARNING') as new_logs:
+                new = lib.config.sanitize_and_merge(self.tree(), copy.deepcopy(existing), filename)
+            self.assertEqual(old, new)
+            self.assertEqual(json.dumps(old), json.dumps(new))
+            self.assertEqual(sorted(old_logs.output), sorted(new_logs.output))
+            self.assertEqual(8, len(new_logs.output))
+
+    def test_invalid_tree(self):
+        with self.assertLogs('lib.config', 'ERROR'):
+            self.assertEqual({}, lib.config.sanitize_and_merge(['a', 'b'], collections.OrderedDict()))
+        destination = collections.OrderedDict([('item', 'attribute')])
+        with self.assertLogs('lib.config', 'ERROR'):
+            lib.config.sanitize_and_merge(collections.OrderedDict([('item', collections.OrderedDict([('type', 'num')]))]), destination)
+        self.assertEqual('attribute', destination['item'])
+
+
+class TestConfigSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.itemsdir = os.path.join(self.dir, 'items') + os.path.sep
+        os.makedirs(self.itemsdir)
+        self.write('a.conf', '[wohnung]\n    [[licht]]\n        type = bool\n')
+        self.write('b.conf', '[garten]\n    [[pumpe]]\n        type = bool\n')
+        self.snapshot = os.path.join(self.dir, 'var', 'config', 'items.snapshot')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, filename, content):
+        with open(os.path.join(self.itemsdir, filename), 'w') as f:
+            f.write(content)
+
+    def parse(self):
+        return lib.config.parse_itemsdirs([(self.itemsdir, True)], self.snapshot)
+
+    def test_snapshot_is_used(self):
+        conf = self.parse()
+        self.assertEqual(lib.config.parse_itemsdir(self.itemsdir, None, addfilenames=True), conf)
+        self.assertTrue(os.path.isfile(self.snapshot))
+        with mock.patch('lib.config._parse_files') as parse_files:
+            self.assertEqual(conf, self.parse())
+            self.assertFalse(parse_files.called)
+
+    def test_snapshot_is_rebuilt(self):
+        self.assertEqual('bool', self.parse()['wohnung']['licht']['type'])
+        self.write('a.conf', '[wohnung]\n    [[licht]]\n        type = num\n')
+        os.utime(os.path.join(self.itemsdir, 'a.conf'), ns=(1, 1))
+        self.assertEqual('num', self.parse()['wohnung']['licht']['type'])
+        self.write('c.conf', '[keller]\n    type = num\n')
+        self.assertTrue('keller' in self.parse())
+        os.remove(os.path.join(self.itemsdir, 'c.conf'))
+        self.assertFalse('keller' in self.parse())
+        with open(self.snapshot, 'wb') as f:
+            f.write(b'damaged')
+        self.assertTrue('garten' in self.parse())
+
+    def test_no_snapshot_with_problems(self):
+        self.write('c.conf', '[keller]\n    [[1licht]]\n        type = num\n')
+        conf = self.parse()
+        self.assertFalse('1licht' in conf['keller'])
+        self.assertFalse(os.path.exists(self.snapshot))
+
+
+class TestConfigParallel(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.itemsdir = os.path.join(self.dir, 'items') + os.path.sep
+        os.makedirs(self.itemsdir)
+        for number in range(6):
+            with open(os.path.join(self.itemsdir, 'f{}.conf'.format(number)), 'w') as f:
+                # all files define attributes of item 'common', later files override earlier ones
+                f.write('[common]\n    value = {0}\n    [[sub{0}]]\n        type = num\n        list = a | b\n'.format(number))
+                f.write('[item{0}]\n    type = str\n'.format(number))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_parallel_equals_sequential(self):
+        sequential = lib.config.parse_itemsdir(self.itemsdir, None, addfilenames=True)
+        parallel = lib.config.parse_itemsdir(self.itemsdir, None, addfilenames=True, processes=2)
+        self.assertEqual(sequential, parallel)
+        self.assertEqual(list(sequential.keys()), list(parallel.keys()))
+        self.assertEqual(list(sequential['common'].keys()), list(parallel['common'].keys()))
+        self.assertEqual('5', parallel['common']['value'])
+        self.assertEqual(['a', 'b'], parallel['common']['sub3']['list'])
+
+    def test_parallel_logging(self):
+        with open(os.path.join(self.itemsdir, 'f9.conf'), 'w') as f:
+            f.write('[invalid]\n    [[1item]]\n')
+        with self.assertLogs('lib.config', 'ERROR') as logs:
+            conf = lib.config.parse_itemsdirs([(self.itemsdir, False)], processes=2)
+        self.assertEqual(1, len(logs.records))
+        self.assertTrue("item starts with digit" in logs.records[0].getMessage())
+        self.assertEqual(0, len(conf['invalid']))
+
+    def test_parallel_does_not_fork(self):
+        # items are loaded while other threads are running, the workers must not be forked
+        self.assertNotEqual('fork', lib.config._pool_context().get_start_method())
+        with mock.patch.object(lib.config.logger, 'warning') as warning:
+            parallel = lib.config.parse_itemsdir(self.itemsdir, None, processes=2)
+        # no fallback to parsing sequentially
+        warning.assert_not_called()
+        self.assertEqual('5', parallel['common']['value'])
+
+
 if __name__ == '__main__':
     unittest.main(verbosity=2)
@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+# vim: set encoding=utf-8 tabstop=4 softtabstop=4 shiftwidth=4 expandtab
+#########################################################################
+# Copyright 2018-       Martin Sinn                         m.sinn@gmx.de
+#########################################################################
+#  This file is part of SmartHomeNG
+#  https://github.com/smarthomeNG/smarthome
+#  http://knx-user-forum.de/
+#
+#  SmartHomeNG is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  SmartHomeNG is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with SmartHomeNG If not, see <http://www.gnu.org/licenses/>.
+#########################################################################
+
+import common
+import unittest
+import logging
+import socket
+
+from lib.connection import Connections, Stream
+
+
+logger = logging.getLogger(__name__)
+
+
+class RecordingStream(Stream):
+
+    def __init__(self, sock):
+        self.frames = []
+        self.closed = False
+        Stream.__init__(self, sock)
+
+    def found_terminator(self, data):
+        self.frames.append(bytes(data))
+
+    def found_balance(self, data):
+        self.frames.append(bytes(data))
+
+    def handle_close(self):
+        self.closed = True
+
+
+class TestStream(unittest.TestCase):
+
+    def setUp(self):
+        self.connections = Connections()
+        self.local, self.remote = socket.socketpair()
+        self.local.setblocking(False)
+        self.stream = RecordingStream(self.local)
+        self.fileno = self.local.fileno()
+
+    def tearDown(self):
+        self.stream.close()
+        self.remote.close()
+        self.connections._epoll.close()
+
+    def write_interest(self):
+        return self.connections._write_interest.get(self.fileno)
+
+    def fill_socket(self):
+        # make the socket buffers small, so a send cannot complete at once
+        self.local.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+        self.remote.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+
+    def receive(self, size):
+        self.remote.settimeout(2)
+        data = bytearray()
+        while len(data) < size:
+            if self.stream.outbuffer:
+                self.stream._out()
+            data += self.remote.recv(65536)
+        return bytes(data)
+
+    def test_write_interest(self):
+        self.assertFalse(self.write_interest())
+        self.stream.send(b'data\r\n')
+        # everything has been sent at once, no need to poll for writability
+        self.assertFalse(self.write_interest())
+        self.assertEqual(b'data\r\n', self.remote.recv(100))
+
+        self.fill_socket()
+        data = b'x' * 1000000
+        self.stream.send(data)
+        self.assertTrue(self.stream.outbuffer)
+        self.assertTrue(self.write_interest())
+        self.assertEqual(data, self.receive(len(data)))
+        self.assertFalse(self.stream.outbuffer)
+        self.assertFalse(self.write_interest())
+
+    def test_write_interest_while_locked(self):
+        # another thread holds the lock for sending, the outbuffer must not be stalled
+        lock = self.stream._Stream__olock
+        lock.acquire()
+        try:
+            self.stream.outbuffer.appendleft(b'data\r\n')
+            self.stream._out()
+            self.assertTrue(self.write_interest())
+        finally:
+            lock.release()
+        self.connections.poll()
+        self.assertEqual(b'data\r\n', self.remote.recv(100))
+        self.assertFalse(self.write_interest())
+
+    def feed(self, data):
+        self.remote.sendall(data)
+        self.stream._in()
+
+    def test_terminator_split_across_reads(self):
+        self.feed(b'abc\r')
+        self.assertEqual([], self.stream.frames)
+        # the incomplete search resumes at the end of the buffer, but still finds the split terminator
+        self.assertEqual(3, self.stream._scan_pos)
+        self.feed(b'\ndef\r\n')
+        self.assertEqual([b'abc', b'def'], self.stream.frames)
+        self.assertEqual(b'', self.stream.inbuffer)
+
+    def test_several_frames_in_one_read(self):
+        self.feed(b'one\r\ntwo\r\n\r\nthree\r\nfo')
+        self.assertEqual([b'one', b'two', b'', b'three'], self.stream.frames)
+        self.assertEqual(b'fo', self.stream.inbuffer)
+        self.feed(b'ur\r\n')
+        self.assertEqual(b'four', self.stream.frames[-1])
+
+    def test_fixed_size_frames(self):
+        frames = self.stream.frames
+
+        def found_terminator(data):
+            frames.append(bytes(data))
+            # the header announces the size of the next frame
+            self.stream.terminator = int(data) if data.isdigit() else b'\r\n'
+
+        self.stream.found_terminator = found_terminator
+        self.feed(b'5\r\nhello3\r\n')
+        self.assertEqual([b'5', b'hello', b'3'], frames)
+        self.feed(b'abc')
+        self.assertEqual(b'abc', frames[-1])
+
+    def test_balanced_frames(self):
+        self.stream.terminator = None
+        self.stream.balance('{', '}')
+        self.feed(b'{"a": {"b": 1}}{"c"')
+        self.assertEqual([b'{"a": {"b": 1}}'], self.stream.frames)
+        self.feed(b': 2}')
+        self.assertEqual([b'{"a": {"b": 1}}', b'{"c": 2}'], self.stream.frames)
+        self.assertEqual(b'', self.stream.inbuffer)
+
+    def test_unbalanced_close(self):
+        self.stream.terminator = None
+        self.stream.balance('{', '}')
+        with self.assertLogs('lib.connection', logging.WARNING):
+            self.feed(b'{}}{')
+        self.assertEqual([b'{}'], self.stream.frames)
+        self.assertFalse(self.stream.connected)
+        self.assertTrue(self.stream.closed)
+
+    def test_buffer_reuse_after_compaction(self):
+        self.feed(b'first\r\nsec')
+        recv_buffer = self.stream._recv_buffer
+        inbuffer = self.stream.inbuffer
+        # the consumed frame has been removed, the positions of the incomplete scan moved along
+        self.assertEqual(b'sec', inbuffer)
+        self.assertEqual(2, self.stream._scan_pos)
+        self.feed(b'ond\r\nthi')
+        self.feed(b'rd\r\n')
+        self.assertEqual([b'first', b'second', b'third'], self.stream.frames)
+        self.assertIs(recv_buffer, self.stream._recv_buffer)
+        self.assertIs(inbuffer, self.stream.inbuffer)
+        self.assertEqual(b'', inbuffer)
+
+    def test_sendmsg_batching(self):
+        calls = []
+        send_buffers = self.stream._send_buffers
+
+        def record(buffers):
+            calls.append(len(buffers))
+            return send_buffers(buffers)
+
+        self.stream._send_buffers = record
+        self.stream._frame_size_out = 4
+        self.stream.send(bytearray(b'0123456789'))
+        # the three frames are sent with one system call
+        self.assertEqual([3], calls)
+        self.assertEqual(b'0123456789', self.remote.recv(100))
+        self.assertEqual(10, self.stream.sent_bytes)
+        self.assertEqual(0, self.stream.outbuffer_size)
+
+    def test_partial_send(self):
+        self.fill_socket()
+        data = bytes(range(256)) * 4000
+        self.stream.send(data)
+        # the socket buffer is full, the unsent rest is kept in the outbuffer
+        self.assertLess(self.stream.sent_bytes, len(data))
+        self.assertEqual(len(data) - self.stream.sent_bytes, self.stream.outbuffer_size)
+        self.assertEqual(data, self.receive(len(data)))
+        self.assertEqual(len(data), self.stream.sent_bytes)
+        self.assertEqual(len(data), self.stream.queued_bytes)
+        self.assertEqual(0, self.stream.outbuffer_size)
+
+    def test_watermarks(self):
+        self.fill_socket()
+        events = []
+
+        def handle_watermark(paused):
+            # the handler is not called while the send lock is held, so it may send itself
+            lock = self.stream._Stream__olock
+            self.assertTrue(lock.acquire(blocking=False))
+            lock.release()
+            events.append(paused)
+            if not paused:
+                self.stream.send(b'resumed')
+
+        self.stream.handle_watermark = handle_watermark
+        self.stream.set_watermarks(65536, 1024)
+        data = b'x' * 200000
+        self.stream.send(data)
+        self.assertEqual([True], events)
+        self.assertTrue(self.stream.write_paused)
+        self.assertEqual(data + b'resumed', self.receive(len(data) + 7))
+        self.assertEqual([True, False], events)
+        self.assertFalse(self.stream.write_paused)
+
+    def test_send_str(self):
+        # like a failing send, a str is logged and the connection is closed
+        with self.assertLogs('lib.connection', logging.ERROR):
+            self.assertTrue(self.stream.send('data'))
+        self.assertFalse(self.stream.connected)
+        self.assertTrue(self.stream.closed)
+
+    def test_unregister(self):
+        self.stream.close()
+        self.assertNotIn(self.fileno, self.connections._write_interest)
+        self.connections.set_write_interest(self.fileno, True)
+        self.assertNotIn(self.fileno, self.connections._write_interest)
+        self.assertTrue(self.stream.closed)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
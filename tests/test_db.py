@@ -1,8 +1,12 @@
 
 import common
 import unittest
+import os
+import shutil
 import sqlite3
+import tempfile
 import threading
+import time
 import lib.db
 
 class TestDbBase:
@@ -141,6 +145,263 @@ class TestDbTests(unittest.TestCase, TestDbBase):
         db.connect()
         db.fetchall("SELECT 1")
 
+    def test_statement_cache(self):
+        db = self.db(paramstyle='pyformat', format_input='qmark')
+        db.connect()
+        cur = db.cursor()
+        for i in range(3):
+            db.execute("SELECT * FROM TABLE WHERE ID = ? AND Name = ?", (i, 'test'), cur=cur)
+        db.execute("SELECT * FROM TABLE WHERE Name = ?", ('test', ), cur=cur)
+        self.assertEqual({'hits': 2, 'misses': 2, 'size': 2, 'maxsize': 256}, db.statement_cache_info())
+        self.assertEqual(('SELECT * FROM TABLE WHERE ID = %(arg1)s AND Name = %(arg2)s', {'arg1': 2, 'arg2': 'test'}), cur.execute_kwargs[2])
+
+    def test_executemany(self):
+        db = self.db(paramstyle='format', format_input='named')
+        db.connect()
+        db.executemany("INSERT INTO TABLE VALUES (:id, :name)", [{'id': 1, 'name': 'a'}, {'name': 'b', 'id': 2}])
+        self.assertEqual(("INSERT INTO TABLE VALUES (%s, %s)", [[1, 'a'], [2, 'b']]), db._conn.cursor_return.execute_kwargs[0])
+        self.assertEqual(1, db.statement_cache_info()['misses'])
+
+
+class TestDbPool(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.file = os.path.join(self.dir, 'test.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def db(self, **kwargs):
+        db = lib.db.Database('test', sqlite3, {'database': self.file}, 'qmark', **kwargs)
+        db.connect()
+        return db
+
+    def test_min_connections(self):
+        db = self.db(min_connections=3, max_connections=5)
+        self.assertEqual(2, len(db._pool))
+        db.close()
+        self.assertEqual(0, db._pool_size)
+
+    def test_wal_mode(self):
+        db = self.db(max_connections=2)
+        self.assertEqual('wal', db.fetchone("PRAGMA journal_mode")[0])
+        db.close()
+
+    def test_concurrent_connections(self):
+        db = self.db(max_connections=3)
+        db.execute("CREATE TABLE t (v INTEGER)")
+        db.commit()
+        with db.connection() as conn1:
+            with db.connection() as conn2:
+                self.assertIsNot(conn1, conn2)
+                conn1.execute("INSERT INTO t VALUES (1)")
+                # readers are not blocked by the uncommitted write
+                self.assertEqual(0, db.fetchone("SELECT COUNT(*) FROM t", cur=conn2.cursor())[0])
+                conn1.commit()
+                self.assertEqual(1, db.fetchone("SELECT COUNT(*) FROM t", cur=conn2.cursor())[0])
+            # the main connection is available besides the pool
+            self.assertEqual(1, db.fetchone("SELECT COUNT(*) FROM t")[0])
+        self.assertEqual(2, len(db._pool))
+        db.close()
+
+    def test_pool_exhausted(self):
+        db = self.db(max_connections=2)
+        with db.connection():
+            with self.assertRaisesRegex(Exception, 'No connection available'):
+                with db.connection(timeout=0.1):
+                    pass
+            released = []
+            def worker():
+                with db.connection(timeout=2):
+                    released.append(True)
+            thread = threading.Thread(target=worker)
+            thread.start()
+            time.sleep(0.1)
+            self.assertEqual([], released)
+        thread.join(2)
+        self.assertEqual([True], released)
+        db.close()
+
+    def test_rollback_on_error(self):
+        db = self.db(max_connections=2)
+        db.execute("CREATE TABLE t (v INTEGER)")
+        db.commit()
+        with self.assertRaises(ZeroDivisionError):
+            with db.connection() as conn:
+                conn.execute("INSERT INTO t VALUES (1)")
+                1 / 0
+        self.assertEqual(0, db.fetchone("SELECT COUNT(*) FROM t")[0])
+        db.close()
+
+    def test_broken_connection_is_replaced(self):
+        db = self.db(min_connections=2, max_connections=2, verify_interval=0)
+        broken = db._pool[0][0]
+        broken.close()
+        with db.connection() as conn:
+            self.assertIsNot(broken, conn)
+            self.assertEqual(1, db.fetchone("SELECT 1", cur=conn.cursor())[0])
+        db.close()
+
+    def test_verify_checks_pool(self):
+        db = self.db(min_connections=2, max_connections=2)
+        db._pool[0][0].close()
+        db.verify()
+        self.assertEqual(0, len(db._pool))
+        self.assertEqual(0, db._pool_size)
+        db.close()
+
+    def test_transaction(self):
+        db = self.db(max_connections=2)
+        db.execute("CREATE TABLE t (v INTEGER)")
+        db.commit()
+        with db.transaction() as cur:
+            db.executemany("INSERT INTO t VALUES (?)", [(i, ) for i in range(10)], cur=cur)
+        self.assertEqual(10, db.fetchone("SELECT COUNT(*) FROM t")[0])
+        with self.assertRaises(ZeroDivisionError):
+            with db.transaction() as cur:
+                db.execute("DELETE FROM t", cur=cur)
+                1 / 0
+        self.assertEqual(10, db.fetchone("SELECT COUNT(*) FROM t")[0])
+        db.close()
+
+    def test_batch_writer(self):
+        db = lib.db.Database('test', sqlite3, {'database': self.file, 'check_same_thread': False}, 'qmark')
+        db.connect()
+        db.execute("CREATE TABLE t (v INTEGER)")
+        db.commit()
+        writer = lib.db.BatchWriter(db, "INSERT INTO t VALUES (?)", max_rows=5, max_delay=0.2)
+        for i in range(7):
+            writer.add((i, ))
+        # flushed by size
+        self.assertEqual(5, db.fetchone("SELECT COUNT(*) FROM t")[0])
+        self.assertEqual(2, writer.pending())
+        # flushed by time
+        time.sleep(0.4)
+        self.assertEqual(7, db.fetchone("SELECT COUNT(*) FROM t")[0])
+        writer.add(('not a number', ))
+        db.execute("DROP TABLE t")
+        writer.close()
+        self.assertEqual((7, 1), (writer.written_rows, writer.failed_rows))
+        db.close()
+
+    def writer_db(self):
+        db = lib.db.Database('test', sqlite3, {'database': self.file, 'check_same_thread': False}, 'qmark')
+        db.connect()
+        db.execute("CREATE TABLE t (v INTEGER)")
+        db.commit()
+        return db
+
+    def test_queued_writer(self):
+        db = self.writer_db()
+        writer = db.start_writer(batch_size=10, max_delay=0.2)
+        for i in range(25):
+            self.assertTrue(db.enqueue("INSERT INTO t VALUES (?)", (i, )))
+        self.assertTrue(writer.flush(5))
+        self.assertEqual(list(range(25)), [row[0] for row in db.fetchall("SELECT v FROM t ORDER BY rowid")])
+        stats = writer.statistics()
+        self.assertEqual((25, 25, 0, 0), (stats['enqueued'], stats['written'], stats['failed'], stats['queue_depth']))
+        self.assertGreaterEqual(stats['batches'], 3)
+        self.assertGreater(stats['flush_latency_max'], 0)
+        db.close()
+        with self.assertRaises(Exception):
+            db.enqueue("INSERT INTO t VALUES (?)", (1, ))
+
+    def test_queued_writer_drop_oldest(self):
+        db = self.writer_db()
+        writer = db.start_writer(max_queue=5, overflow='drop_oldest', max_delay=10)
+        for i in range(8):
+            db.enqueue("INSERT INTO t VALUES (?)", (i, ))
+        self.assertEqual(5, writer.queue_depth())
+        db.stop_writer()
+        self.assertEqual([3, 4, 5, 6, 7], [row[0] for row in db.fetchall("SELECT v FROM t ORDER BY rowid")])
+        self.assertEqual((3, 5), (writer.statistics()['dropped'], writer.statistics()['max_queue_depth']))
+        db.close()
+
+    def test_queued_writer_block(self):
+        db = self.writer_db()
+        writer = db.start_writer(max_queue=2, max_delay=10)
+        self.assertTrue(db.enqueue("INSERT INTO t VALUES (?)", (1, )))
+        self.assertTrue(db.enqueue("INSERT INTO t VALUES (?)", (2, )))
+        self.assertFalse(db.enqueue("INSERT INTO t VALUES (?)", (3, ), timeout=0.1))
+        self.assertEqual(1, writer.statistics()['dropped'])
+        db.stop_writer()
+        self.assertEqual(2, db.fetchone("SELECT COUNT(*) FROM t")[0])
+        db.close()
+
+    def test_queued_writer_spill(self):
+        db = self.writer_db()
+        spill_file = os.path.join(self.dir, 'spill.json')
+        writer = db.start_writer(max_queue=5, overflow='spill', spill_file=spill_file, max_delay=10)
+        for i in range(12):
+            self.assertTrue(db.enqueue("INSERT INTO t VALUES (?)", (i, )))
+        stats = writer.statistics()
+        self.assertEqual((5, 7, 7), (stats['queue_depth'], stats['spilled_depth'], stats['spilled']))
+        self.assertTrue(writer.flush(5))
+        self.assertEqual(list(range(12)), [row[0] for row in db.fetchall("SELECT v FROM t ORDER BY rowid")])
+        self.assertEqual(0, writer.statistics()['spilled_depth'])
+        self.assertFalse(os.path.exists(spill_file))
+        db.close()
+
+    def test_queued_writer_spill_file_is_written_after_restart(self):
+        db = self.writer_db()
+        spill_file = os.path.join(self.dir, 'spill.json')
+        with open(spill_file, 'w') as f:
+            f.write('["INSERT INTO t VALUES (?)", [1], null]\n["INSERT INTO t VALUES (?)", [2], null]\n')
+        writer = db.start_writer(overflow='spill', spill_file=spill_file)
+        self.assertTrue(writer.flush(5))
+        self.assertEqual([1, 2], [row[0] for row in db.fetchall("SELECT v FROM t ORDER BY rowid")])
+        db.close()
+
+    def test_queued_writer_failing_statement(self):
+        db = self.writer_db()
+        writer = lib.db.QueuedWriter(db, max_delay=10, retries=1, retry_delay=0)
+        writer.start()
+        writer.put("INSERT INTO t VALUES (?)", (1, ))
+        writer.put("INSERT INTO missing VALUES (?)", (2, ))
+        writer.put("INSERT INTO t VALUES (?)", (3, ))
+        writer.stop()
+        self.assertEqual([1, 3], [row[0] for row in db.fetchall("SELECT v FROM t ORDER BY rowid")])
+        stats = writer.statistics()
+        self.assertEqual((2, 1), (stats['written'], stats['failed']))
+        with self.assertRaises(Exception):
+            lib.db.QueuedWriter(db, overflow='spill')
+        db.close()
+
+    def test_fetchiter(self):
+        db = self.db(max_connections=2)
+        db.execute("CREATE TABLE t (v INTEGER)")
+        db.executemany("INSERT INTO t VALUES (?)", [(i, ) for i in range(25)])
+        db.commit()
+        self.assertEqual(list(range(25)), [row[0] for row in db.fetchiter("SELECT v FROM t ORDER BY v", chunk_size=10)])
+        self.assertEqual([10, 10, 5], [len(rows) for rows in db.stream("SELECT v FROM t", chunk_size=10)])
+        self.assertEqual([[(24, )]], list(db.stream("SELECT v FROM t WHERE v > ?", (23, ), cur=db.cursor())))
+        db.close()
+
+    def test_fetchiter_early_termination(self):
+        db = self.db()
+        db.execute("CREATE TABLE t (v INTEGER)")
+        db.executemany("INSERT INTO t VALUES (?)", [(i, ) for i in range(25)])
+        db.commit()
+        rows = db.fetchiter("SELECT v FROM t", chunk_size=10)
+        self.assertEqual((0, ), next(rows))
+        # the main connection is locked while iterating and released when the iteration is stopped
+        self.assertFalse(db.lock(0))
+        rows.close()
+        self.assertTrue(db.lock(0))
+        db.release()
+        db.close()
+
+    def test_single_connection(self):
+        db = lib.db.Database('test', sqlite3, {'database': ':memory:'}, 'qmark', max_connections=4)
+        db.connect()
+        with db.connection() as conn:
+            self.assertIs(db._conn, conn)
+            self.assertFalse(db.lock(0))
+        self.assertTrue(db.lock(0))
+        db.release()
+        db.close()
+
 
 class DbQueryBaseTests(TestDbBase):
 
@@ -315,6 +576,10 @@ class MockDbApiCursor():
         self.execute_kwargs.append(kwargs if kwargs is not None else True)
         return {}
 
+    def executemany(self, *kwargs):
+        self.execute_kwargs.append(kwargs if kwargs is not None else True)
+        return {}
+
     def close(self, **kwargs):
         self.close_kwargs = kwargs if kwargs is not None else True
 
@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+# vim: set encoding=utf-8 tabstop=4 softtabstop=4 shiftwidth=4 expandtab
+#########################################################################
+# Copyright 2017-       Martin Sinn                         m.sinn@gmx.de
+#########################################################################
+#  This file is part of SmartHomeNG
+#  https://github.com/smarthomeNG/smarthome
+#  http://knx-user-forum.de/
+#
+#  SmartHomeNG is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  SmartHomeNG is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with SmartHomeNG If not, see <http://www.gnu.org/licenses/>.
+#########################################################################
+
+import common
+import unittest
+import gzip
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import cherrypy
+import requests
+
+from jinja2 import Environment, FileSystemLoader
+
+import lib.timeseries
+from lib.timeseries import TimeSeries
+
+from modules.http import Http, ItemChangeStream, StaticAssets, _CredentialCache, _ItemStreamApp, _TemplateBytecodeCache
+
+
+logger = logging.getLogger(__name__)
+
+
+class MockItem():
+
+    def __init__(self, path, value=0):
+        self._path = path
+        self._value = value
+        self.conf = {}
+        self._methods = []
+
+    def __call__(self, value=None):
+        if value is None:
+            return self._value
+        self._value = value
+        for method in self._methods:
+            method(self, 'Test', None, None)
+
+    def id(self):
+        return self._path
+
+    def add_method_trigger(self, method):
+        self._methods.append(method)
+
+
+class MockSmartHome():
+
+    def __init__(self, items):
+        self.items = items
+
+    def return_items(self):
+        return iter(self.items)
+
+
+class MockHttp():
+
+    def __init__(self, sh):
+        self.item_stream = ItemChangeStream(sh, buffer_size=3)
+
+
+class TestItemChangeStream(unittest.TestCase):
+
+    def setUp(self):
+        self.items = {path: MockItem(path) for path in ['wohnung.licht', 'wohnung.heizung', 'garten.licht', 'garten.pumpe']}
+        self.stream = ItemChangeStream(MockSmartHome(list(self.items.values())), buffer_size=3)
+
+    def tearDown(self):
+        self.stream.stop()
+
+    def test_prefix_filter(self):
+        client = self.stream.subscribe(prefix='wohnung.')
+        self.assertEqual({'wohnung.licht': 0, 'wohnung.heizung': 0}, self.stream.snapshot(client))
+        self.items['garten.licht'](1)
+        self.items['wohnung.licht'](1)
+        self.assertEqual({'wohnung.licht': 1}, client.fetch(1))
+
+    def test_pattern_filter(self):
+        client = self.stream.subscribe(pattern='*.licht')
+        self.items['wohnung.heizung'](21)
+        self.items['garten.licht'](1)
+        self.assertEqual({'garten.licht': 1}, client.fetch(1))
+
+    def test_items_added_later(self):
+        client = self.stream.subscribe(pattern='*.licht')
+        self.stream._sh.items.append(MockItem('keller.licht'))
+        self.stream._sh.items.append(MockItem('keller.pumpe'))
+        # new items are hooked when the next client subscribes
+        other = self.stream.subscribe()
+        for item in self.stream._sh.items[-2:]:
+            item(1)
+        self.assertEqual({'keller.licht': 1}, client.fetch(1))
+        self.assertEqual({'keller.licht': 1, 'keller.pumpe': 1}, other.fetch(1))
+        self.assertEqual(1, len(self.items['wohnung.licht']._methods))
+
+    def test_coalescing_and_bounded_buffer(self):
+        client = self.stream.subscribe()
+        for value in range(1, 4):
+            self.items['wohnung.licht'](value)
+        self.items['wohnung.heizung'](20)
+        self.items['garten.licht'](1)
+        self.items['garten.pumpe'](1)
+        time.sleep(0.2)
+        changes = client.fetch(1)
+        # intermediate values are coalesced, the oldest change is dropped when the buffer is full
+        self.assertEqual({'wohnung.heizung': 20, 'garten.licht': 1, 'garten.pumpe': 1}, changes)
+        self.assertEqual(1, client.dropped)
+
+    def test_fetch_waits_for_changes(self):
+        client = self.stream.subscribe()
+        threading.Timer(0.1, self.items['garten.pumpe'], args=(1,)).start()
+        self.assertEqual({'garten.pumpe': 1}, client.fetch(2))
+        self.assertEqual({}, client.fetch(0.1))
+
+    def test_long_poll(self):
+        mod = MockHttp(MockSmartHome(list(self.items.values())))
+        app = _ItemStreamApp(mod)
+        result = app.poll(prefix='garten.')
+        self.assertEqual({'garten.licht': 0, 'garten.pumpe': 0}, result['changes'])
+        self.items['garten.pumpe'](True)
+        self.assertEqual({'client': result['client'], 'changes': {'garten.pumpe': True}}, app.poll(client=result['client'], timeout=1))
+        for timeout in ['abc', '-1', 'nan']:
+            with self.assertRaises(cherrypy.HTTPError) as cm:
+                app.poll(client=result['client'], timeout=timeout)
+            self.assertEqual(400, cm.exception.status)
+        mod.item_stream.stop()
+
+    def test_series(self):
+        mod = MockHttp(MockSmartHome(list(self.items.values())))
+        app = _ItemStreamApp(mod)
+        lib.timeseries._timeseries_instance = None
+        with self.assertRaises(cherrypy.HTTPError):
+            app.series('wohnung.heizung')
+        data_dir = tempfile.mkdtemp()
+        try:
+            timeseries = TimeSeries(None, data_dir=data_dir)
+            timeseries.add('wohnung.heizung', 21, time.time() - 60)
+            result = app.series('wohnung.heizung', start='10m')
+            self.assertEqual('raw', result['resolution'])
+            self.assertEqual([21.0], [row[1] for row in result['rows']])
+            self.assertEqual('1m', app.series('wohnung.heizung', start='12h')['resolution'])
+            with self.assertRaises(cherrypy.HTTPError):
+                app.series('wohnung.heizung', resolution='5m')
+            with self.assertRaises(cherrypy.HTTPError) as cm:
+                app.series('../..')
+            self.assertEqual(404, cm.exception.status)
+        finally:
+            lib.timeseries._timeseries_instance = None
+            shutil.rmtree(data_dir)
+        mod.item_stream.stop()
+
+
+class TestStaticAssets(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.source_dir = os.path.join(self.dir, 'gstatic')
+        os.makedirs(os.path.join(self.source_dir, 'lib'))
+        self.script = b'function test() { return 42; }\n' * 100
+        with open(os.path.join(self.source_dir, 'lib', 'test.js'), 'wb') as f:
+            f.write(self.script)
+        with open(os.path.join(self.source_dir, 'lib', 'test.3f9a2c1e.js'), 'wb') as f:
+            f.write(self.script)
+        with open(os.path.join(self.source_dir, 'image.png'), 'wb') as f:
+            f.write(b'\x89PNG' * 500)
+        self.assets = StaticAssets(self.source_dir, os.path.join(self.dir, 'cache'))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_build(self):
+        self.assertEqual(2 * len(self.assets.encodings), self.assets.build())
+        with open(os.path.join(self.dir, 'cache', 'lib', 'test.js.gz'), 'rb') as f:
+            self.assertEqual(self.script, gzip.decompress(f.read()))
+        # unchanged files are not compressed again
+        self.assertEqual(0, self.assets.build())
+        os.utime(os.path.join(self.source_dir, 'lib', 'test.js'), (1, 1))
+        self.assertEqual(len(self.assets.encodings), self.assets.build())
+
+    def test_accepted_encodings(self):
+        self.assertEqual({'gzip', 'deflate'}, self.assets._accepted_encodings('gzip, deflate'))
+        self.assertEqual({'br'}, self.assets._accepted_encodings('gzip;q=0, br;q=1.0'))
+
+    def test_serve(self):
+        self.assets.build()
+        cherrypy.tools.gstatic = cherrypy._cptools.HandlerTool(self.assets.serve)
+        cherrypy.config.update({'server.socket_host': '127.0.0.1', 'server.socket_port': 0, 'log.screen': False, 'engine.autoreload.on': False})
+        cherrypy.tree.mount(None, '/test', {'/gstatic': {'tools.gstatic.on': True}})
+        cherrypy.engine.start()
+        try:
+            url = 'http://127.0.0.1:{}/test/gstatic/'.format(cherrypy.server.bound_addr[1])
+            response = requests.get(url + 'lib/test.js', headers={'Accept-Encoding': 'gzip'})
+            self.assertEqual(200, response.status_code)
+            self.assertEqual('gzip', response.headers['Content-Encoding'])
+            self.assertEqual(self.script, response.content)
+            self.assertEqual('no-cache', response.headers['Cache-Control'])
+            etag = response.headers['ETag']
+            last_modified = response.headers['Last-Modified']
+            response = requests.get(url + 'lib/test.js', headers={'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+            self.assertEqual(304, response.status_code)
+            self.assertEqual(last_modified, response.headers['Last-Modified'])
+            response = requests.get(url + 'lib/test.js', headers={'Accept-Encoding': 'gzip', 'If-Modified-Since': last_modified})
+            self.assertEqual(304, response.status_code)
+            # only fingerprinted files may be used from the cache without revalidation
+            response = requests.get(url + 'lib/test.3f9a2c1e.js', headers={'Accept-Encoding': 'gzip'})
+            self.assertEqual(self.script, response.content)
+            self.assertEqual('public, max-age=31536000, immutable', response.headers['Cache-Control'])
+            response = requests.get(url + 'lib/test.js', headers={'Accept-Encoding': 'identity'})
+            self.assertNotIn('Content-Encoding', response.headers)
+            self.assertNotEqual(etag, response.headers['ETag'])
+            self.assertEqual(self.script, response.content)
+            response = requests.get(url + 'image.png')
+            self.assertEqual(b'\x89PNG' * 500, response.content)
+            self.assertEqual(404, requests.get(url + 'missing.js').status_code)
+        finally:
+            cherrypy.engine.exit()
+            del cherrypy.tree.apps['/test']
+
+
+class TestCredentialCache(unittest.TestCase):
+
+    def setUp(self):
+        self.checked = []
+        self.cache = _CredentialCache(ttl=0.2, max_entries=2)
+
+    def check(self, password):
+        self.checked.append(password)
+        return password == 'secret'
+
+    def test_verified_credentials_are_cached(self):
+        self.assertTrue(self.cache.verify('realm', 'admin', 'secret', self.check))
+        self.assertTrue(self.cache.verify('realm', 'admin', 'secret', self.check))
+        self.assertEqual(['secret'], self.checked)
+        # other realm or user are verified separately
+        self.assertTrue(self.cache.verify('other', 'admin', 'secret', self.check))
+        self.assertEqual(2, len(self.checked))
+        time.sleep(0.25)
+        self.assertTrue(self.cache.verify('realm', 'admin', 'secret', self.check))
+        self.assertEqual(3, len(self.checked))
+
+    def test_failed_credentials_are_not_cached(self):
+        self.assertFalse(self.cache.verify('realm', 'admin', 'wrong', self.check))
+        self.assertFalse(self.cache.verify('realm', 'admin', 'wrong', self.check))
+        self.assertEqual(['wrong', 'wrong'], self.checked)
+        self.assertNotIn('wrong', str(self.cache._verified))
+
+    def test_max_entries(self):
+        for realm in ['a', 'b', 'c']:
+            self.cache.verify(realm, 'admin', 'secret', self.check)
+        self.assertEqual(2, len(self.cache._verified))
+
+
+class TestTemplateEnvironment(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        for name, source in [('gtemplates/base.html', '<h1>{% block title %}{% endblock %}</h1>'),
+                             ('plugin1/index.html', '{% extends "base.html" %}{% block title %}{{ _("one") }}{% endblock %}'),
+                             ('plugin2/index.html', '{% extends "base.html" %}{% block title %}{{ _("two") }}{% endblock %}')]:
+            os.makedirs(os.path.dirname(os.path.join(self.dir, name)), exist_ok=True)
+            with open(os.path.join(self.dir, name), 'w') as f:
+                f.write(source)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def create_http(self):
+        http = Http.__new__(Http)
+        http.gtemplates_dir = os.path.join(self.dir, 'gtemplates')
+        http._bytecode_cache = _TemplateBytecodeCache(os.path.join(self.dir, 'cache'))
+        http._template_env = Environment(loader=FileSystemLoader(http.gtemplates_dir), bytecode_cache=http._bytecode_cache, auto_reload=False)
+        return http
+
+    def test_environments_of_plugins(self):
+        http = self.create_http()
+        env1 = http.create_template_environment([os.path.join(self.dir, 'plugin1')])
+        env2 = http.create_template_environment([os.path.join(self.dir, 'plugin2')])
+        env1.globals['_'] = lambda txt: txt.upper()
+        env2.globals['_'] = lambda txt: txt + '!'
+        self.assertEqual('<h1>ONE</h1>', env1.get_template('index.html').render())
+        self.assertEqual('<h1>two!</h1>', env2.get_template('index.html').render())
+        self.assertNotIn('_', http._template_env.globals)
+        self.assertFalse(env1.auto_reload)
+        # filters and tests of a plugin are not visible to other plugins either
+        env1.filters['shout'] = lambda txt: txt.upper() + '!'
+        env1.tests['loud'] = lambda txt: txt.isupper()
+        self.assertEqual('ONE!', env1.from_string('{{ "one" | shout }}').render())
+        self.assertEqual('True', env1.from_string('{{ "ONE" is loud }}').render())
+        self.assertNotIn('shout', env2.filters)
+        self.assertNotIn('loud', env2.tests)
+        self.assertNotIn('shout', http._template_env.filters)
+        self.assertIn('upper', env2.filters)
+
+    def test_bytecode_cache_survives_restart(self):
+        env = self.create_http().create_template_environment([os.path.join(self.dir, 'plugin1')])
+        env.globals['_'] = str
+        env.get_template('index.html').render()
+        # after a restart the templates are loaded from the bytecode cache without compiling
+        env = self.create_http().create_template_environment([os.path.join(self.dir, 'plugin1')])
+        env.globals['_'] = str
+        def compile(*args, **kwargs):
+            raise AssertionError('template compiled again')
+        env.compile = compile
+        self.assertEqual('<h1>one</h1>', env.get_template('index.html').render())
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -421,6 +421,24 @@ class TestItem(unittest.TestCase):
         self.assertEqual(13, item._value)
         item.set('14')
 
+    def test_update_items(self):
+        sh = MockSmartHome()
+        item1 = lib.item.Item(config={'type': 'num'}, parent=sh, smarthome=sh, path='test_item01')
+        item2 = lib.item.Item(config={'type': 'bool'}, parent=sh, smarthome=sh, path='test_item02')
+        values = []
+        def trigger(item, caller, source, dest):
+            # all items of the batch are already set when the triggers are dispatched
+            values.append((item1(), item2(), caller, source))
+        item1.add_method_trigger(trigger)
+        sh.items.update_items([(item1, '42'), (item2, True)], caller='Scene', source='test_scene')
+        self.assertEqual(42, item1())
+        self.assertTrue(item2())
+        self.assertEqual([(42, True, 'Scene', 'test_scene')], values)
+        # values that cannot be cast are skipped without affecting the rest of the batch
+        sh.items.update_items([(item1, 'qwe'), (item2, False)])
+        self.assertEqual(42, item1())
+        self.assertFalse(item2())
+
     def test_cast_duration(self):
         if verbose == True:
             logger.warning('')
@@ -27,7 +27,8 @@ import logging
 import shutil
 
 from lib.model.smartplugin import SmartPlugin
-from lib.logic import Logics
+from lib.logic import Logics, WatchItemIndex
+from lib.item import Items
 #import lib.logic
 
 from tests.mock.core import MockSmartHome
@@ -147,6 +148,53 @@ class TestLogics(unittest.TestCase):
         self.assertEqual(len(readback),0)
 
 
+class MockItem():
+
+    def __init__(self, path, conf=None):
+        self._path = path
+        self.conf = conf if conf is not None else {}
+
+
+class TestWatchItemIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.index = WatchItemIndex(Items)
+        self.logic1 = 'logic1'
+        self.logic2 = 'logic2'
+
+
+    def test_exact_subscription(self):
+        self.index.subscribe(self.logic1, 'wohnung.licht')
+        self.assertEqual(self.index.lookup(MockItem('wohnung.licht')), (self.logic1,))
+        self.assertEqual(self.index.lookup(MockItem('wohnung.licht2')), ())
+
+
+    def test_wildcard_subscription(self):
+        self.index.subscribe(self.logic1, '*.motion')
+        self.index.subscribe(self.logic2, 'flur.motion')
+        self.assertEqual(self.index.lookup(MockItem('flur.motion')), (self.logic1, self.logic2))
+        # items created after the logic has been loaded are matched too
+        self.assertEqual(self.index.lookup(MockItem('keller.motion')), (self.logic1,))
+        self.assertEqual(self.index.lookup(MockItem('keller.motion.level')), ())
+
+
+    def test_attribute_filter(self):
+        self.index.subscribe(self.logic1, '*:knx_dpt[1]')
+        self.assertEqual(self.index.lookup(MockItem('a.b', {'knx_dpt': '1'})), (self.logic1,))
+        self.assertEqual(self.index.lookup(MockItem('a.c', {'knx_dpt': '5'})), ())
+
+
+    def test_unsubscribe(self):
+        self.index.subscribe(self.logic1, '*.motion')
+        self.index.subscribe(self.logic1, 'flur.licht')
+        self.index.subscribe(self.logic2, 'flur.licht')
+        self.assertEqual(self.index.lookup(MockItem('flur.motion')), (self.logic1,))
+        self.index.unsubscribe(self.logic1)
+        self.assertEqual(self.index.lookup(MockItem('flur.motion')), ())
+        self.assertEqual(self.index.lookup(MockItem('flur.licht')), (self.logic2,))
+        self.assertEqual(self.index.get_subscriptions(self.logic1), [])
+
+
 if __name__ == '__main__':
     unittest.main(verbosity=2)
 
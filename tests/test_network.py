@@ -0,0 +1,477 @@
+#!/usr/bin/env python3
+# vim: set encoding=utf-8 tabstop=4 softtabstop=4 shiftwidth=4 expandtab
+#########################################################################
+#  This file is part of SmartHomeNG
+#  https://github.com/smarthomeNG/smarthome
+#  http://knx-user-forum.de/
+#
+#  SmartHomeNG is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  SmartHomeNG is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with SmartHomeNG If not, see <http://www.gnu.org/licenses/>.
+#########################################################################
+
+import common
+import unittest
+import logging
+import http.server
+import os
+import shutil
+import tempfile
+import socketserver
+import socket
+import threading
+import time
+from unittest import mock
+
+import requests
+
+from lib.network import Http, HttpClient, NetworkLoop, Reachability, Tcp_client, Tcp_server, Udp_client, Udp_server
+from lib.tools import Tools
+
+
+logger = logging.getLogger(__name__)
+
+
+def wait_for(condition, timeout=5):
+    end = time.time() + timeout
+    while not condition() and time.time() < end:
+        time.sleep(0.01)
+    return condition()
+
+
+class TestTcpClient(unittest.TestCase):
+
+    def setUp(self):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(5)
+        self.port = self.server.getsockname()[1]
+
+    def tearDown(self):
+        self.server.close()
+
+    def test_connect_send_receive(self):
+        received = []
+        events = []
+        client = Tcp_client('127.0.0.1', self.port, name='test', autoreconnect=False, binary=True)
+        client.terminator = b'\n'
+        client.set_callbacks(connected=lambda c: events.append('connected'),
+                             data_received=lambda c, data: received.append(data),
+                             disconnected=lambda c: events.append('disconnected'))
+        self.assertTrue(client.connect())
+        peer, addr = self.server.accept()
+        # the connected callback is called by the network loop right after the connected flag is set
+        self.assertTrue(wait_for(lambda: client.connected() and events == ['connected']))
+
+        self.assertTrue(client.send('hello'))
+        self.assertEqual(b'hello', peer.recv(100))
+
+        peer.sendall(b'line1\nli')
+        peer.sendall(b'ne2\nrest')
+        self.assertTrue(wait_for(lambda: len(received) == 2))
+        self.assertEqual([b'line1\n', b'line2\n'], received)
+
+        peer.close()
+        self.assertTrue(wait_for(lambda: 'disconnected' in events))
+        self.assertFalse(client.connected())
+        client.close()
+
+    def test_clients_share_one_thread(self):
+        clients = [Tcp_client('127.0.0.1', self.port, autoreconnect=False) for i in range(10)]
+        threads = threading.active_count()
+        for client in clients:
+            client.connect()
+        peers = [self.server.accept()[0] for client in clients]
+        self.assertTrue(wait_for(lambda: all(client.connected() for client in clients)))
+        self.assertEqual(threads, threading.active_count())
+        self.assertTrue(NetworkLoop.get_instance()._thread.is_alive())
+        for client in clients:
+            client.close()
+        for peer in peers:
+            peer.close()
+
+    def test_reconnect_backoff(self):
+        self.server.close()
+        client = Tcp_client('127.0.0.1', self.port, autoreconnect=False, connect_retries=2, connect_cycle=0.1)
+        start = time.process_time()
+        self.assertTrue(client.connect())
+        time.sleep(0.5)
+        # waiting for the next retry must not consume cpu time (no busy waiting)
+        self.assertLess(time.process_time() - start, 0.3)
+        self.assertFalse(client.connected())
+        self.assertEqual(2, client._connect_counter)
+        client.close()
+
+
+class TestTcpServer(unittest.TestCase):
+
+    def get_free_port(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        return port
+
+    def start_server(self, **kwargs):
+        self.received = []
+        self.port = self.get_free_port()
+        server = Tcp_server(self.port, interface='127.0.0.1', name='test', **kwargs)
+        server.set_callbacks(data_received=lambda server, client, data: self.received.append(data))
+        self.assertTrue(server.start())
+        self.assertTrue(server.listening())
+        return server
+
+    def test_line_mode(self):
+        server = self.start_server(mode=Tcp_server.MODE_TEXT_LINE)
+        sock = socket.create_connection(('127.0.0.1', self.port))
+        sock.sendall(b'first line\r\nsecond ')
+        sock.sendall(b'line \n')
+        self.assertTrue(wait_for(lambda: len(self.received) == 2))
+        self.assertEqual(['first line', 'second line '], self.received)
+        sock.close()
+        server.close()
+        self.assertFalse(server.listening())
+
+    def test_raw_mode(self):
+        server = self.start_server(mode=Tcp_server.MODE_RAW)
+        sock = socket.create_connection(('127.0.0.1', self.port))
+        sock.sendall(b'\x00\x01 \r\n')
+        self.assertTrue(wait_for(lambda: len(self.received) == 1))
+        self.assertEqual([b'\x00\x01 \r\n'], self.received)
+        sock.close()
+        server.close()
+
+    def test_binary_mode_is_decoded(self):
+        # MODE_BINARY (the default) delivers decoded strings as before
+        for kwargs in [{}, {'mode': Tcp_server.MODE_BINARY}]:
+            server = self.start_server(**kwargs)
+            sock = socket.create_connection(('127.0.0.1', self.port))
+            sock.sendall(b'hello \r\n')
+            self.assertTrue(wait_for(lambda: len(self.received) == 1))
+            self.assertEqual(['hello'], self.received)
+            sock.close()
+            server.close()
+
+    def test_send_and_connection_limit(self):
+        clients = []
+        server = self.start_server(max_connections=1)
+        server.set_callbacks(incoming_connection=lambda server, client: clients.append(client))
+        sock1 = socket.create_connection(('127.0.0.1', self.port))
+        self.assertTrue(wait_for(lambda: server.connection_count() == 1))
+        server.send(clients[0], 'welcome')
+        self.assertEqual(b'welcome', sock1.recv(100))
+        # second connection is closed by the server
+        sock2 = socket.create_connection(('127.0.0.1', self.port))
+        self.assertEqual(b'', sock2.recv(100))
+        self.assertEqual(1, server.connection_count())
+        sock1.close()
+        self.assertTrue(wait_for(lambda: server.connection_count() == 0))
+        sock2.close()
+        server.close()
+
+    def test_failing_incoming_connection_callback(self):
+        def incoming_connection(server, client):
+            raise ValueError('rejected by plugin')
+
+        server = self.start_server(max_connections=1)
+        server.set_callbacks(incoming_connection=incoming_connection)
+        for i in range(2):
+            # the connection is closed and does not count towards max_connections
+            sock = socket.create_connection(('127.0.0.1', self.port))
+            sock.settimeout(5)
+            self.assertEqual(b'', sock.recv(100))
+            self.assertTrue(wait_for(lambda: server.connection_count() == 0))
+            sock.close()
+        server.close()
+
+    def test_servers_share_one_thread(self):
+        threads = threading.active_count()
+        servers = [self.start_server() for i in range(5)]
+        self.assertEqual(threads, threading.active_count())
+        for server in servers:
+            server.close()
+
+
+class TestUdp(unittest.TestCase):
+
+    def setUp(self):
+        self.batches = []
+        self.server = Udp_server(0, interface='127.0.0.1', name='test', max_size=16, copy_data=True)
+        self.server.set_callbacks(data_received=lambda server, datagrams: self.batches.append(datagrams))
+        self.assertTrue(self.server.start())
+        self.port = self.server.get_port()
+
+    def tearDown(self):
+        self.server.close()
+        self.assertFalse(self.server.listening())
+
+    def test_send_and_receive(self):
+        responses = []
+        client = Udp_client('127.0.0.1', self.port, name='client')
+        client.set_callbacks(data_received=lambda client, datagrams: responses.extend(bytes(data) for data, address in datagrams))
+        self.assertTrue(client.send('hello'))
+        self.assertTrue(wait_for(lambda: len(self.batches) == 1))
+        data, address = self.batches[0][0]
+        self.assertEqual(b'hello', data)
+        self.assertEqual('127.0.0.1', address[0])
+        self.assertTrue(self.server.sendto(b'world', *address))
+        self.assertTrue(wait_for(lambda: len(responses) == 1))
+        self.assertEqual([b'world'], responses)
+        client.close()
+
+    def test_batches_and_counters(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # block the network loop, so that the datagrams queue up in the socket
+        NetworkLoop.get_instance().call_soon(time.sleep, 0.3)
+        for i in range(10):
+            sock.sendto(str(i).encode(), ('127.0.0.1', self.port))
+        sock.sendto(b'x' * 17, ('127.0.0.1', self.port))
+        self.assertTrue(wait_for(lambda: self.server.datagrams_dropped == 1))
+        sock.close()
+        self.assertEqual(1, len(self.batches))
+        self.assertEqual([str(i).encode() for i in range(10)], [data for data, address in self.batches[0]])
+        stats = self.server.get_statistics()
+        self.assertEqual(10, stats['datagrams_received'])
+        self.assertEqual(10, stats['bytes_received'])
+        self.assertEqual(1, stats['datagrams_dropped'])
+        self.assertEqual(1, stats['batches'])
+
+    def test_multicast_join(self):
+        self.assertTrue(self.server.join_multicast('239.255.0.1', '127.0.0.1'))
+
+
+class _TestHttpHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def do_GET(self):
+        self.server.requests += 1
+        self.server.cookies.append(self.headers.get('Cookie'))
+        etag = '"v{}"'.format(self.server.version)
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = '{} {}'.format(self.path, self.server.version).encode()
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        if self.path == '/cookie':
+            self.send_header('Set-Cookie', 'session=secret; Path=/')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _TestHttpServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+class TestHttpClient(unittest.TestCase):
+
+    def setUp(self):
+        self.server = _TestHttpServer(('127.0.0.1', 0), _TestHttpHandler)
+        self.server.connections = 0
+        self.server.requests = 0
+        self.server.version = 1
+        self.server.cookies = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+        self.client = HttpClient()
+
+    def tearDown(self):
+        self.client.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_keep_alive(self):
+        for i in range(5):
+            self.assertEqual(200, self.client.request('GET', self.url + '/a').status_code)
+        self.assertEqual(5, self.server.requests)
+        self.assertEqual(1, self.server.connections)
+
+    def test_cache_and_revalidation(self):
+        self.assertEqual(b'/a 1', self.client.request('GET', self.url + '/a', cache_ttl=60).content)
+        self.assertEqual(b'/a 1', self.client.request('GET', self.url + '/a', cache_ttl=60).content)
+        self.assertEqual(1, self.server.requests)
+        self.assertEqual(1, self.client.cache_hits)
+        # expired entry is revalidated with its ETag
+        self.assertEqual(b'/a 1', self.client.request('GET', self.url + '/a', cache_ttl=0).content)
+        self.assertEqual(2, self.server.requests)
+        self.assertEqual(1, self.client.cache_revalidated)
+        self.server.version = 2
+        self.assertEqual(b'/a 2', self.client.request('GET', self.url + '/a', cache_ttl=0).content)
+        self.assertEqual(3, self.server.requests)
+
+    def test_cached_responses_are_copies(self):
+        response = self.client.request('GET', self.url + '/a', cache_ttl=60)
+        response.encoding = 'utf-16'
+        response.headers['X-Test'] = 'changed'
+        cached = self.client.request('GET', self.url + '/a', cache_ttl=60)
+        self.assertEqual(1, self.server.requests)
+        self.assertEqual('/a 1', cached.text)
+        self.assertNotIn('X-Test', cached.headers)
+        # Http.get_text() with an encoding does not change the cached response either
+        http = Http(self.url + '/a', cache_ttl=60)
+        HttpClient._instance = self.client
+        try:
+            self.assertEqual('/a 1', http.get_text(encoding='ascii'))
+            self.assertNotEqual('ascii', self.client.request('GET', self.url + '/a', cache_ttl=60).encoding)
+        finally:
+            HttpClient._instance = None
+        self.assertEqual(1, self.server.requests)
+
+    def test_request_headers_are_part_of_the_cache_key(self):
+        self.client.request('GET', self.url + '/a', headers={'Accept-Language': 'de'}, cache_ttl=60)
+        self.client.request('GET', self.url + '/a', headers={'accept-language': 'de'}, cache_ttl=60)
+        self.assertEqual(1, self.server.requests)
+        self.client.request('GET', self.url + '/a', headers={'Accept-Language': 'en'}, cache_ttl=60)
+        self.client.request('GET', self.url + '/a', cache_ttl=60)
+        self.assertEqual(3, self.server.requests)
+
+    def test_cache_with_auth_and_list_params(self):
+        auth = requests.auth.HTTPBasicAuth('user', 'secret')
+        for i in range(2):
+            self.assertEqual(200, self.client.request('GET', self.url + '/a', auth=auth, cache_ttl=60).status_code)
+        # requests' auth objects are not cached
+        self.assertEqual(2, self.server.requests)
+        for i in range(2):
+            self.assertEqual(200, self.client.request('GET', self.url + '/a', auth=('user', 'secret'), cache_ttl=60).status_code)
+            self.assertEqual(200, self.client.request('GET', self.url + '/a', auth=['user', 'secret'], cache_ttl=60).status_code)
+        self.assertEqual(3, self.server.requests)
+        for i in range(2):
+            response = self.client.request('GET', self.url + '/a', params={'id': [1, 2]}, cache_ttl=60)
+            self.assertEqual(b'/a?id=1&id=2 1', response.content)
+        self.assertEqual(4, self.server.requests)
+        self.client.request('GET', self.url + '/a', params={'id': [1, 3]}, cache_ttl=60)
+        self.assertEqual(5, self.server.requests)
+
+    def test_cookies_are_not_shared(self):
+        response = self.client.request('GET', self.url + '/cookie')
+        self.assertEqual('secret', response.cookies.get('session'))
+        self.client.request('GET', self.url + '/a')
+        self.assertEqual([None, None], self.server.cookies)
+        self.assertEqual(0, len(self.client.session.cookies))
+
+    def test_fetch_many(self):
+        urls = [self.url + '/' + str(i) for i in range(10)] + ['http://127.0.0.1:1/']
+        responses = self.client.fetch_many(urls)
+        self.assertEqual(['/{} 1'.format(i) for i in range(10)], [response.text for response in responses[:10]])
+        self.assertIsInstance(responses[10], Exception)
+        self.assertLessEqual(self.server.connections, self.client.pool_maxsize)
+
+    def test_http_and_fetch_url_use_shared_client(self):
+        http = Http(self.url)
+        self.assertEqual('/ 1', http.get_text())
+        self.assertEqual(b'/b 1', Tools().fetch_url(self.url + '/b'))
+        self.assertEqual(False, Tools().fetch_url('http://127.0.0.1:1/', warn_no_connect=0))
+        self.assertEqual(1, self.server.connections)
+        HttpClient.shutdown()
+
+
+class TestReachability(unittest.TestCase):
+
+    def setUp(self):
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(5)
+        self.reachability = Reachability(ports=(self.listener.getsockname()[1],))
+
+    def tearDown(self):
+        self.listener.close()
+
+    def test_check_many(self):
+        start = time.time()
+        # the top level domain .invalid is reserved and never resolves
+        hosts = ['host{}.invalid'.format(i) for i in range(20)]
+        results = self.reachability.check_many(['127.0.0.1', 'localhost'] + hosts, timeout=0.5)
+        self.assertLess(time.time() - start, 2)
+        self.assertTrue(results['127.0.0.1'])
+        self.assertTrue(results['localhost'])
+        self.assertFalse(any(results[host] for host in hosts))
+
+    def test_refused_connection_counts_as_reachable(self):
+        self.reachability.ports = (self.get_closed_port(),)
+        self.assertTrue(self.reachability.check('127.0.0.1', timeout=0.5))
+
+    def test_cache(self):
+        self.assertTrue(self.reachability.check('127.0.0.1'))
+        self.assertTrue(self.reachability.check('127.0.0.1'))
+        self.assertEqual(1, self.reachability.probes)
+        self.assertTrue(self.reachability.check('127.0.0.1', use_cache=False))
+        self.assertEqual(2, self.reachability.probes)
+
+    def test_tools_ping_is_not_cached(self):
+        Reachability._instance = self.reachability
+        try:
+            self.assertTrue(Tools().ping('127.0.0.1'))
+            self.assertTrue(Tools().ping('127.0.0.1'))
+            self.assertEqual(2, self.reachability.probes)
+            self.assertEqual({'127.0.0.1': True}, Tools().ping_many(['127.0.0.1']))
+            self.assertEqual(3, self.reachability.probes)
+            # the cache can be used on request
+            self.assertTrue(Tools().ping('127.0.0.1', use_cache=True))
+            self.assertEqual(3, self.reachability.probes)
+        finally:
+            Reachability._instance = None
+
+    def test_system_ping_without_icmp_sockets(self):
+        directory = tempfile.mkdtemp()
+        try:
+            script = os.path.join(directory, 'ping')
+            with open(script, 'w') as f:
+                f.write('#!/bin/sh\necho "$@" >> {0}.log\nread result < {0}.result\nexit $result\n'.format(script))
+            os.chmod(script, 0o755)
+            reachability = Reachability(ports=())
+            reachability._icmp_available = False
+            with mock.patch.dict(os.environ, {'PATH': directory}):
+                with open(script + '.result', 'w') as f:
+                    f.write('0')
+                self.assertTrue(reachability.check('127.0.0.1', timeout=2))
+                with open(script + '.result', 'w') as f:
+                    f.write('1')
+                self.assertFalse(reachability.check('127.0.0.1', timeout=2, use_cache=False))
+            with open(script + '.log') as f:
+                self.assertEqual(['-c 1 -W 2 127.0.0.1'] * 2, f.read().splitlines())
+
+            # without the ping command only the TCP probes are left
+            reachability = Reachability(ports=self.reachability.ports)
+            reachability._icmp_available = False
+            with mock.patch.dict(os.environ, {'PATH': os.path.join(directory, 'missing')}):
+                with self.assertLogs('lib.network', logging.WARNING):
+                    self.assertTrue(reachability.check('127.0.0.1', timeout=2))
+                self.assertFalse(reachability._ping_available)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_icmp_checksum(self):
+        packet = self.reachability._icmp_packet(1)
+        self.assertEqual(0, Reachability._icmp_checksum(packet))
+
+    def get_closed_port(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        return port
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
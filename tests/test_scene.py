@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+# vim: set encoding=utf-8 tabstop=4 softtabstop=4 shiftwidth=4 expandtab
+#########################################################################
+# Copyright 2018-       Martin Sinn                         m.sinn@gmx.de
+#########################################################################
+#  This file is part of SmartHomeNG
+#  https://github.com/smarthomeNG/smarthome
+#  http://knx-user-forum.de/
+#
+#  SmartHomeNG is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  SmartHomeNG is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with SmartHomeNG If not, see <http://www.gnu.org/licenses/>.
+#########################################################################
+
+import common
+import unittest
+import datetime
+import json
+import logging
+import os
+import shutil
+import tempfile
+from unittest import mock
+
+import bin.smarthome
+import lib.scene
+from lib.scene import LearnedValues, Scenes
+
+
+logger = logging.getLogger(__name__)
+
+
+class MockItem():
+
+    def __init__(self, path, value=0):
+        self._path = path
+        self._value = value
+
+    def __call__(self):
+        return self._value
+
+    def id(self):
+        return self._path
+
+
+class MockShtime():
+
+    def now(self):
+        return datetime.datetime(2018, 7, 1, 12, 0, 0)
+
+
+class MockScheduler():
+
+    def __init__(self):
+        self.jobs = {}
+
+    def add(self, name, obj, prio=3, cron=None, cycle=None, value=None, offset=None, next=None):
+        # like the scheduler, a job with the same name replaces the existing one
+        self.jobs[name] = (obj, next)
+
+
+class MockSmartHome():
+
+    def __init__(self):
+        self.shtime = MockShtime()
+        self.scheduler = MockScheduler()
+
+
+class TestLearnedValues(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, 'learned_values.json')
+
+    def tearDown(self):
+        lib.scene._scenes_instance = None
+        shutil.rmtree(self.dir)
+
+    def create_scenes(self):
+        scenes = Scenes.__new__(Scenes)
+        scenes._sh = MockSmartHome()
+        scenes._learned_values = LearnedValues(self.dir)
+        return scenes
+
+    def test_save_is_debounced(self):
+        scenes = self.create_scenes()
+        for scene, value in [('wohnung.szene', 1), ('wohnung.szene', 2), ('garten.szene', 3)]:
+            scenes._set_learned_value(scene, 1, MockItem('wohnung.licht'), value)
+            scenes._save_learned_values(scene)
+        # learning only schedules one save job for all scenes, the store is not written yet
+        self.assertEqual(['scenes.save_learned_values'], list(scenes._sh.scheduler.jobs))
+        save, next = scenes._sh.scheduler.jobs['scenes.save_learned_values']
+        self.assertEqual(MockShtime().now() + datetime.timedelta(seconds=LearnedValues.save_delay), next)
+        self.assertFalse(os.path.exists(self.filename))
+        save()
+        with open(self.filename) as f:
+            self.assertEqual({'wohnung.szene': {'1#wohnung.licht': 2}, 'garten.szene': {'1#wohnung.licht': 3}}, json.load(f))
+        # nothing is written, if no values have been learned since the last save
+        mtime = os.path.getmtime(self.filename)
+        os.utime(self.filename, (mtime - 10, mtime - 10))
+        save()
+        self.assertEqual(mtime - 10, os.path.getmtime(self.filename))
+
+    def test_reload_after_restart(self):
+        values = LearnedValues(self.dir)
+        values.set('wohnung.szene', 1, 'wohnung.licht', 42.5)
+        values.set('wohnung.szene', '2', 'wohnung.dimmer', [10, 20])
+        values.set('wohnung.szene', 3, 'wohnung.rollo', (1, 2))
+        values.set('wohnung.szene', 4, 'wohnung.farbe', {'r': 255, 'g': None})
+        values.save()
+
+        values = LearnedValues(self.dir)
+        self.assertEqual(42.5, values.get('wohnung.szene', 1, 'wohnung.licht'))
+        self.assertEqual([10, 20], values.get('wohnung.szene', 2, 'wohnung.dimmer'))
+        self.assertEqual([1, 2], values.get('wohnung.szene', 3, 'wohnung.rollo'))
+        self.assertEqual({'r': 255, 'g': None}, values.get('wohnung.szene', 4, 'wohnung.farbe'))
+        self.assertIsNone(values.get('wohnung.szene', 5, 'wohnung.licht'))
+
+    def test_values_that_cannot_be_stored(self):
+        values = LearnedValues(self.dir)
+        values.set('wohnung.szene', 1, 'wohnung.licht', 1)
+        with self.assertLogs('lib.scene', logging.WARNING) as cm:
+            self.assertFalse(values.set('wohnung.szene', 1, 'wohnung.licht', datetime.datetime(2018, 7, 1)))
+            self.assertFalse(values.set('wohnung.szene', 2, 'wohnung.licht', [1, object()]))
+            self.assertFalse(values.set('wohnung.szene', 3, 'wohnung.licht', {1: 'a'}))
+        self.assertEqual(3, len(cm.output))
+        self.assertIn('wohnung.szene#1#wohnung.licht', cm.output[0])
+        # the previously learned value is kept
+        self.assertEqual(1, values.get('wohnung.szene', 1, 'wohnung.licht'))
+        values.save()
+        with open(self.filename) as f:
+            self.assertEqual({'wohnung.szene': {'1#wohnung.licht': 1}}, json.load(f))
+
+    def test_save_on_stop(self):
+        scenes = self.create_scenes()
+        lib.scene._scenes_instance = scenes
+        scenes._set_learned_value('wohnung.szene', 1, MockItem('wohnung.licht'), 1)
+        scenes._save_learned_values('wohnung.szene')
+        sh = mock.Mock()
+        with mock.patch('bin.smarthome.threading') as threading, mock.patch('bin.smarthome.lib.network'), \
+                mock.patch('bin.smarthome.lib.daemon'), mock.patch('bin.smarthome.logging'), mock.patch('bin.smarthome.exit', create=True):
+            threading.enumerate.return_value = []
+            threading.active_count.return_value = 1
+            bin.smarthome.SmartHome.stop(sh)
+        # stopping SmartHomeNG writes the learned values without waiting for the scheduled save
+        with open(self.filename) as f:
+            self.assertEqual({'wohnung.szene': {'1#wohnung.licht': 1}}, json.load(f))
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
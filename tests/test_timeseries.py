@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+# vim: set encoding=utf-8 tabstop=4 softtabstop=4 shiftwidth=4 expandtab
+#########################################################################
+# Copyright 2018-       Martin Sinn                         m.sinn@gmx.de
+#########################################################################
+#  This file is part of SmartHomeNG
+#  https://github.com/smarthomeNG/smarthome
+#  http://knx-user-forum.de/
+#
+#  SmartHomeNG is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  SmartHomeNG is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with SmartHomeNG If not, see <http://www.gnu.org/licenses/>.
+#########################################################################
+
+import common
+import unittest
+import datetime
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import lib.timeseries
+from lib.timeseries import TimeSeries, _decode_blocks, _encode_block, _to_ms
+
+
+logger = logging.getLogger(__name__)
+
+DAY = 86400
+
+
+class MockItem():
+
+    def __init__(self, path, type='num', value=0):
+        self._path = path
+        self._type = type
+        self._value = value
+        self.conf = {'timeseries': 'yes'}
+        self._methods = []
+
+    def __call__(self, value=None):
+        if value is None:
+            return self._value
+        self._value = value
+        for method in self._methods:
+            method(self, 'Test', None, None)
+
+    def id(self):
+        return self._path
+
+    def type(self):
+        return self._type
+
+    def add_method_trigger(self, method):
+        self._methods.append(method)
+
+
+class TestTimeSeries(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        lib.timeseries._timeseries_instance = None
+
+    def tearDown(self):
+        lib.timeseries._timeseries_instance = None
+        shutil.rmtree(self.dir)
+
+    def timeseries(self, **kwargs):
+        return TimeSeries(None, data_dir=self.dir, **kwargs)
+
+    def test_block_encoding(self):
+        timestamps = [1500000000000, 1500000001000, 1500000000500]
+        rows = [(1.5, 2), (-3.0, 4), (0.25, 6)]
+        data = _encode_block(timestamps, rows) + _encode_block([1500000002000], [(7.0, 8)])
+        blocks = [list(block) for block in _decode_blocks(data)]
+        self.assertEqual([(1500000000000, 1.5, 2.0), (1500000001000, -3.0, 4.0), (1500000000500, 0.25, 6.0)], blocks[0])
+        self.assertEqual([(1500000002000, 7.0, 8.0)], blocks[1])
+        # a truncated block is ignored
+        self.assertEqual(1, len(list(_decode_blocks(data[:-4]))))
+
+    def test_to_ms(self):
+        self.assertEqual(1500000000000, _to_ms(1500000000))
+        self.assertEqual(1500000000500, _to_ms('1500000000.5'))
+        self.assertEqual(1500000000000, _to_ms(datetime.datetime.fromtimestamp(1500000000, datetime.timezone.utc)))
+        self.assertEqual(1500000000000 - 2 * 3600000, _to_ms('2h', 1500000000000))
+        self.assertEqual(1500000000000 - 7 * DAY * 1000, _to_ms('1w', 1500000000000))
+        with self.assertRaises(ValueError):
+            _to_ms('yesterday')
+
+    def test_register(self):
+        ts = self.timeseries()
+        item = MockItem('wohnung.temperatur')
+        self.assertTrue(ts.register(item))
+        self.assertTrue(ts.register(item))
+        self.assertFalse(ts.register(MockItem('wohnung.name', type='str')))
+        self.assertEqual(['wohnung.temperatur'], ts.registered_items())
+        self.assertIs(ts, TimeSeries.get_instance())
+        item(21.5)
+        item(22)
+        self.assertEqual([21.5, 22.0], [row[1] for row in ts.query(item, '1h', resolution='raw')])
+
+    def test_rollups(self):
+        ts = self.timeseries()
+        start = 1500000000 - 1500000000 % DAY
+        for i in range(3 * 60):
+            # one value every 30 seconds for 90 minutes
+            ts.add('wohnung.temperatur', i % 10, start + i * 30)
+        ts.add('wohnung.temperatur', 100, start + DAY)
+
+        rows = ts.query('wohnung.temperatur', start, start + 3600, resolution='1m')
+        self.assertEqual(61, len(rows))
+        self.assertEqual(((start + 60) * 1000, 2.0, 3.0, 2.5), rows[1])
+
+        rows = ts.query('wohnung.temperatur', start, start + DAY, resolution='1h')
+        self.assertEqual([start * 1000, (start + 3600) * 1000, (start + DAY) * 1000], [row[0] for row in rows])
+        self.assertEqual((0.0, 9.0, 4.5), rows[0][1:])
+        self.assertEqual((0.0, 9.0, 4.5), rows[1][1:])
+
+        rows = ts.query('wohnung.temperatur', start, start + DAY, resolution='1d')
+        self.assertEqual([(start * 1000, 0.0, 9.0, 4.5), ((start + DAY) * 1000, 100.0, 100.0, 100.0)], rows)
+
+    def test_flush_and_reload(self):
+        ts = self.timeseries(chunk_size=50)
+        start = 1500000000 - 1500000000 % DAY
+        for i in range(120):
+            ts.add('wohnung.temperatur', i, start + i * 60)
+        # without a scheduler the values are only written by flush()
+        self.assertFalse(os.path.exists(os.path.join(self.dir, 'wohnung.temperatur')))
+        ts.flush()
+        self.assertTrue(os.path.isfile(os.path.join(self.dir, 'wohnung.temperatur', 'raw-20170714.tsb')))
+        before = {resolution: ts.query('wohnung.temperatur', start, start + DAY, resolution=resolution) for resolution in lib.timeseries.TIERS}
+        ts.stop()
+
+        lib.timeseries._timeseries_instance = None
+        ts = self.timeseries()
+        after = {resolution: ts.query('wohnung.temperatur', start, start + DAY, resolution=resolution) for resolution in lib.timeseries.TIERS}
+        self.assertEqual(before, after)
+        self.assertEqual(120, len(after['raw']))
+        self.assertEqual(119.0, after['raw'][-1][1])
+
+        # aggregation of the open buckets continues after a restart
+        ts.add('wohnung.temperatur', 1000, start + 119 * 60 + 30)
+        self.assertEqual(((start + 119 * 60) * 1000, 119.0, 1000.0, 559.5), ts.query('wohnung.temperatur', start, start + DAY, resolution='1m')[-1])
+
+    def test_full_buffer_is_written_by_scheduler(self):
+        triggered = []
+
+        class MockScheduler():
+            def trigger(self, name, obj=None, value=None, prio=3):
+                triggered.append((name, obj, value))
+
+        class MockSmartHome():
+            scheduler = MockScheduler()
+
+        ts = TimeSeries(MockSmartHome(), data_dir=self.dir, chunk_size=10)
+        start = 1500000000 - 1500000000 % DAY
+        for i in range(25):
+            ts.add('wohnung.temperatur', i, start + i)
+        # add() does not write, the write is handed to the scheduler once per full buffer
+        self.assertFalse(os.path.exists(os.path.join(self.dir, 'wohnung.temperatur')))
+        self.assertEqual([('sh.timeseries.write', ts._write_series, {'path': 'wohnung.temperatur'})], triggered)
+        name, obj, value = triggered[0]
+        obj(**value)
+        self.assertTrue(os.path.isfile(os.path.join(self.dir, 'wohnung.temperatur', 'raw-20170714.tsb')))
+        ts.add('wohnung.temperatur', 25, start + 25)
+        self.assertEqual(1, len(triggered))
+        for i in range(26, 35):
+            ts.add('wohnung.temperatur', i, start + i)
+        self.assertEqual(2, len(triggered))
+        self.assertEqual(list(range(35)), [row[1] for row in ts.query('wohnung.temperatur', start, start + 100, resolution='raw')])
+
+    def test_query_while_writing(self):
+        ts = self.timeseries()
+        start = 1500000000 - 1500000000 % DAY
+        for i in range(10):
+            ts.add('wohnung.temperatur', i, start + i)
+        ts.flush()
+        for i in range(10, 20):
+            ts.add('wohnung.temperatur', i, start + i)
+        writing = threading.Event()
+        proceed = threading.Event()
+        encode_block = lib.timeseries._encode_block
+
+        def blocking_encode_block(timestamps, rows):
+            writing.set()
+            proceed.wait(5)
+            return encode_block(timestamps, rows)
+
+        lib.timeseries._encode_block = blocking_encode_block
+        try:
+            writer = threading.Thread(target=ts.flush)
+            writer.start()
+            self.assertTrue(writing.wait(5))
+            # neither adding values nor queries wait for the write, no row is returned twice or missed
+            ts.add('wohnung.temperatur', 20, start + 20)
+            ts.add('wohnung.heizung', 1, start)
+            self.assertEqual(list(range(21)), [row[1] for row in ts.query('wohnung.temperatur', start, start + 100, resolution='raw')])
+            proceed.set()
+            writer.join(5)
+        finally:
+            lib.timeseries._encode_block = encode_block
+        self.assertEqual(list(range(21)), [row[1] for row in ts.query('wohnung.temperatur', start, start + 100, resolution='raw')])
+        ts.flush()
+        self.assertEqual(list(range(21)), [row[1] for row in ts.query('wohnung.temperatur', start, start + 100, resolution='raw')])
+        # rows appended after the snapshot are not read from the file
+        pending, sizes = ts._series['wohnung.temperatur'].snapshot('raw', start * 1000, (start + 100) * 1000)
+        with open(os.path.join(self.dir, 'wohnung.temperatur', 'raw-20170714.tsb'), 'ab') as f:
+            f.write(_encode_block([(start + 21) * 1000], [(21.0, )]))
+        rows = lib.timeseries._read_rows(os.path.join(self.dir, 'wohnung.temperatur'), 'raw', start * 1000, (start + 100) * 1000, sizes)
+        self.assertEqual(list(range(21)), [row[1] for row in rows])
+
+    def test_expire(self):
+        ts = self.timeseries(retention={'raw': 2, '1m': 10})
+        start = 1500000000 - 1500000000 % DAY
+        for day in range(5):
+            ts.add('wohnung.temperatur', day, start + day * DAY)
+        ts.flush()
+        self.assertEqual(3, ts.expire(start + 5 * DAY))
+        self.assertEqual([3.0, 4.0], [row[1] for row in ts.query('wohnung.temperatur', start, start + 5 * DAY, resolution='raw')])
+        self.assertEqual(5, len(ts.query('wohnung.temperatur', start, start + 5 * DAY, resolution='1m')))
+        self.assertEqual(0, ts.expire(start + 5 * DAY))
+
+    def test_select_resolution(self):
+        ts = self.timeseries()
+        self.assertEqual('raw', ts.select_resolution('10m'))
+        self.assertEqual('1m', ts.select_resolution('12h'))
+        self.assertEqual('1h', ts.select_resolution('30d'))
+        self.assertEqual('1d', ts.select_resolution('1000d'))
+        self.assertEqual('1h', ts.select_resolution('12h', max_points=100))
+        with self.assertRaises(ValueError):
+            ts.query('wohnung.temperatur', '1h', resolution='5m')
+
+    def test_query_path(self):
+        ts = self.timeseries()
+        ts.add('wohnung.temperatur', 21)
+        self.assertEqual(1, len(ts.query('wohnung.temperatur', '1h')))
+        # only registered items and items with stored data can be queried
+        for path in ['/etc', '../..', '..', '.', 'wohnung/../..', 'wohnung.unbekannt']:
+            with self.assertRaises(KeyError):
+                ts.query(path, '1h')
+        with self.assertRaises(ValueError):
+            ts.add('../wohnung.temperatur', 21)
+        self.assertFalse(os.path.exists(os.path.join(os.path.dirname(self.dir), 'wohnung.temperatur')))
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
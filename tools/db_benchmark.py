@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+# vim: set encoding=utf-8 tabstop=4 softtabstop=4 shiftwidth=4 expandtab
+
+"""
+This script measures the throughput of lib.db with a sqlite database in a temporary directory.
+
+- ``pool``: mixed read/write throughput of several threads with one connection and with a pool of connections
+- ``execute``: overhead of execute() (statement and parameter translation) compared to the plain DB-API cursor
+- ``insert``: insert throughput with a commit per row, with executemany() in a transaction and with a BatchWriter
+- ``queue``: time the calling thread is blocked per write, writing directly and with the queued writer
+"""
+
+import argparse
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import timeit
+
+sys.path.insert(0, os.path.sep.join(os.path.realpath(__file__).split(os.path.sep)[:-2]))
+
+import lib.db
+
+
+def create_database(directory, **kwargs):
+    params = {'database': os.path.join(directory, 'benchmark.db'), 'check_same_thread': False}
+    db = lib.db.Database('benchmark', sqlite3, params, 'qmark', **kwargs)
+    db.connect()
+    return db
+
+
+def benchmark_pool(directory, threads, operations):
+    """Runs the mixed workload (one write per four reads) with one connection and with a pool"""
+    db = create_database(directory)
+    db.execute("CREATE TABLE log (time INTEGER, item TEXT, val REAL)")
+    db.execute("CREATE INDEX log_time ON log (time)")
+    cur = db.cursor()
+    cur.executemany("INSERT INTO log VALUES (?, ?, ?)", [(i, 'item{}'.format(i % 100), i * 0.5) for i in range(20000)])
+    db.commit()
+    db.close()
+
+    for connections in (1, threads):
+        db = create_database(directory, max_connections=connections)
+
+        def worker(number):
+            for i in range(operations):
+                with db.connection() as conn:
+                    cur = conn.cursor()
+                    if i % 5 == 0:
+                        db.execute("INSERT INTO log VALUES (?, ?, ?)", (20000 + i, 'item{}'.format(number), i), cur=cur)
+                        conn.commit()
+                    else:
+                        db.execute("SELECT item, AVG(val) FROM log WHERE time BETWEEN ? AND ? GROUP BY item", (i * 10, i * 10 + 5000), cur=cur)
+                        cur.fetchall()
+                    cur.close()
+
+        workers = [threading.Thread(target=worker, args=(number,)) for number in range(threads)]
+        start = time.time()
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        duration = time.time() - start
+        print("pool: {} threads, {} connection(s): {:.0f} operations/s".format(threads, connections, threads * operations / duration))
+        db.close()
+
+
+def benchmark_execute(directory, operations):
+    """Measures the time per execute() call of a statement in named style on the qmark style sqlite driver"""
+    db = lib.db.Database('benchmark', sqlite3, {'database': ':memory:'}, 'named')
+    db.connect()
+    cur = db.cursor()
+    stmt = "SELECT :time, :item, :val, :changed, :duration"
+    params = {'time': 1, 'item': 'wohnung.licht', 'val': 1.0, 'changed': 2, 'duration': 3}
+    plain = timeit.timeit(lambda: cur.execute("SELECT ?, ?, ?, ?, ?", (1, 'wohnung.licht', 1.0, 2, 3)), number=operations)
+    prepare = timeit.timeit(lambda: db._prepare(stmt, params), number=operations)
+    execute = timeit.timeit(lambda: db.execute(stmt, params, cur=cur), number=operations)
+    print("execute: plain cursor {:.2f} us, _prepare {:.2f} us, execute() {:.2f} us".format(plain / operations * 1e6, prepare / operations * 1e6, execute / operations * 1e6))
+    if hasattr(db, 'statement_cache_info'):
+        print("execute: statement cache {}".format(db.statement_cache_info()))
+    db.close()
+
+
+def benchmark_insert(directory, operations):
+    """Measures the insert throughput of the different write methods"""
+    db = create_database(directory)
+    db.execute("CREATE TABLE log (time INTEGER, item TEXT, val REAL)")
+    db.commit()
+    rows = [(i, 'item{}'.format(i % 100), i * 0.5) for i in range(operations)]
+
+    start = time.time()
+    for row in rows:
+        db.execute("INSERT INTO log VALUES (?, ?, ?)", row)
+        db.commit()
+    print("insert: commit per row {:.0f} rows/s".format(operations / (time.time() - start)))
+
+    start = time.time()
+    with db.transaction() as cur:
+        db.executemany("INSERT INTO log VALUES (?, ?, ?)", rows, cur=cur)
+    print("insert: executemany() in transaction() {:.0f} rows/s".format(operations / (time.time() - start)))
+
+    writer = lib.db.BatchWriter(db, "INSERT INTO log VALUES (?, ?, ?)", max_rows=100)
+    start = time.time()
+    for row in rows:
+        writer.add(row)
+    writer.close()
+    print("insert: BatchWriter (100 rows per transaction) {:.0f} rows/s".format(operations / (time.time() - start)))
+    db.close()
+
+
+def benchmark_queue(directory, operations):
+    """Measures the time the calling thread is blocked per write, writing directly and with the queued writer"""
+    db = create_database(directory)
+    db.execute("CREATE TABLE log (time INTEGER, item TEXT, val REAL)")
+    db.commit()
+    rows = [(i, 'item{}'.format(i % 100), i * 0.5) for i in range(operations)]
+
+    latencies = []
+    for row in rows:
+        start = time.time()
+        with db.transaction() as cur:
+            db.execute("INSERT INTO log VALUES (?, ?, ?)", row, cur=cur)
+        latencies.append(time.time() - start)
+    print("queue: direct write, caller blocked {:.1f} us avg, {:.1f} us max".format(sum(latencies) / operations * 1e6, max(latencies) * 1e6))
+
+    writer = db.start_writer(batch_size=100, max_delay=0.05)
+    latencies = []
+    start_all = time.time()
+    for row in rows:
+        start = time.time()
+        db.enqueue("INSERT INTO log VALUES (?, ?, ?)", row)
+        latencies.append(time.time() - start)
+    writer.flush()
+    print("queue: enqueue(), caller blocked {:.1f} us avg, {:.1f} us max, {:.0f} rows/s written".format(sum(latencies) / operations * 1e6, max(latencies) * 1e6, operations / (time.time() - start_all)))
+    print("queue: {}".format(writer.statistics()))
+    db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks for lib.db')
+    parser.add_argument('benchmark', choices=['pool', 'execute', 'insert', 'queue'], help='benchmark to run')
+    parser.add_argument('--threads', type=int, default=4, help='number of threads')
+    parser.add_argument('--operations', type=int, default=500, help='number of operations (per thread)')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        if args.benchmark == 'pool':
+            benchmark_pool(directory, args.threads, args.operations)
+        elif args.benchmark == 'execute':
+            benchmark_execute(directory, args.operations)
+        elif args.benchmark == 'insert':
+            benchmark_insert(directory, args.operations)
+        elif args.benchmark == 'queue':
+            benchmark_queue(directory, args.operations)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# vim: set encoding=utf-8 tabstop=4 softtabstop=4 shiftwidth=4 expandtab
+
+"""
+This script measures the time lib.shyaml needs to load yaml files.
+
+It loads the yaml files in tests/resources and a large synthetic item file with the
+pure Python loader and with the C based loader of libyaml (if ruamel.yaml has been
+built with libyaml) and checks that both return the same data.
+"""
+
+import argparse
+import glob
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.sep.join(os.path.realpath(__file__).split(os.path.sep)[:-2]))
+
+import lib.shyaml as shyaml
+
+
+def create_item_file(directory, items):
+    """Creates an item file with the given number of items (with three child items each)"""
+    filename = os.path.join(directory, 'items.yaml')
+    with open(filename, 'w') as f:
+        for number in range(items):
+            f.write("room{}:\n    name: Room {}\n".format(number, number))
+            for child in ('light', 'temperature', 'window'):
+                f.write("    {}:\n        type: num\n        visu_acl: rw\n        knx_dpt: 9\n".format(child))
+                f.write("        knx_listen:\n          - 1/2/{}\n          - 1/3/{}\n".format(number % 256, number % 256))
+                f.write("        eval: 'value * 2 # comment'\n")
+    return filename
+
+
+def benchmark_file(filename, repeat):
+    with open(filename) as f:
+        sdata = f.read().replace('\n', '\n\n')
+    python = timeit.timeit(lambda: shyaml._safe_load(sdata, shyaml.yaml.SafeLoader, True), number=repeat) / repeat
+    result = "{}: python {:.2f} ms".format(os.path.basename(filename), python * 1000)
+    if shyaml._CSafeLoader is not None:
+        try:
+            same = shyaml._safe_load(sdata, shyaml._CSafeLoader, True) == shyaml._safe_load(sdata, shyaml.yaml.SafeLoader, True)
+        except Exception as e:
+            result += ", libyaml fails ({}), falls back to python".format(str(e).splitlines()[0])
+        else:
+            if not same:
+                result += ", DIFFERENT RESULT of the C loader"
+            c = timeit.timeit(lambda: shyaml._safe_load(sdata, shyaml._CSafeLoader, True), number=repeat) / repeat
+            result += ", libyaml {:.2f} ms ({:.1f}x)".format(c * 1000, python / c)
+    load = timeit.timeit(lambda: shyaml.yaml_load(filename, ordered=True), number=repeat) / repeat
+    print(result + ", yaml_load() {:.2f} ms".format(load * 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark for lib.shyaml')
+    parser.add_argument('--items', type=int, default=2000, help='number of items in the synthetic item file')
+    parser.add_argument('--repeat', type=int, default=5, help='number of loads per file')
+    args = parser.parse_args()
+
+    if shyaml._CSafeLoader is None:
+        print("libyaml is not available, only the pure Python loader is measured")
+    base = os.path.sep.join(os.path.realpath(__file__).split(os.path.sep)[:-2])
+    for filename in sorted(glob.glob(os.path.join(base, 'tests', 'resources', '*.yaml'))):
+        benchmark_file(filename, args.repeat)
+
+    directory = tempfile.mkdtemp()
+    try:
+        benchmark_file(create_item_file(directory, args.items), args.repeat)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()